@@ -9,7 +9,8 @@ from .neuron import Neuron
 from . import rendering
 from . import source
 from .source import get_source
+from . import tiles
 from . import utils
 
 __all__ = ['algorithms', 'connection', 'connect', 'errors', 'neuron',
-           'rendering', 'source', 'utils', 'get_source', 'Neuron']
+           'rendering', 'source', 'tiles', 'utils', 'get_source', 'Neuron']
@@ -1,13 +1,15 @@
 #!/usr/bin/env python
 
+from . import batch
 from . import graph
 from . import images
 from . import morphology
 from . import myelination
 from . import skeleton
+from . import spatial
 from . import wiring
 from . import skeleton_json_new_to_old
 
 #__all__ = ['myelination', 'synapses', 'wiring']
-__all__ = ['graph', 'images', 'morphology', 'skeleton',
+__all__ = ['batch', 'graph', 'images', 'morphology', 'skeleton', 'spatial',
            'wiring', 'myelination', 'skeleton_json_new_to_old']
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Run a function over many items in this process or in worker processes
+
+Large inputs (arrays, a source...) are shared with the workers through a
+module level state dict that is set before the pool is forked, so they
+are not pickled for every item. Only one map_items can run at a time.
+"""
+
+import multiprocessing
+
+
+# shared with map_items worker processes (set before fork)
+_state = {}
+
+
+def state():
+    """The state passed to the running map_items (in any process)"""
+    return _state
+
+
+def map_items(function, items, state=None, processes=None):
+    """
+    Generates function(item) for each item, run in this process (in
+    order) if processes is None or else in processes worker processes
+    (in the order they finish)
+
+    state (a dict) is available to function through batch.state() while
+    the items are run. The state is cleared and the workers are
+    terminated when all items are done, on errors and when the generator
+    is closed early.
+    """
+    _state.clear()
+    _state.update(state or {})
+    pool = None
+    try:
+        if processes is None:
+            for item in items:
+                yield function(item)
+        else:
+            pool = multiprocessing.Pool(processes=processes)
+            for r in pool.imap_unordered(function, items):
+                yield r
+            pool.close()
+            pool.join()
+            pool = None
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _state.clear()
@@ -1,38 +1,101 @@
 #!/usr/bin/env python
 
-import numpy
+import logging
 import math
+from multiprocessing.pool import ThreadPool
+
+import numpy
 
 from .. import errors
 
 
+def _fetch_tile(args):
+    """Fetch and decode one tile, returns (index, image or None)"""
+    conn, index, kwargs = args
+    try:
+        return index, conn.fetch_tile(**kwargs)
+    except IOError as e:
+        # urllib2 and PIL (decoding) errors
+        logging.warning("Failed to fetch tile %s: %s", kwargs, e)
+        return index, None
+
+
+def fetch_tiles(conn, tiles, threads=8):
+    """
+    Fetch and decode tiles in threads worker threads (in this thread if
+    threads < 2)
+
+    tiles is a list of (index, kwargs) where kwargs are the conn.fetch_tile
+    arguments (url and/or row, column, z_index... which are needed to use
+    the tile cache), tiles are generated as (index, image) in the order
+    they arrive, image is None for tiles that failed
+    """
+    args = [(conn, index, kwargs) for (index, kwargs) in tiles]
+    if threads is None or threads < 2 or len(args) < 2:
+        for a in args:
+            yield _fetch_tile(a)
+        return
+    pool = ThreadPool(min(threads, len(args)))
+    try:
+        for r in pool.imap_unordered(_fetch_tile, args):
+            yield r
+    finally:
+        pool.terminate()
+
+
 def get_web_montage(conn, vertex_length, vertex_height, z_index, stack_id=None,
-                    tiletype=4, shp=(1024, 1024)):
+                    tiletype=4, shp=(1024, 1024), threads=8, prefetch=0):
     """This function takes a range of catmaid tiles on one index (l, h, z) and
-       stiches those tiles together into one image."""
-    vslices = []
-    for i in range(vertex_length[0], vertex_height[0] + 1):
-        hslices = []
-        for j in range(vertex_length[1], vertex_height[1] + 1):
+       stiches those tiles together into one image.
+
+       Tiles are fetched concurrently (see fetch_tiles) and written into
+       one preallocated image, out of range or failed tiles are left as 0.
+       If conn has a tile_cache, the tiles (and a border of 1 tile) of the
+       next prefetch sections are fetched into it in the background."""
+    rows = range(vertex_length[0], vertex_height[0] + 1)
+    columns = range(vertex_length[1], vertex_height[1] + 1)
+    if prefetch and getattr(conn, 'tile_cache', None) is not None:
+        conn.prefetch_tiles(
+            range(rows[0] - 1, rows[-1] + 2),
+            range(columns[0] - 1, columns[-1] + 2),
+            range(z_index + 1, z_index + prefetch + 1),
+            tiletype=tiletype, stack_id=stack_id)
+    tiles = []
+    for (i, row) in enumerate(rows):
+        for (j, column) in enumerate(columns):
             try:
-                img = conn.fetch_tile(row=i, column=j, z_index=z_index,
-                                      stack_id=stack_id, tiletype=tiletype)
-                if img.shape != shp:
-                    raise ValueError(
-                        "invalid tile shape %s does not match actual tile"
-                        "shape %s" % (img.shape, shp))
-            except errors.InvalidUrl as e:
-                img = numpy.zeros(shp)
-            hslices.append(img)
-        vslices.append(numpy.hstack(hslices))
-    full_img = numpy.vstack(vslices)
+                url = conn.fetch_tile_url(
+                    row, column, z_index, tiletype=tiletype,
+                    stack_id=stack_id)
+            except errors.InvalidUrl:
+                continue
+            tiles.append(((i, j), {
+                'row': row, 'column': column, 'z_index': z_index,
+                'tiletype': tiletype, 'stack_id': stack_id, 'url': url}))
+    full_img = None
+    for ((i, j), img) in fetch_tiles(conn, tiles, threads):
+        if img is None:
+            continue
+        if img.shape[:2] != tuple(shp):
+            raise ValueError(
+                "invalid tile shape %s does not match actual tile"
+                "shape %s" % (img.shape, shp))
+        if full_img is None:
+            full_img = numpy.zeros(
+                (len(rows) * shp[0], len(columns) * shp[1]) + img.shape[2:],
+                dtype=img.dtype)
+        full_img[i * shp[0]:(i + 1) * shp[0],
+                 j * shp[1]:(j + 1) * shp[1]] = img
+    if full_img is None:
+        full_img = numpy.zeros((len(rows) * shp[0], len(columns) * shp[1]))
     return full_img
 
 
 def img_from_catmaid(conn, ctr_x_px, ctr_y_px, z_index,
                      tiletype=4, tile_shape=(1024, 1024),
                      imgshape=(3072, 3072), points=None, colors=None,
-                     stack_id=None, add_points=False, image_copy=False):
+                     stack_id=None, add_points=False, image_copy=False,
+                     threads=8, prefetch=0, edges=None, edge_colors=None):
     """
     Inputs:
         ctr_x_px -- x coordinate in catmaid pixel space used for centering of
@@ -50,6 +113,13 @@ def img_from_catmaid(conn, ctr_x_px, ctr_y_px, z_index,
                       positions on the image
         image_copy = a boolean toggle used to return a second cropped image
                      without the node points
+        threads -- the number of threads used to fetch tiles
+        prefetch -- the number of following sections to prefetch into the
+                    tile cache of conn (see get_web_montage)
+        edges -- a list or array of (x0, y0, x1, y1) line segments in catmaid
+                 pixel space drawn under the points (see
+                 add_points_to_image)
+        edge_colors -- a list or array of colors for the edges
     ----------
     Outputs:
         img -- an image that is cropped from a full image of
@@ -89,7 +159,8 @@ def img_from_catmaid(conn, ctr_x_px, ctr_y_px, z_index,
     full_img = get_web_montage(conn,
                                (out_top_tilespace, out_left_tilespace),
                                (out_bot_tilespace, out_right_tilespace),
-                               z_index, stack_id, tiletype, tile_shape)
+                               z_index, stack_id, tiletype, tile_shape,
+                               threads, prefetch)
     img = full_img[crop_y_min:crop_y_max, crop_x_min:crop_x_max]
     if image_copy:
         copy = img
@@ -97,7 +168,8 @@ def img_from_catmaid(conn, ctr_x_px, ctr_y_px, z_index,
         copy = None
     if add_points:
         img = add_points_to_image(points, img, imgshape, (left, top), z_index,
-                                  radius=8., colors=colors)
+                                  radius=8., colors=colors, edges=edges,
+                                  edge_colors=edge_colors)
     return img, copy
 
 
@@ -109,7 +181,8 @@ def add_depth_to_image(arr, depth=3):
 # Takes an image from catmaid as input, and places circles at node positions
 # On the image
 def add_points_to_image(points, image, imgshape, top_left_corner, z_index,
-                        radius=8., colors=None):
+                        radius=8., colors=None, edges=None, edge_colors=None,
+                        line_width=1):
     """
     This function add location indicators for nodes on an image pulled from
     catmaid. This script requires the top left point position of the tilespace
@@ -117,7 +190,7 @@ def add_points_to_image(points, image, imgshape, top_left_corner, z_index,
     of the circle indicator on the image.
     ---------------
     Inputs:
-        points - a list of (x, y) points
+        points - a list of (skeleton id, x, y) points
         image - a numpy array(image) pulled from catmaid
         imgshape - the resolution of the image
         top_left_corner = the top left corner (x, y) of the image in pixel
@@ -125,43 +198,107 @@ def add_points_to_image(points, image, imgshape, top_left_corner, z_index,
         radius - size of circle (node indicator)
         colors - a list of colors to represent different skeletons (Will be
                  a default color for all nodes if left as None)
+        edges - a list of (x0, y0, x1, y1) line segments (in the pixel
+                coordinates of points) drawn under the circles, for example
+                the parent/child edges of a section from
+                population.node_index.SectionIndex.section
+        edge_colors - a list of colors for the edges (Will be the default
+                      color for all edges if left as None)
+        line_width - the width of the edges in pixels
     ---------------
     Outputs:
         img - a numpy array(image) that has node positions indicated on a
               catmaid image.
     """
     img = add_depth_to_image(image, depth=3)
-    if colors is not None:
-        for pt, col in zip(points, colors):
-            x_point = pt[1] - top_left_corner[0]
-            y_point = pt[2] - top_left_corner[1]
-            pts = numpy.array([pt[0], x_point, y_point])
-            img = addcircle(img, z_index, radius, pts, col)
-        return img
-    else:
-        for pt in points:
-            x_point = pt[1] - top_left_corner[0]
-            y_point = pt[2] - top_left_corner[1]
-            pts = numpy.array([pt[0], x_point, y_point])
-            img = addcircle(img, z_index, radius, pts)
+    corner = numpy.asarray(top_left_corner, dtype='f8')
+    if edges is not None and len(edges):
+        edges = numpy.asarray(edges, dtype='f8').reshape((-1, 4))
+        if edge_colors is None:
+            edge_colors = (232, 96, 28)
+        draw_lines(img, edges[:, :2] - corner, edges[:, 2:] - corner,
+                   edge_colors, line_width)
+    if len(points) == 0:
         return img
+    points = numpy.asarray(points, dtype='f8')
+    xy = points[:, 1:3] - corner
+    if colors is None:
+        colors = [(232, 96, 28)] * len(points)
+    colors = numpy.asarray(colors)
+    drawn = draw_points(img, xy, radius, colors)
+    for sid in numpy.unique(points[~drawn, 0]):
+        print ("Skeleton {} will be out of bounds for specified image area on"
+               " section {}".format(int(sid), z_index))
+    return img
+
+
+def draw_points(arr, xy, r, colors):
+    """
+    Draw filled circles (of radius r) at (x, y) positions xy into an
+    image with colors (one per point or one for all points)
+
+    All circles are drawn at once by stamping the window around each point
+    (instead of masking the full image per point), later points are drawn
+    over earlier ones.
+
+    Returns a boolean array of the points that were (partly) in the image
+    """
+    xy = numpy.atleast_2d(numpy.asarray(xy, dtype='f8'))
+    colors = numpy.asarray(colors)
+    if colors.ndim < 2:
+        colors = numpy.tile(colors, (len(xy), 1))
+    R = int(math.ceil(r))
+    oy, ox = [o.ravel() for o in numpy.mgrid[-R:R + 2, -R:R + 2]]
+    # pixels of the window around each point (points x window)
+    x = numpy.floor(xy[:, :1]).astype('i8') + ox
+    y = numpy.floor(xy[:, 1:]).astype('i8') + oy
+    inside = (
+        ((x - xy[:, :1]) ** 2 + (y - xy[:, 1:]) ** 2 <= r ** 2) &
+        (x >= 0) & (x < arr.shape[1]) & (y >= 0) & (y < arr.shape[0]))
+    i = numpy.nonzero(inside)[0]
+    arr[y[inside], x[inside]] = colors[i]
+    return inside.any(axis=1)
+
+
+def draw_lines(arr, starts, ends, colors, width=1):
+    """
+    Draw lines from (x, y) starts to ends into an image with colors (one
+    per line or one for all lines)
+
+    Every line is sampled once per pixel along its longest axis, all
+    samples are drawn at once (as circles of diameter width if width > 1)
+    """
+    starts = numpy.atleast_2d(numpy.asarray(starts, dtype='f8'))
+    ends = numpy.atleast_2d(numpy.asarray(ends, dtype='f8'))
+    if len(starts) == 0:
+        return arr
+    colors = numpy.asarray(colors)
+    if colors.ndim < 2:
+        colors = numpy.tile(colors, (len(starts), 1))
+    d = ends - starts
+    n = numpy.ceil(numpy.abs(d).max(axis=1)).astype('i8') + 1
+    line = numpy.repeat(numpy.arange(len(starts)), n)
+    # position of each sample along its line (0 to 1)
+    t = numpy.arange(n.sum()) - numpy.repeat(numpy.cumsum(n) - n, n)
+    t = t / numpy.maximum(n - 1, 1).astype('f8')[line]
+    xy = starts[line] + d[line] * t[:, numpy.newaxis]
+    if width > 1:
+        draw_points(arr, xy, width / 2., colors[line])
+        return arr
+    x, y = numpy.round(xy).astype('i8').T
+    inside = (x >= 0) & (x < arr.shape[1]) & (y >= 0) & (y < arr.shape[0])
+    arr[y[inside], x[inside]] = colors[line[inside]]
+    return arr
 
 
 def addcircle(arr, z_index, r, position=None, color=(232, 96, 28)):
     """
-    This function adds a circle to an image by creating a boolean mask where
-    the circle will be placed, and adding the node to the image with the
-    correct color.
+    This function adds a circle (of radius r) at the (id, x, y) position
+    to an image with the given color, see draw_points.
     """
     if position is None:
-        position = [i/2 for i in arr.shape]
-    y, x = numpy.ogrid[-position[2]:(arr.shape[0]-position[2]),
-                       -position[1]:(arr.shape[1]-position[1])]
-    circle = (x**2 + y**2) <= r**2
-    try:
-        arr[circle] = numpy.vstack([numpy.array(color) for i in
-                                    range(arr[circle].shape[0])])
-    except:
+        position = [0, arr.shape[1] / 2, arr.shape[0] / 2]
+    if not draw_points(arr, [position[1:3]], r, color)[0]:
         print ("Skeleton {} will be out of bounds for specified image area on"
                " section {}".format(int(position[0]), z_index))
     return arr
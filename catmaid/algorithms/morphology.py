@@ -81,56 +81,111 @@ def node_edge_array(neuron):
     return nodes, edges
 
 
+def graph_arrays(neuron, graph=None):
+    """
+    graph_arrays(neuron, graph=None)
+
+    Returns the tree arrays of a neuron graph
+
+    Input:
+     - Neuron (from Neuron class)
+     - graph  (networkx graph of the Neuron, default is neuron.dgraph)
+
+    Output:
+     - nodes (N x 3 array of node xyz coordinates)
+     - edges (E x 2 array of (parent, child) indices into nodes)
+     - nids  (list of the N node ids in the order of nodes)
+    """
+    if graph is None:
+        graph = neuron.dgraph
+    nids = list(graph.nodes())
+    lookup = dict([(nid, i) for (i, nid) in enumerate(nids)])
+    nodes = numpy.array(
+        [node_position(neuron.nodes[nid]) for nid in nids],
+        dtype='f8').reshape((-1, 3))
+    edges = numpy.array(
+        [(lookup[u], lookup[v]) for (u, v) in graph.edges()],
+        dtype='i8').reshape((-1, 2))
+    return nodes, edges, nids
+
+
+def resample_tree(nodes, edges, distance=40):
+    """
+    resample_tree(nodes, edges, distance=40)
+
+    Resamples every edge of a tree so that no sub-edge is longer than
+    distance. All edges are processed at once (no recursion or per-edge
+    loops) so this is safe for deep arbors.
+
+    Input:
+     - nodes    (N x 3 array of node coordinates)
+     - edges    (E x 2 array of (start, end) indices into nodes)
+     - distance (maximum sub-edge length, numpy.inf disables resampling)
+
+    Output:
+     - points   (P x 3 array, the N input nodes followed by all
+                 interpolated points)
+     - segments (S x 2 array of (start, end) indices into points)
+     - edge_ids (S array of the index of the source edge of each segment)
+    """
+    if distance is None:
+        distance = numpy.inf
+    if distance <= 0:
+        raise ValueError(
+            "resample distance must be > 0 [{}]".format(distance))
+    nodes = numpy.asarray(nodes, dtype='f8').reshape((-1, 3))
+    edges = numpy.asarray(edges, dtype='i8').reshape((-1, 2))
+    n_nodes = len(nodes)
+    u = nodes[edges[:, 0]]
+    delta = nodes[edges[:, 1]] - u
+    lengths = numpy.sqrt(numpy.sum(delta ** 2., axis=1))
+    # number of sub-edges per edge
+    n_sub = numpy.maximum(
+        numpy.ceil(lengths / distance), 1).astype('i8')
+    edge_ids = numpy.repeat(numpy.arange(len(edges)), n_sub)
+    first = numpy.cumsum(n_sub) - n_sub
+    # index of each sub-edge within its source edge
+    sub = numpy.arange(len(edge_ids)) - numpy.repeat(first, n_sub)
+    # every sub-edge but the first of an edge starts at a new point
+    new = sub > 0
+    eids = edge_ids[new]
+    scale = numpy.zeros(len(lengths))
+    nz = lengths > 0
+    scale[nz] = distance / lengths[nz]
+    new_points = u[eids] + delta[eids] * (
+        sub[new] * scale[eids])[:, numpy.newaxis]
+    points = numpy.vstack((nodes, new_points))
+    # assign start and end point indices
+    starts = edges[edge_ids, 0].copy()
+    starts[new] = n_nodes + numpy.arange(len(new_points))
+    ends = edges[edge_ids, 1].copy()
+    # a sub-edge that is not the last of its edge ends where the next starts
+    not_last = sub < (n_sub[edge_ids] - 1)
+    ends[not_last] = starts[numpy.where(not_last)[0] + 1]
+    return points, numpy.column_stack((starts, ends)), edge_ids
+
+
 def resampled_edge_array(neuron, graph=None, distance=40):
     """Returns an array of [sx sy sz ex ey ez], where s=start/e=end of edge"""
-    edge_array = []
     if graph is None:
         graph = neuron.dgraph
-    for u, v in graph.edges_iter():
-        un = neuron.nodes[u]
-        vn = neuron.nodes[v]
-        up = numpy.array([un['x'], un['y'], un['z']], dtype='f8')
-        vp = numpy.array([vn['x'], vn['y'], vn['z']], dtype='f8')
-        d = numpy.linalg.norm(vp - up)
-        if d > distance:
-            # resample this
-            s = up
-            delta = distance
-            n = (vp - up) / d
-            # print d, up, vp
-            while delta < d:
-                # compute new point that is delta away from p
-                e = n * delta + up
-                # print numpy.linalg.norm(e - s), s, e
-                edge_array.append(numpy.hstack((s, e)))
-                s = e
-                delta += distance
-            # print numpy.linalg.norm(vp - s), s, vp
-            edge_array.append(numpy.hstack((s, vp)))
-        else:
-            edge_array.append(numpy.hstack((up, vp)))
-    return numpy.array(edge_array)
+    nodes, edges, _ = graph_arrays(neuron, graph)
+    points, segments, _ = resample_tree(nodes, edges, distance)
+    return numpy.hstack((points[segments[:, 0]], points[segments[:, 1]]))
 
 
-def resampled_node_array(
-        neuron, graph=None, distance=40, start=None, end=None, nodes=None,
-        edges=None):
+def resampled_node_array(neuron, graph=None, distance=40):
     '''
-    resampled_node_array(neuron, graph=None, distance=40, start=None, end=None,
-                         nodes=None, edges=None)
+    resampled_node_array(neuron, graph=None, distance=40)
 
     Creates an array of cartesian coordinates that includes nodes of an input
-       Neuron, as well as coordinates interpolated between neighboring nodes.
-       This triples the length of the node array for added precision.
+       Neuron, as well as coordinates interpolated between neighboring nodes
+       so that no two neighboring points are more than distance apart.
 
     Input:
      - Neuron   (from Neuron class)
      - graph    (directed graph of Neuron generated by networkx)
      - distance (thickness of EM slices, 40nm in our case)
-     - start    (Node ID where the algorithm begins (default is the root node))
-     - nodes    (Array of nodes on which to run the algoritm
-                (default is all nodes of input neuron))
-     - edges    (TODO?)
 
     Output:
      - array of cartesian coordinates containing the nodes of the input Neuron,
@@ -139,61 +194,8 @@ def resampled_node_array(
     '''
     if graph is None:
         graph = neuron.dgraph
-    if start is None:
-        pred = graph.pred
-        start = [i for i in pred if len(pred[i]) == 0][0]
-    if nodes is None:
-        nodes = []
-    if edges is None:
-        edges = []
-    while start is not None:
-        if end is None:
-            succ = graph.succ
-            if len(succ[start]) == 0:
-                return nodes
-            elif len(succ[start]) > 1:
-                vs = succ[start].keys()
-                end = vs[0]
-                for other in vs[1:]:
-                    nodes = resampled_node_array(
-                        neuron, graph, distance, start, other, nodes, edges)
-            else:
-                end = succ[start].keys()[0]
-        sn = neuron.nodes[start]
-        en = neuron.nodes[end]
-        l = sum([(sn[k] - en[k]) ** 2. for k in ('x', 'y', 'z')]) ** 0.5
-        if l < distance:
-            nodes.append((sn['x'], sn['y'], sn['z']))
-            # TODO edges?
-            # new_graph.add_edge(start, end)
-        else:
-            # origin is sn
-            origin = (sn['x'], sn['y'], sn['z'])
-            # slope is en - sn
-            slope = (en['x'] - sn['x'], en['y'] - sn['y'], en['z'] - sn['z'])
-            scale = distance / float(l)
-            breaks = int(l / distance)
-            # print("Resampling %s into %s" % (l, breaks))
-            origin_id = start
-            for i in xrange(breaks):
-                # compute position of new point
-                new_point = (
-                    origin[0] + slope[0] * scale,
-                    origin[1] + slope[1] * scale,
-                    origin[2] + slope[2] * scale)
-
-                # add edge to graph
-                nodes.append(origin)
-                # TODO edges?
-
-                # reset for next loop
-                origin = new_point
-            # add edge to graph
-            nodes.append(origin)
-            # TODO edges?
-        start = end
-        end = None
-    return nodes
+    nodes, edges, _ = graph_arrays(neuron, graph)
+    return resample_tree(nodes, edges, distance)[0]
 
 
 def midpoint(neuron, v0, v1):
@@ -323,13 +325,36 @@ def center_of_mass(neuron):
     return com
 
 
+def _root_neurites(neu):
+    '''
+    Neurites of unique_neurites (for base = root) found in one walk down
+        the tree from the root
+    '''
+    dgraph = neu.dgraph
+    if neu.root is None or neu.root not in dgraph:
+        return []
+    neurites = []
+    # neurites start at the root and at every bifurcation
+    starts = [neu.root]
+    while len(starts):
+        start = starts.pop()
+        for child in dgraph.successors(start):
+            neurite = [start, child]
+            while dgraph.out_degree(neurite[-1]) == 1:
+                neurite.append(next(iter(dgraph.successors(neurite[-1]))))
+            if dgraph.out_degree(neurite[-1]) > 1:
+                starts.append(neurite[-1])
+            neurites.append(tuple(neurite))
+    return neurites
+
+
 def unique_neurites(neu, base=None):
     '''
     This function generates lists of unique neurites based off branching
         structure of neuron object
     '''
-    if base is None:
-        base = neu.root
+    if base is None or base == neu.root:
+        return _root_neurites(neu)
     neurites = []
     for bifurcation in neu.bifurcations:
         if bifurcation == base:
@@ -557,10 +582,11 @@ def find_nearby_points(
 
 def gaussian_smooth_points(
         pts, sigma=300., min_effect=1e-6, fix_axes=None):
+    """ gaussian smooth an array of points, the axes in fix_axes
+    ([2,] for z) keep their values
+    """
     if fix_axes is None:
         fix_axes = []
-    else:
-        fix_axes = [2, ]
     max_dist = numpy.sqrt(
         -numpy.log(min_effect) * 2 * sigma * sigma)
     npts = find_nearby_points(
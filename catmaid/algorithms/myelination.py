@@ -3,10 +3,43 @@
 import math
 import logging
 
-from . import morphology
+import numpy
 
 
-def find_myelination(neuron, axid, result):
+def parent_distances(neuron):
+    """Returns the distance of each node to its parent {nid: distance}"""
+    index = dict([(nid, i) for (i, nid) in enumerate(neuron.node_ids)])
+    dedges = neuron.dedges
+    children = [nid for nid in neuron.node_ids if nid in dedges]
+    if len(children) == 0:
+        return {}
+    c = neuron.node_coordinates
+    ci = numpy.array([index[nid] for nid in children])
+    pi = numpy.array([index[dedges[nid][0]] for nid in children])
+    d = numpy.sqrt(numpy.sum((c[ci] - c[pi]) ** 2., axis=1))
+    return dict(zip(children, d.tolist()))
+
+
+def trunk_path(neuron, axid, trunk):
+    """Returns the nodes from axid down to trunk, found by walking up
+    the tree from trunk"""
+    dedges = neuron.dedges
+    path = [trunk]
+    while path[-1] != axid:
+        if path[-1] not in dedges:
+            raise ValueError(
+                "Trunk {} is not below axon {}".format(trunk, axid))
+        path.append(dedges[path[-1]][0])
+    return path[::-1]
+
+
+def find_myelination(neuron, axid, result, distances=None):
+    """Find the pmas, trunk length (dist) and myelinated length of axon
+    axid and store them in result[axid]
+
+    distances (see parent_distances) can be provided to reuse them
+    for all axons of a neuron
+    """
     if axid not in neuron.axons:
         logging.critical("Invalid axon id %s"
                          " not in %s", axid, neuron.axons.keys())
@@ -15,17 +48,19 @@ def find_myelination(neuron, axid, result):
                                                   neuron.axons.keys()))
     axon = neuron.axons[axid]
     if 'trunk' not in axon:
+        # axon does not have a trunk
         logging.warn("Axon %s missing trunk", axid)
-        result = {}  # axon does not have a trunk
-    path = morphology.find_path(neuron, axid, axon['trunk'])
+        return
+    if distances is None:
+        distances = parent_distances(neuron)
+    path = trunk_path(neuron, axid, axon['trunk'])
     dist = 0.
     myelinated = 0.
     # state = 0  # 0: un-myelinated, 1: myelinated
     state = int(bool('myelinated' in neuron.nodes[path[0]]['labels']))
     pmas = float('nan')
-    p = path[0]
     for n in path[1:]:
-        d = morphology.distance(neuron, p, n)
+        d = distances[n]
         if state == 1:
             myelinated += d
         if 'myelinated' in neuron.nodes[n]['labels']:
@@ -44,7 +79,6 @@ def find_myelination(neuron, axid, result):
             state = 0
             logging.info("found unmyelinated %s", n)
         dist += d
-        p = n
     result[axid] = dict(pmas=pmas, dist=dist, myelinated=myelinated)
 
 
@@ -64,10 +98,11 @@ def myelination(neuron, axid):
     6) test if (5) is related to function.
     """
     result = {}
+    distances = parent_distances(neuron)
     if axid is None:
         axids = neuron.axons.keys()
         for axid in axids:
-            find_myelination(neuron, axid, result)
+            find_myelination(neuron, axid, result, distances)
     else:
-        find_myelination(neuron, axid, result)
+        find_myelination(neuron, axid, result, distances)
     return result
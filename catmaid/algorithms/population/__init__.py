@@ -2,10 +2,14 @@ from . import all_tags
 from . import cofasciculation
 from . import distance
 from . import graph_tools
+from . import myelination
 from . import network
+from . import network_analysis
+from . import node_index
 from . import synapses
 from . import unlabeled_leaves
 
 __all__ = [
-    'all_tags', 'cofasciculation', 'graph_tools', 'network', 'overlap',
-    'synapses', 'unlabeled_leaves']
+    'all_tags', 'cofasciculation', 'graph_tools', 'myelination', 'network',
+    'network_analysis', 'node_index', 'overlap', 'synapses',
+    'unlabeled_leaves']
@@ -30,6 +30,29 @@ import logging
 import itertools
 import numpy
 
+try:
+    import scipy.sparse
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
+from .. import batch
+from .. import spatial
+
+try:
+    xrange
+except NameError as E:
+    xrange = range
+
+# result of cofasciculation2 (angle) and cofasciculation (metric)
+# u1, v1: edge of neuron a, u2, v2: edge of neuron b
+cofasciculation2_dtype = [
+    ('u1', 'i8'), ('v1', 'i8'), ('u2', 'i8'), ('v2', 'i8'),
+    ('distance', 'f8'), ('angle', 'f8')]
+cofasciculation_dtype = [
+    ('u1', 'i8'), ('v1', 'i8'), ('u2', 'i8'), ('v2', 'i8'),
+    ('distance', 'f8'), ('metric', 'f8')]
+
 
 class EdgeError(Exception):
     pass
@@ -106,6 +129,55 @@ def dists(a):
     return numpy.sum(a ** 2., axis=1) ** 0.5
 
 
+def valid_edges(a, nron=None):
+    """
+    Remove 0 length edges from an edges_to_array array
+
+    Returns the remaining edges and their unit vectors (u - v)
+    """
+    n = a[:, 2:5] - a[:, 5:]
+    l = dists(n)
+    valid = l > 0.
+    if not numpy.all(valid):
+        logging.error("Skipping {} bad (0 length) edges on {}".format(
+            numpy.sum(~valid), nron))
+    return a[valid], n[valid] / l[valid][:, numpy.newaxis]
+
+
+def edge_pairs(a, b, distance_threshold):
+    """
+    Find all pairs of edges (rows of edges_to_array arrays a and b) that
+    are within distance_threshold of each other
+
+    Candidates are found with a KD-tree (see spatial.segment_candidates)
+    and the true minimum distance between the edge segments is computed
+    for each candidate.
+
+    Returns i, j (indices into a and b, sorted by i then j) and distances
+    """
+    ua, va, ub, vb = a[:, 2:5], a[:, 5:], b[:, 2:5], b[:, 5:]
+    if numpy.isinf(distance_threshold):
+        i, j = [x.ravel() for x in numpy.indices((len(a), len(b)))]
+    else:
+        i, j = spatial.segment_candidates(ua, va, ub, vb, distance_threshold)
+    d = spatial.segment_distances(ua[i], va[i], ub[j], vb[j])[0]
+    m = d <= distance_threshold
+    i, j, d = i[m], j[m], d[m]
+    order = numpy.lexsort((j, i))
+    return i[order], j[order], d[order]
+
+
+def _pairs_array(a, b, i, j, d, values, dtype):
+    r = numpy.empty(len(i), dtype=dtype)
+    r['u1'] = a[i, 0]
+    r['v1'] = a[i, 1]
+    r['u2'] = b[j, 0]
+    r['v2'] = b[j, 1]
+    r['distance'] = d
+    r[dtype[-1][0]] = values
+    return r
+
+
 def cofasciculation2(
         neuron_a, graph_a, neuron_b, graph_b,
         distance_threshold=1000., angle_threshold=90.,
@@ -116,6 +188,10 @@ def cofasciculation2(
         - calculate minimum distance between edge pairs, find < threshold pairs
         - repeat for angles
         - return remaining pairs and path length (each chain? sub-edge?)
+
+    Returns a structured array (see cofasciculation2_dtype) with one row
+    per pair of edges that are within distance_threshold of each other
+    and at an angle (in radians, [0, pi]) < angle_threshold (in degrees)
     """
     if distance_threshold is None:
         distance_threshold = float('inf')
@@ -123,80 +199,50 @@ def cofasciculation2(
         angle_threshold = 361.
     angle_threshold = numpy.radians(angle_threshold)
     # [nid_1, nid_2, x_1, y_1, z_1, x_2, y_2, z_2]
-    a = edges_to_array(neuron_a, graph_a)
-    b = edges_to_array(neuron_b, graph_b)
-    r = []
-    # find pairs for each a
-    for ai in a:
-        ua = ai[2:5]
-        va = ai[5:]
-        ubs = b[:, 2:5]
-        vbs = b[:, 5:]
-        na = ua - va
-        na /= numpy.linalg.norm(na)  # normalized vector
-        # minimum distance for all ds
-        min_dist = numpy.min(numpy.vstack((
-            dists(ua - ubs),
-            dists(va - ubs),
-            dists(ua - vbs),
-            dists(va - vbs),
-        )), axis=0)
-        # angles
-        bns = ubs - vbs
-        bns /= dists(bns)[:, numpy.newaxis]
-        for i in numpy.where(min_dist <= distance_threshold)[0]:
-            relative_angle = angle(na, bns[i])
-            # clamp angles to +- 90
-            #while relative_angle > (numpy.pi / 2.):
-            #    relative_angle -= numpy.pi
-            #while relative_angle < -(numpy.pi / 2.):
-            #    relative_angle += numpy.pi
-            if numpy.abs(relative_angle) < angle_threshold:
-                r.append((
-                    ai[0], ai[1], b[i][0], b[i][1],
-                    min_dist[i], relative_angle))
+    a, na = valid_edges(edges_to_array(neuron_a, graph_a), neuron_a)
+    b, nb = valid_edges(edges_to_array(neuron_b, graph_b), neuron_b)
+    i, j, d = edge_pairs(a, b, distance_threshold)
+    # dot product sometimes is slightly outside [-1, 1]
+    angles = numpy.arccos(numpy.clip(
+        numpy.einsum('ij,ij->i', na[i], nb[j]), -1., 1.))
+    m = angles < angle_threshold
     if return_pairs:
-        return r
+        return _pairs_array(
+            a, b, i[m], j[m], d[m], angles[m], cofasciculation2_dtype)
 
 
 def cofasciculation(
         neuron_a, graph_a, neuron_b, graph_b,
         distance=1000., s=1000., sig=10000.):
+    """
+    Cofasciculation metric (see cylinder_cofasciculation) for all
+    pairs of edges (of graph_a and graph_b) within distance of each other
+
+    Returns a structured array (see cofasciculation_dtype)
+    """
     if distance is None:
         distance = float('inf')
-    # build cylinders
-    for (nron, g) in ((neuron_a, graph_a), (neuron_b, graph_b)):
-        for u, v, d in g.edges_iter(data=True):
-            try:
-                uv = vertex_to_point(nron.skeleton['vertices'][u])
-                vv = vertex_to_point(nron.skeleton['vertices'][v])
-                d['u'] = uv
-                d['v'] = vv
-                d['r'], d['n'], d['l'] = edge_to_cylinder(uv, vv)
-                d['valid'] = True
-            except EdgeError as e:
-                logging.error("Bad edge: {} -> {} on {}, Error: {}".format(
-                    u, v, nron, e))
-                d['valid'] = False
-
-    # iterate over sk.dgraph.edges_iter
-    edges = []
-    #n = len(axon.edges()) * 0.01
-    #i = 0
-    for u1, v1, a in graph_a.edges_iter(data=True):
-        #i += 1
-        if not a['valid']:
-            continue
-        for u2, v2, b in graph_b.edges_iter(data=True):
-            if not d['valid']:
-                continue
-            dist = cylinder_minimum_distance(a, b)
-            if dist > distance:
-                continue
-            metric = cylinder_cofasciculation(a, b, sig=sig) * 2. * s
-            edges.append((u1, v1, u2, v2, dist, metric))
-
-    return edges
+    a, na = valid_edges(edges_to_array(neuron_a, graph_a), neuron_a)
+    b, nb = valid_edges(edges_to_array(neuron_b, graph_b), neuron_b)
+    i, j, d = edge_pairs(a, b, distance)
+    # cylinders (midpoints and lengths)
+    ra = (a[:, 2:5] + a[:, 5:]) / 2.
+    rb = (b[:, 2:5] + b[:, 5:]) / 2.
+    la = dists(a[:, 2:5] - a[:, 5:])
+    lb = dists(b[:, 2:5] - b[:, 5:])
+    # abs(cos(angle))
+    dp = numpy.abs(numpy.clip(
+        numpy.einsum('ij,ij->i', na[i], nb[j]), -1., 1.))
+    rdiff = ra[i] - rb[j]
+    metric = la[i] * lb[j] * dp * numpy.exp(
+        -numpy.einsum('ij,ij->i', rdiff, rdiff) / (4 * sig ** 2.)) / (
+            (4 * numpy.pi * sig ** 2) ** 1.5) * 2. * s
+    if numpy.any(numpy.isnan(metric)):
+        logging.critical("cofasciculation = nan, {}, {}".format(
+            neuron_a, neuron_b))
+        raise Exception("cofasciculation = nan, {}, {}".format(
+            neuron_a, neuron_b))
+    return _pairs_array(a, b, i, j, d, metric, cofasciculation_dtype)
 
 
 def test():
@@ -302,3 +348,109 @@ def overlap_list(source, skList):
         except Exception as e:
             overlap_dict[(sk_d, sk_a)] = ov_b
     return overlap_dict
+
+
+def _dgraph(n):
+    return n.dgraph
+
+
+def population_edges(source, sk_list, graph=None):
+    """
+    Loads each skeleton in sk_list once and concatenates the (valid) edges
+    of graph(neuron) (default neuron.dgraph) of all of them
+
+    Returns edges (see edges_to_array), unit vectors and the index (in
+    sk_list) of the skeleton each edge came from
+    """
+    if graph is None:
+        graph = _dgraph
+    edges = [numpy.empty((0, 8))]
+    units = [numpy.empty((0, 3))]
+    owners = [numpy.empty(0, dtype='i8')]
+    for (index, sk) in enumerate(sk_list):
+        nron = source.get_neuron(sk)
+        a, n = valid_edges(edges_to_array(nron, graph(nron)), nron)
+        edges.append(a)
+        units.append(n)
+        owners.append(numpy.ones(len(a), dtype='i8') * index)
+    return numpy.vstack(edges), numpy.vstack(units), numpy.hstack(owners)
+
+
+def _bundle_chunk(ids):
+    """Co-running length of edges ids with all edges of other skeletons"""
+    st = batch.state()
+    edges, units, owners = st['edges'], st['units'], st['owners']
+    n = st['n']
+    starts, ends = edges[:, 2:5], edges[:, 5:]
+    i, j = spatial.segment_candidates(
+        starts[ids], ends[ids], starts, ends, st['distance'],
+        b_index=st['index'])
+    i = ids[i]
+    # only pairs of edges on different skeletons
+    m = owners[i] != owners[j]
+    i, j = i[m], j[m]
+    # the direction of edges is arbitrary, so use abs(cos(angle))
+    m = numpy.abs(numpy.einsum(
+        'ij,ij->i', units[i], units[j])) >= st['min_cos']
+    i, j = i[m], j[m]
+    # part of edge i within distance of edge j
+    lo, hi = spatial.capsule_intervals(
+        starts[i], ends[i], starts[j], ends[j], st['distance'])
+    # merge the parts of each edge near any edge of the other skeleton
+    key, lo, hi = spatial.merge_intervals(i * n + owners[j], lo, hi)
+    i = key // n
+    length = (hi - lo) * dists(ends[i] - starts[i])
+    return scipy.sparse.coo_matrix(
+        (length, (owners[i], key % n)), shape=(n, n)).tocsr()
+
+
+def bundle_matrix(
+        source, sk_list=None, distance_threshold=1000., angle_threshold=30.,
+        graph=None, processes=None, chunk_size=50000):
+    """
+    Finds cofasciculating (bundled) skeletons in a population
+
+    The edges of all skeletons are indexed once (spatial.segment_index)
+    and all pairs of edges from different skeletons that are within
+    distance_threshold and angle_threshold (in degrees, the direction of
+    edges is ignored) are found in one sweep. Edges are swept in spatially
+    sorted chunks of chunk_size edges that are run in processes worker
+    processes (in this process if processes is None).
+
+    graph is a function that returns the graph to use for a neuron
+    (default neuron.dgraph)
+
+    Returns a scipy.sparse.csr_matrix m where m[a, b] is the path length
+    of sk_list[a] that runs along sk_list[b]
+    """
+    if not has_scipy:
+        raise ImportError("bundle_matrix requires scipy")
+    if sk_list is None:
+        sk_list = source.skeleton_ids()
+    sk_list = list(sk_list)
+    n = len(sk_list)
+    if angle_threshold is None or angle_threshold >= 90.:
+        min_cos = 0.
+    else:
+        min_cos = numpy.cos(numpy.radians(angle_threshold))
+    edges, units, owners = population_edges(source, sk_list, graph)
+    total = scipy.sparse.csr_matrix((n, n))
+    if len(edges) == 0:
+        return total
+    starts, ends = edges[:, 2:5], edges[:, 5:]
+    # sweep edges in spatially sorted chunks
+    mid = (starts + ends) / 2.
+    cells = numpy.floor(
+        (mid - mid.min(axis=0)) / max(distance_threshold, 1.)).astype('i8')
+    order = numpy.lexsort(cells.T[::-1])
+    chunks = [
+        order[start:start + chunk_size]
+        for start in xrange(0, len(order), chunk_size)]
+
+    state = {
+        'edges': edges, 'units': units, 'owners': owners, 'n': n,
+        'distance': distance_threshold, 'min_cos': min_cos,
+        'index': spatial.segment_index(starts, ends)}
+    for m in batch.map_items(_bundle_chunk, chunks, state, processes):
+        total = total + m
+    return total.tocsr()
@@ -1,152 +1,385 @@
 #!/usr/bin/env python
 
+import collections
+import logging
+
 try:
     import numpy
     has_numpy = True
 except ImportError:
     has_numpy = False
 
+try:
+    from scipy.spatial import cKDTree
+    has_scipy = has_numpy
+except ImportError:
+    has_scipy = False
+
 from .. import morphology
+from .. import spatial
+
+
+def node_tree(neuron, graph=None, resample_distance=None):
+    """
+    Returns a spatial index (scipy.spatial.cKDTree) of the nodes of graph
+    resampled to resample_distance
+
+    Build this once per neuron and pass it as tree2 to near_path_length
+    or near_path_length_md to avoid rebuilding it for every pair.
+
+    if graph is not supplied, it defaults to the first axon of the neuron
+    """
+    if not has_scipy:
+        raise ImportError("node_tree requires numpy and scipy")
+    if graph is None:
+        graph = neuron.axons.values()[0]['tree']
+    if resample_distance is None:
+        resample_distance = numpy.inf
+    return cKDTree(
+        morphology.resampled_node_array(neuron, graph, resample_distance))
+
+
+def resampled_segments(neuron, graph, resample_distance):
+    """
+    Returns the points of graph resampled to resample_distance and the
+    (start, end) point indices of each resampled segment
+    """
+    if resample_distance is None:
+        resample_distance = numpy.inf
+    nodes, edges, _ = morphology.graph_arrays(neuron, graph)
+    points, segments, _ = morphology.resample_tree(
+        nodes, edges, resample_distance)
+    return points, segments
+
+
+def segment_tree(neuron, graph=None, resample_distance=None):
+    """
+    Returns the points and segments of graph resampled to
+    resample_distance (see resampled_segments) and a spatial index of the
+    segments (see spatial.segment_index)
+
+    Build this once per neuron and pass it as segments2 to
+    near_path_length or near_path_length_md (exact mode) to avoid
+    rebuilding the index for every pair.
+
+    if graph is not supplied, it defaults to the first axon of the neuron
+    """
+    if not has_scipy:
+        raise ImportError("segment_tree requires numpy and scipy")
+    if graph is None:
+        graph = neuron.axons.values()[0]['tree']
+    points, segments = resampled_segments(neuron, graph, resample_distance)
+    index = spatial.segment_index(
+        points[segments[:, 0]], points[segments[:, 1]])
+    return points, segments, index
+
+
+def _nearest_distances(tree, points, max_distance):
+    """Distance from each point to the nearest point in tree,
+    inf if no point is within max_distance"""
+    if tree.n == 0:
+        return numpy.ones(len(points)) * numpy.inf
+    return tree.query(points, k=1, distance_upper_bound=max_distance)[0]
+
+
+def _exact_near_path_length(segments1, segments2, distances):
+    """
+    Exact portions of segments1 within each distance of segments2
+
+    Candidate segment pairs are found with spatial.segment_candidates, then
+    the part of each segment in segments1 that lies within the capsule
+    around each candidate segment in segments2 is computed analytically.
+    segments2 can include a segment index (see segment_tree).
+    """
+    points1, segs1 = segments1
+    points2, segs2 = segments2[:2]
+    index2 = segments2[2] if len(segments2) > 2 else None
+    p0, p1 = points1[segs1[:, 0]], points1[segs1[:, 1]]
+    q0, q1 = points2[segs2[:, 0]], points2[segs2[:, 1]]
+    lengths = numpy.sqrt(numpy.sum((p1 - p0) ** 2., axis=1))
+    ci, cj = spatial.segment_candidates(
+        p0, p1, q0, q1, max(distances), b_index=index2)
+    pdi = {}
+    for d in distances:
+        lo, hi = spatial.capsule_intervals(
+            p0[ci], p1[ci], q0[cj], q1[cj], d)
+        ids, lo, hi = spatial.merge_intervals(ci, lo, hi)
+        v = p1[ids] - p0[ids]
+        pdi[d] = {
+            'l': float(((hi - lo) * lengths[ids]).sum()),
+            'segs': numpy.hstack((
+                p0[ids] + v * lo[:, numpy.newaxis],
+                p0[ids] + v * hi[:, numpy.newaxis])),
+            'dt': d * d,
+            'skip': False,
+        }
+    return pdi
 
 
 def near_path_length_md(
         n1, n2, g1=None, g2=None, distances=None, resample_distance=None,
-        segments=False):
+        segments=False, tree2=None, segments1=None, exact=False,
+        segments2=None):
     """
     Returns the total pathlength of g1 that is < distance from the closest
-    node in g2
+    node in g2 for each distance in distances
 
     The distance is only calculated between nodes (not edges) so long edges
     can introduce errors. In this case, use a reasonable resample_distance.
+    If exact is True, distances are instead calculated between edges and
+    the pathlength of g1 that is <= distance from any edge in g2 is
+    computed exactly, so no resampling is needed.
 
     if g1 and g2 (the graphs of n1 and n2) are not supplied, they will
     default to the dendrites of g1 and the first axon for g2
+
+    tree2 (see node_tree) and segments1 (see resampled_segments) can be
+    supplied to reuse the spatial index of n2 and resampled edges of n1.
+    For exact mode, supply segments2 (see segment_tree) instead of
+    tree2. All distances are answered from a single query.
     """
-    if not has_numpy:
-        raise ImportError("path_length requires numpy")
-    if g1 is None:
-        g1 = n1.dendrites
-    if g2 is None:
-        g2 = n2.axons.values()[0]['tree']
+    if not has_scipy:
+        raise ImportError("path_length requires numpy and scipy")
     if distances is None:
         distances = [1000., 5000.]
-    if resample_distance is None:
-        resample_distance = numpy.inf
-    e1 = morphology.resampled_edge_array(n1, g1, resample_distance)
-    #e2 = morphology.resampled_edge_array(n2, g2, resample_distance)
-    nodes2 = numpy.array(
-        morphology.resampled_node_array(n2, g2, resample_distance))
-    # for each edge in e1
+    if segments1 is None:
+        if g1 is None:
+            g1 = n1.dendrites
+        segments1 = resampled_segments(n1, g1, resample_distance)
+    if exact:
+        if segments2 is None:
+            if g2 is None:
+                g2 = n2.axons.values()[0]['tree']
+            segments2 = resampled_segments(n2, g2, resample_distance)
+        return _exact_near_path_length(segments1, segments2, distances)
+    if tree2 is None:
+        tree2 = node_tree(n2, g2, resample_distance)
+    points, segs = segments1
+    mds = _nearest_distances(tree2, points, max(distances))
+    s, e = points[segs[:, 0]], points[segs[:, 1]]
+    lengths = numpy.sqrt(numpy.sum((e - s) ** 2., axis=1))
+    edges = numpy.hstack((s, e))
     pdi = {}
-    mds = {}
     for d in distances:
+        near = mds < d
+        m = near[segs[:, 0]] & near[segs[:, 1]]
         pdi[d] = {
-            'l': 0.,
-            'segs': [],
+            'l': float(lengths[m].sum()),
+            'segs': edges[m],
             'dt': d * d,
             'skip': False,
         }
-    for edge in e1:
-        s, e = edge[:3], edge[3:]
-        st = tuple(s)
-        if st not in mds:
-            mds[st] = numpy.sum(numpy.square(s - nodes2), axis=1).min()
-        et = tuple(e)
-        if et not in mds:
-            mds[et] = numpy.sum(numpy.square(e - nodes2), axis=1).min()
-        for d in pdi:
-            if mds[st] < pdi[d]['dt'] and mds[et] < pdi[d]['dt']:
-                pdi[d]['l'] += numpy.linalg.norm(e - s)
-                pdi[d]['segs'].append(edge)
     return pdi
 
 
 def near_path_length(
         n1, n2, g1=None, g2=None, distance=1000., resample_distance=None,
-        segments=False):
+        segments=False, tree2=None, segments1=None, exact=False,
+        segments2=None):
     """
     Returns the total pathlength of g1 that is < distance from the closest
     node in g2
 
     The distance is only calculated between nodes (not edges) so long edges
     can introduce errors. In this case, use a reasonable resample_distance.
+    If exact is True, distances are instead calculated between edges and
+    the pathlength of g1 that is <= distance from any edge in g2 is
+    computed exactly, so no resampling is needed.
 
     if g1 and g2 (the graphs of n1 and n2) are not supplied, they will
     default to the dendrites of g1 and the first axon for g2
+
+    tree2 (see node_tree) and segments1 (see resampled_segments) can be
+    supplied to reuse the spatial index of n2 and resampled edges of n1.
+    For exact mode, supply segments2 (see segment_tree) instead of
+    tree2.
+    """
+    r = near_path_length_md(
+        n1, n2, g1, g2, [distance, ], resample_distance,
+        tree2=tree2, segments1=segments1, exact=exact,
+        segments2=segments2)[distance]
+    if segments:
+        return r['l'], r['segs']
+    return r['l']
+
+
+def _touch(cache, key, max_cached):
+    """Mark key as most recently used and drop the least recently used
+    entries beyond max_cached"""
+    cache[key] = cache.pop(key)
+    while max_cached is not None and len(cache) > max_cached:
+        cache.popitem(last=False)
+
+
+def _dendrites(n):
+    return n.dendrites
+
+
+def _first_axon_tree(n):
+    return n.axons.values()[0]['tree']
+
+
+def near_path_lengths(
+        source, pairs, g1=None, g2=None, distance=1000.,
+        resample_distance=None, exact=False, max_cached=None):
+    """
+    Computes near_path_length for many (skeleton_id_1, skeleton_id_2) pairs
+
+    Each neuron is loaded, resampled and indexed at most once and the result
+    is reused for all pairs that neuron takes part in. All neurons are kept
+    unless max_cached is set, then only the max_cached most recently used
+    neurons on each side of the pairs are kept (others are rebuilt if they
+    are needed again). To bound memory for many pairs, set max_cached and
+    order pairs by neuron or split them into chunks.
+
+    g1 and g2 are functions that return a graph for a neuron,
+    default to the dendrites for the first neuron and the first axon
+    for the second neuron of each pair.
+
+    Returns a list of path lengths (in the order of pairs), failed pairs
+    return the raised exception
     """
-    if not has_numpy:
-        raise ImportError("path_length requires numpy")
     if g1 is None:
-        g1 = n1.dendrites
+        g1 = _dendrites
     if g2 is None:
-        g2 = n2.axons.values()[0]['tree']
-    if resample_distance is None:
-        resample_distance = numpy.inf
-    e1 = morphology.resampled_edge_array(n1, g1, resample_distance)
-    #e2 = morphology.resampled_edge_array(n2, g2, resample_distance)
-    nodes2 = numpy.array(
-        morphology.resampled_node_array(n2, g2, resample_distance))
-    # for each edge in e1
-    l = 0.
-    segs = []
-    pns = {}
-    sd = distance * distance
-    for edge in e1:
-        s, e = edge[:3], edge[3:]
-        st = tuple(s)
-        if st not in pns:
-            pns[st] = numpy.sum(numpy.square(s - nodes2), axis=1).min() < sd
-        if not pns[st]:
-            continue
-        et = tuple(e)
-        if et not in pns:
-            pns[et] = numpy.sum(numpy.square(e - nodes2), axis=1).min() < sd
-        if not pns[et]:
-            continue
-        l += numpy.linalg.norm(e - s)
-        segs.append(edge)
-    if segments:
-        return l, numpy.array(segs)
-    return l
+        g2 = _first_axon_tree
+    segments = collections.OrderedDict()
+    indices = collections.OrderedDict()
+    results = []
+    for (sk1, sk2) in pairs:
+        try:
+            if sk1 not in segments:
+                n = source.get_neuron(sk1)
+                segments[sk1] = resampled_segments(
+                    n, g1(n), resample_distance)
+            if sk2 not in indices:
+                n = source.get_neuron(sk2)
+                if exact:
+                    indices[sk2] = segment_tree(n, g2(n), resample_distance)
+                else:
+                    indices[sk2] = node_tree(n, g2(n), resample_distance)
+            _touch(segments, sk1, max_cached)
+            _touch(indices, sk2, max_cached)
+            if exact:
+                r = near_path_length(
+                    None, None, distance=distance, segments1=segments[sk1],
+                    exact=True, segments2=indices[sk2])
+            else:
+                r = near_path_length(
+                    None, None, distance=distance, segments1=segments[sk1],
+                    tree2=indices[sk2])
+            results.append(r)
+        except Exception as e:
+            logging.error(
+                "near_path_length failed for {}, {}: {}".format(sk1, sk2, e))
+            results.append(e)
+    return results
+
+
+def hausdorff_summary(tree1, tree2, percentiles=None):
+    """
+    Computes directed, reverse and symmetric hausdorff distances between
+    the points of two spatial indices (see node_tree) in one pass
+
+    directed = max[across a](min[across b](d(a, b))
+    reverse = max[across b](min[across a](d(a, b))
+    symmetric = max(directed, reverse)
 
+    For each percentile p in percentiles (e.g. 95), the same values are
+    computed using the pth percentile instead of the max and stored as
+    directed_p95, reverse_p95 and symmetric_p95.
 
-def hausdorff(n1, n2, g1=None, g2=None, resample_distance=None):
+    Returns a dictionary of all values
+    """
+    if percentiles is None:
+        percentiles = []
+    d12 = tree2.query(tree1.data, k=1)[0]
+    d21 = tree1.query(tree2.data, k=1)[0]
+    r = {
+        'directed': d12.max(),
+        'reverse': d21.max(),
+    }
+    r['symmetric'] = max(r['directed'], r['reverse'])
+    for p in percentiles:
+        k = '_p{}'.format(p)
+        r['directed' + k] = numpy.percentile(d12, p)
+        r['reverse' + k] = numpy.percentile(d21, p)
+        r['symmetric' + k] = max(r['directed' + k], r['reverse' + k])
+    return r
+
+
+def hausdorff(n1, n2, g1=None, g2=None, resample_distance=None,
+              symmetric=False, percentile=None):
     """
     The maximum of the minimum distances between a node
     in n1 and any node in n2
 
     max[across a](min[across b](d(a, b))
+
+    if symmetric is True, return the max of this and the reverse distance
+    (from n2 to n1). if percentile is provided (e.g. 95), use that
+    percentile of the minimum distances instead of the maximum.
     """
-    if not has_numpy:
-        raise ImportError("hasdorff distance requires numpy")
+    if not has_scipy:
+        raise ImportError("hasdorff distance requires numpy and scipy")
     if g1 is None:
         g1 = n1.axons.values()[0]['tree']
     if g2 is None:
         g2 = n2.dendrites
-
-    if resample_distance is not None:
-        n1s = numpy.array(
+    tree2 = node_tree(n2, g2, resample_distance)
+    if not symmetric:
+        # only the directed distance is needed
+        d = tree2.query(
             morphology.resampled_node_array(
-                n1, g1, resample_distance))
-        n2s = numpy.array(
-            morphology.resampled_node_array(
-                n2, g2, resample_distance))
-    else:
-        n1s = morphology.node_array(n1, g1.nodes())
-        n2s = morphology.node_array(n2, g2.nodes())
-    #n1s = []
-    #for nid in g1.nodes():
-    #    n = n1.nodes[nid]
-    #    n1s.append((n['x'], n['y'], n['z']))
-    #n1s = numpy.array(n1s)
-    #n2s = []
-    #for nid in g2.nodes():
-    #    n = n2.nodes[nid]
-    #    n2s.append((n['x'], n['y'], n['z']))
-    #n2s = numpy.array(n2s)
-    v = -numpy.inf
-    for n in n1s:
-        v = max(
-            v,
-            numpy.min(numpy.sum((n2s - n) ** 2., 1)) ** 0.5)
-    return v
+                n1, g1, numpy.inf if resample_distance is None
+                else resample_distance), k=1)[0]
+        if percentile is None:
+            return d.max()
+        return numpy.percentile(d, percentile)
+    tree1 = node_tree(n1, g1, resample_distance)
+    if percentile is None:
+        return hausdorff_summary(tree1, tree2)['symmetric']
+    return hausdorff_summary(
+        tree1, tree2, [percentile, ])['symmetric_p{}'.format(percentile)]
+
+
+def hausdorff_pairs(
+        source, pairs, g1=None, g2=None, resample_distance=None,
+        percentiles=None, trees1=None, trees2=None):
+    """
+    Computes hausdorff_summary for many (skeleton_id_1, skeleton_id_2) pairs
+
+    g1 and g2 are functions that return a graph for a neuron,
+    default to the first axon for the first neuron and the dendrites
+    for the second neuron of each pair.
+
+    Spatial indices are built at most once per neuron and stored in the
+    trees1 and trees2 dictionaries (keyed by skeleton id). Pass in the
+    same dictionaries to share prebuilt trees across calls (e.g. when
+    splitting an all-vs-all comparison into chunks).
+
+    Returns a list of summaries (in the order of pairs), failed pairs
+    return the raised exception
+    """
+    if g1 is None:
+        g1 = _first_axon_tree
+    if g2 is None:
+        g2 = _dendrites
+    if trees1 is None:
+        trees1 = {}
+    if trees2 is None:
+        trees2 = {}
+    results = []
+    for (sk1, sk2) in pairs:
+        try:
+            for (sk, g, trees) in ((sk1, g1, trees1), (sk2, g2, trees2)):
+                if sk not in trees:
+                    n = source.get_neuron(sk)
+                    trees[sk] = node_tree(n, g(n), resample_distance)
+            results.append(
+                hausdorff_summary(trees1[sk1], trees2[sk2], percentiles))
+        except Exception as e:
+            logging.error(
+                "hausdorff failed for {}, {}: {}".format(sk1, sk2, e))
+            results.append(e)
+    return results
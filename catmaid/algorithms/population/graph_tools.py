@@ -1,52 +1,133 @@
 import networkx
+
+try:
+    import numpy
+    import scipy.sparse
+    has_scipy = True
+except ImportError:
+    has_scipy = False
 '''
 graph_tools meant to act as a medium between matlab, gephi and networkx.
 inprogress
 TODO:
-    add DiGraph implementation
-    catch self loops
     add file converters to matlab/gephi
 '''
 
 
+def connector_table(source, sk_list=None):
+    """
+    Collects the synapse links of all skeletons in sk_list
+
+    Returns rows, columns, pre, index and connector ids where each link of
+    a skeleton to a connector has:
+        rows: index of the skeleton (in sk_list)
+        columns: index of the connector (in connector ids)
+        pre: True for presynaptic_to links, False for postsynaptic_to
+    and index maps skeleton ids to rows
+    """
+    if sk_list is None:
+        sk_list = source.skeleton_ids()
+    index = dict([(sk, i) for (i, sk) in enumerate(sk_list)])
+    connector_index = {}
+    rows = []
+    columns = []
+    pre = []
+    for sk in sk_list:
+        table = source.get_neuron(sk).synapse_table
+        p = table['type'] == 'presynaptic_to'
+        unknown = ~p & (table['type'] != 'postsynaptic_to')
+        if numpy.any(unknown):
+            raise ValueError(
+                "Unknown connector type {} for {} in {}".format(
+                    table['type'][unknown][0],
+                    table['connector'][unknown][0], sk))
+        rows.append(numpy.ones(len(table), dtype='i8') * index[sk])
+        columns.append(numpy.array([
+            connector_index.setdefault(cid, len(connector_index))
+            for cid in table['connector'].tolist()], dtype='i8'))
+        pre.append(p)
+    connector_ids = [None] * len(connector_index)
+    for (cid, column) in connector_index.items():
+        connector_ids[column] = cid
+    if len(rows) == 0:
+        return (
+            numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8'),
+            numpy.zeros(0, dtype=bool), index, connector_ids)
+    return (
+        numpy.hstack(rows), numpy.hstack(columns), numpy.hstack(pre),
+        index, connector_ids)
+
+
+def get_sparse_graph(source, sk_list=None):
+    """
+    Builds weighted adjacency matrices (scipy.sparse.csr_matrix) of the
+    skeletons in sk_list from their synapse_table
+
+    Returns directed, undirected, index where:
+        directed[i, j]: number of (pre, post) synapse links from skeleton
+            i to skeleton j through the same connector
+        undirected[i, j]: number of connectors shared by skeleton i and j
+            (i != j), regardless of the link types
+        index: maps skeleton ids to rows (and columns)
+    """
+    if not has_scipy:
+        raise ImportError("get_sparse_graph requires numpy and scipy")
+    rows, columns, pre, index, connector_ids = connector_table(
+        source, sk_list)
+    shape = (len(index), len(connector_ids))
+    ones = numpy.ones(len(rows), dtype='i8')
+    # skeleton x connector incidence
+    presynaptic = scipy.sparse.csr_matrix(
+        (ones[pre], (rows[pre], columns[pre])), shape=shape)
+    postsynaptic = scipy.sparse.csr_matrix(
+        (ones[~pre], (rows[~pre], columns[~pre])), shape=shape)
+    directed = (presynaptic * postsynaptic.T).tocsr()
+    linked = scipy.sparse.csr_matrix((ones, (rows, columns)), shape=shape)
+    # count each skeleton once per connector
+    linked.data[:] = 1
+    undirected = (linked * linked.T).tolil()
+    undirected.setdiag(0)
+    undirected = undirected.tocsr()
+    undirected.eliminate_zeros()
+    return directed, undirected, index
+
+
 def get_graph(source, sk_list=None, directed=False):
+    """
+    Returns a networkx graph (a DiGraph if directed) of the skeletons in
+    sk_list with edges weighted by the number of connections, see
+    get_sparse_graph
+    """
     if sk_list is None:
         sk_list = source.skeleton_ids()
-    nr_list = source.get_neuron(sk_list)
+    sk_list = list(sk_list)
+    d, u, index = get_sparse_graph(source, sk_list)
     if directed:
         G = networkx.DiGraph()
-        # TODO Add DiGraph Implementation
+        m = d.tocoo()
     else:
         G = networkx.Graph()
-        G.add_nodes_from(sk_list, bipartite=0)
-        for nr in nr_list:
-            G.add_nodes_from(nr.connectors.keys(), bipartite=1)
-            for con in nr.connectors:
-                G.add_edge(nr.sid, con, weight=1)
-    proj_multi = networkx.projected_graph(G, set(sk_list), multigraph=True)
-    G2 = networkx.Graph()
-    unique_edges = set(proj_multi.edges())
-    for u, v in unique_edges:
-        w = proj_multi.edges().count((u, v))
-        G2.add_edge(u, v, weight=w)
-    return G2
-
-
-def get_adj_mat(source, sk_list=None, directed=False):
-    # TODO : self loops
+        m = scipy.sparse.triu(u).tocoo()
+    G.add_nodes_from(sk_list)
+    G.add_weighted_edges_from(
+        (sk_list[i], sk_list[j], int(w))
+        for (i, j, w) in zip(m.row, m.col, m.data))
+    return G
+
+
+def get_adj_mat(source, sk_list=None, directed=False, dense=False):
+    """
+    Returns an adjacency matrix (a scipy.sparse.csr_matrix or, if dense is
+    True, a numpy array) and the skeleton list that defines the
+    rows/columns, see get_sparse_graph
+    """
     if sk_list is None:
         sk_list = source.skeleton_ids()
-    graph = get_graph(source, sk_list, directed)
-    n = len(sk_list)
-    adj_mat = []
-    for i in xrange(n):
-        adj_mat.append([0] * n)
-    for pair in graph.adjacency_iter():
-        ind_a = sk_list.index(pair[0])
-        for val in pair[1].keys():
-            ind_b = sk_list.index(val)
-            if ind_b in adj_mat[ind_a]:
-                adj_mat[ind_a][ind_b] += pair[1][val]['weight']
-            else:
-                adj_mat[ind_a][ind_b] = pair[1][val]['weight']
-    return adj_mat, sk_list
+    d, u, index = get_sparse_graph(source, sk_list)
+    if directed:
+        m = d
+    else:
+        m = u
+    if dense:
+        m = m.toarray()
+    return m, sk_list
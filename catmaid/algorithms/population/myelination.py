@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Myelination (see algorithms.myelination) of all axons of a source
+
+The results are collected in one table (a numpy structured array with
+myelination_dtype) with a row per axon that can be saved as csv or npz.
+"""
+
+import csv
+import logging
+
+import numpy
+
+from .. import batch
+from .. import myelination
+
+
+# one row per axon (with a trunk)
+myelination_dtype = [
+    ('skeleton', 'i8'), ('axon', 'i8'), ('trunk', 'i8'), ('pmas', 'f8'),
+    ('myelinated', 'f8'), ('length', 'f8'), ('coverage', 'f8')]
+
+
+def neuron_myelination(neuron):
+    """Returns the myelination rows of all axons of neuron"""
+    sid = int(neuron.skeleton_id)
+    distances = myelination.parent_distances(neuron)
+    result = {}
+    rows = []
+    for axid in neuron.axons:
+        myelination.find_myelination(neuron, axid, result, distances)
+        if axid not in result:
+            continue
+        r = result[axid]
+        if r['dist'] > 0.:
+            coverage = r['myelinated'] / r['dist']
+        else:
+            coverage = float('nan')
+        rows.append((
+            sid, int(axid), int(neuron.axons[axid]['trunk']), r['pmas'],
+            r['myelinated'], r['dist'], coverage))
+    return rows
+
+
+def _skeleton_myelination(sid):
+    try:
+        return sid, neuron_myelination(batch.state()['source'].get_neuron(sid))
+    except Exception as E:
+        logging.error("Failed to find myelination of {}: {!r}".format(
+            sid, E))
+        return sid, None
+
+
+def myelination_table(source, sk_list=None, processes=None):
+    """
+    Find the myelination of all axons of skeletons in sk_list (all in
+    source if None)
+
+    Skeleton ids are sent to processes worker processes (run in this
+    process if processes is None) that load their neurons from source.
+    Skeletons that fail (for example with 2 axon trunks) are logged and
+    skipped.
+
+    Returns a myelination_dtype array sorted by skeleton and axon
+    """
+    if sk_list is None:
+        sk_list = source.skeleton_ids()
+    rows = []
+    for (sid, r) in batch.map_items(
+            _skeleton_myelination, sk_list, {'source': source}, processes):
+        if r is not None:
+            rows.extend(r)
+    table = numpy.array(rows, dtype=myelination_dtype)
+    return table[numpy.lexsort((table['axon'], table['skeleton']))]
+
+
+def save_table(table, fn):
+    """Save a table (structured array) as npz (if fn ends with .npz,
+    one array per column) or csv"""
+    if fn.endswith('.npz'):
+        numpy.savez(fn, **dict([
+            (name, table[name]) for name in table.dtype.names]))
+        return
+    with open(fn, 'w') as f:
+        w = csv.writer(f)
+        w.writerow(table.dtype.names)
+        for row in table.tolist():
+            w.writerow(row)
+
+
+def load_table(fn, dtype=myelination_dtype):
+    """Load a table saved with save_table"""
+    if fn.endswith('.npz'):
+        columns = numpy.load(fn)
+        table = numpy.empty(len(columns[dtype[0][0]]), dtype=dtype)
+        for (name, _) in dtype:
+            table[name] = columns[name]
+        return table
+    with open(fn, 'r') as f:
+        r = csv.reader(f)
+        names = next(r)
+        rows = [tuple(row) for row in r]
+    table = numpy.empty(len(rows), dtype=dtype)
+    for (i, name) in enumerate(names):
+        table[name] = [row[i] for row in rows]
+    return table
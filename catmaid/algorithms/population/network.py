@@ -1,4 +1,15 @@
 #!/usr/bin/env python
+import numpy
+
+try:
+    long
+except NameError as E:
+    long = int
+
+try:
+    unicode
+except NameError as E:
+    unicode = str
 
 
 def add_neuron_to_conns(n, conns=None):
@@ -32,37 +43,254 @@ def add_neuron_to_conns(n, conns=None):
 
 def find_conns(neuron_iter):
     # used by rendering script
-    conns = {}
+    index = ConnectorIndex()
     for n in neuron_iter:
-        conns = add_neuron_to_conns(n, conns)
-    return conns
+        index.add_neuron(n, compact=False)
+    return index.to_conns()
 
 
 def find_synapses(*neurons):
     syns = {}
-    for (i, n) in enumerate(neurons):
+    for n in neurons:
         for c in n.synapse_info:
-            if c in syns:  # already found this one
-                continue
-            nc = n.synapse_info[c]
-            syns[c] = {
-                'connector': nc['connector'].copy(),
-                'connector_id': nc['connector_id'],
-                'skeletons': {
-                    n.skeleton_id: {
-                        'type': nc['type'],
-                        'vertex': nc['vertex'].copy(),
-                        'vertex_id': nc['vertex_id'],
-                    }
+            # use the first link of each neuron to the connector
+            nc = n.synapse_info[c][0]
+            if c not in syns:
+                syns[c] = {
+                    'connector': nc['connector'].copy(),
+                    'connector_id': nc['connector_id'],
+                    'skeletons': {},
+                }
+            if n.skeleton_id not in syns[c]['skeletons']:
+                syns[c]['skeletons'][n.skeleton_id] = {
+                    'type': nc['type'],
+                    'vertex': nc['vertex'].copy(),
+                    'vertex_id': nc['vertex_id'],
                 }
-            }
-            for n2 in neurons[i+1:]:
-                if c in n2.synapse_info:
-                    # n2 is connected to c (and therefore n)
-                    n2c = n2.synapse_info[c]
-                    syns[c]['skeletons'][n2.skeleton_id] = {
-                        'type': n2c['type'],
-                        'vertex': n2c['vertex'].copy(),
-                        'vertex_id': n2c['vertex_id'],
-                    }
     return syns
+
+
+class ConnectorIndex(object):
+    """
+    Index of the connectors of many skeletons stored as compact arrays
+
+    connector_ids: sorted connector ids
+    locations: connector locations (in the order of connector_ids)
+    links: one row per synapse link (see link_dtype) sorted by connector
+    skeleton_ids: sorted ids of the skeletons that were indexed
+
+    Skeletons can be added (or re-added, which replaces their links and
+    updates their connector locations) with add_neuron or add_source and
+    removed with remove_skeleton. The index can be saved to (and loaded
+    from) a .npz file.
+
+    Ids are stored as ints, the types of the connector (vertex key) and
+    skeleton ids of the added neurons are kept so to_conns returns the
+    same keys as synapse_info (and neuron_to_tree).
+    """
+    link_dtype = [
+        ('connector', 'i8'), ('skeleton', 'i8'), ('node', 'i8'),
+        ('pre', '?')]
+
+    def __init__(self):
+        self.connector_ids = numpy.zeros(0, dtype='i8')
+        self.locations = numpy.zeros((0, 3), dtype='f8')
+        self.links = numpy.zeros(0, dtype=self.link_dtype)
+        self.skeleton_ids = numpy.zeros(0, dtype='i8')
+        self.connector_type = None
+        self.skeleton_type = None
+        self._pending = []
+        self._skeleton_order = None
+
+    def __len__(self):
+        self._compact()
+        return len(self.connector_ids)
+
+    def __contains__(self, cid):
+        self._compact()
+        i = numpy.searchsorted(self.connector_ids, cid)
+        return i < len(self.connector_ids) and self.connector_ids[i] == cid
+
+    def add_neuron(self, n, compact=True):
+        """
+        Add (or replace) the synapse links of neuron n
+
+        When adding many neurons, use compact=False to defer merging them
+        into the arrays until the next lookup (or _compact call)
+        """
+        sid = int(n.skeleton_id)
+        self.skeleton_type = type(n.skeleton_id)
+        self.connector_type = type(next(iter(n.skeleton['vertices']), 0))
+        if sid in self.skeleton_ids or any(
+                p[0] == sid for p in self._pending):
+            self.remove_skeleton(sid)
+        table = n.synapse_table
+        pre = table['type'] == 'presynaptic_to'
+        unknown = ~pre & (table['type'] != 'postsynaptic_to')
+        if numpy.any(unknown):
+            raise ValueError(
+                "Unknown connector type {} for {} in {}".format(
+                    table['type'][unknown][0],
+                    table['connector'][unknown][0], sid))
+        links = numpy.empty(len(table), dtype=self.link_dtype)
+        links['connector'] = table['connector']
+        links['skeleton'] = sid
+        links['node'] = table['node']
+        links['pre'] = pre
+        cids, first = numpy.unique(table['connector'], return_index=True)
+        locations = numpy.column_stack((
+            table['connector_x'], table['connector_y'],
+            table['connector_z']))[first]
+        self._pending.append((sid, cids, locations, links))
+        if compact:
+            self._compact()
+
+    def add_source(self, source, sids=None, update=False):
+        """Add all skeletons in sids (default all on source), skeletons
+        that are already indexed are skipped unless update is True"""
+        if sids is None:
+            sids = source.skeleton_ids()
+        self._compact()
+        for sid in sids:
+            if not update and int(sid) in self.skeleton_ids:
+                continue
+            self.add_neuron(source.get_neuron(sid), compact=False)
+        self._compact()
+
+    def remove_skeleton(self, sid):
+        """Remove all links of skeleton sid (and connectors without links)"""
+        self._compact()
+        self.skeleton_ids = self.skeleton_ids[self.skeleton_ids != sid]
+        self.links = self.links[self.links['skeleton'] != sid]
+        keep = numpy.in1d(self.connector_ids, self.links['connector'])
+        self.connector_ids = self.connector_ids[keep]
+        self.locations = self.locations[keep]
+        self._skeleton_order = None
+
+    def _compact(self):
+        """Merge pending neurons into the arrays"""
+        if len(self._pending) == 0:
+            return
+        sids, cids, locations, links = zip(*self._pending)
+        self._pending = []
+        self.skeleton_ids = numpy.union1d(
+            self.skeleton_ids, numpy.array(sids, dtype='i8'))
+        # reversed so the most recently added location of each connector
+        # is kept
+        cids = numpy.hstack((self.connector_ids, ) + cids)[::-1]
+        locations = numpy.vstack((self.locations, ) + locations)[::-1]
+        self.connector_ids, last = numpy.unique(cids, return_index=True)
+        self.locations = locations[last]
+        links = numpy.hstack((self.links, ) + links)
+        self.links = links[numpy.lexsort(
+            (links['node'], links['skeleton'], links['connector']))]
+        self._skeleton_order = None
+
+    def _link_range(self, cid):
+        c = self.links['connector']
+        return (
+            numpy.searchsorted(c, cid, 'left'),
+            numpy.searchsorted(c, cid, 'right'))
+
+    def connector(self, cid):
+        """
+        Returns {'location': (x, y, z), 'pre': [(sid, nid), ...],
+                 'post': [(sid, nid), ...]} for connector cid
+        """
+        self._compact()
+        i = numpy.searchsorted(self.connector_ids, cid)
+        if i == len(self.connector_ids) or self.connector_ids[i] != cid:
+            raise KeyError("Unknown connector {}".format(cid))
+        s, e = self._link_range(cid)
+        links = self.links[s:e]
+        return {
+            'location': tuple(self.locations[i]),
+            'pre': [
+                (int(link['skeleton']), int(link['node']))
+                for link in links[links['pre']]],
+            'post': [
+                (int(link['skeleton']), int(link['node']))
+                for link in links[~links['pre']]],
+        }
+
+    def skeleton_links(self, sid):
+        """Returns the links (see link_dtype) of skeleton sid"""
+        self._compact()
+        if self._skeleton_order is None:
+            self._skeleton_order = numpy.argsort(
+                self.links['skeleton'], kind='mergesort')
+        sk = self.links['skeleton'][self._skeleton_order]
+        s = numpy.searchsorted(sk, sid, 'left')
+        e = numpy.searchsorted(sk, sid, 'right')
+        return self.links[self._skeleton_order[s:e]]
+
+    def skeleton_connectors(self, sid):
+        """Returns {'pre': connector ids, 'post': connector ids} where
+        skeleton sid is pre or postsynaptic"""
+        links = self.skeleton_links(sid)
+        return {
+            'pre': numpy.unique(links['connector'][links['pre']]),
+            'post': numpy.unique(links['connector'][~links['pre']]),
+        }
+
+    def in_box(self, lo, hi):
+        """Returns the ids of connectors with lo <= location <= hi"""
+        self._compact()
+        m = numpy.all(
+            (self.locations >= lo) & (self.locations <= hi), axis=1)
+        return self.connector_ids[m]
+
+    def to_conns(self):
+        """
+        Returns the connectors in the add_neuron_to_conns format with
+        connector and skeleton ids of the types of the added neurons
+        """
+        self._compact()
+        ctype = self.connector_type or int
+        stype = self.skeleton_type or int
+        conns = {}
+        starts = numpy.searchsorted(
+            self.links['connector'], self.connector_ids, 'left')
+        ends = numpy.searchsorted(
+            self.links['connector'], self.connector_ids, 'right')
+        for (cid, location, s, e) in zip(
+                self.connector_ids, self.locations, starts, ends):
+            links = self.links[s:e]
+            conns[ctype(cid)] = {
+                'pre': [
+                    stype(sid) for sid in links['skeleton'][links['pre']]],
+                'post': [
+                    stype(sid) for sid in links['skeleton'][~links['pre']]],
+                'location': tuple(float(v) for v in location),
+            }
+        return conns
+
+    def save(self, fn):
+        self._compact()
+        numpy.savez_compressed(
+            fn, connector_ids=self.connector_ids, locations=self.locations,
+            links=self.links, skeleton_ids=self.skeleton_ids,
+            id_types=numpy.array([
+                _type_name(self.connector_type),
+                _type_name(self.skeleton_type)]))
+
+    @classmethod
+    def load(cls, fn):
+        index = cls()
+        d = numpy.load(fn)
+        index.connector_ids = d['connector_ids']
+        index.locations = d['locations']
+        index.links = d['links']
+        index.skeleton_ids = d['skeleton_ids']
+        if 'id_types' in d:
+            index.connector_type, index.skeleton_type = [
+                _id_types.get(t) for t in d['id_types'].tolist()]
+        return index
+
+
+# types of saved connector and skeleton ids by name
+_id_types = {'int': int, 'long': long, 'str': str, 'unicode': unicode}
+
+
+def _type_name(t):
+    return '' if t is None else t.__name__
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+"""
+Analysis of (whole project) wiring diagrams as sparse matrices
+
+All functions take a directed adjacency matrix m where m[i, j] is the
+number of synapses from skeleton i to skeleton j, for example from
+graph_tools.get_sparse_graph, graph_tools.get_adj_mat(directed=True) or
+wiring.to_adjacency_matrix. Edges are m[i, j] >= threshold, self
+connections (m[i, i]) are ignored. Rows/columns are returned as indices,
+use the skeleton list (or index) that built m to map them to skeletons.
+"""
+
+try:
+    import numpy
+    import scipy.sparse
+    import scipy.sparse.csgraph
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
+
+# triad types (1-based, in the order of triad_names) for the 64 codes of
+# the 6 directed edges between 3 nodes v, i and j with the bits:
+#   1: v -> i, 2: i -> v, 4: v -> j, 8: j -> v, 16: i -> j, 32: j -> i
+triad_codes = (
+    1, 2, 2, 3, 2, 4, 6, 8, 2, 6, 5, 7, 3, 8, 7, 11, 2, 6, 4, 8, 5, 9, 9,
+    13, 6, 10, 9, 14, 7, 14, 12, 15, 2, 5, 6, 7, 6, 9, 10, 14, 4, 9, 9, 12,
+    8, 13, 14, 15, 3, 7, 8, 11, 7, 12, 14, 15, 8, 14, 13, 15, 11, 15, 15,
+    16)
+triad_names = (
+    '003', '012', '102', '021D', '021U', '021C', '111D', '111U', '030T',
+    '030C', '201', '120D', '120U', '120C', '210', '300')
+
+
+def binarize(m, threshold=1):
+    """
+    Returns a boolean csr matrix of the edges (m[i, j] >= threshold)
+    of m without self connections
+    """
+    if not has_scipy:
+        raise ImportError("binarize requires numpy and scipy")
+    m = scipy.sparse.coo_matrix(m)
+    keep = (m.data >= threshold) & (m.row != m.col)
+    a = scipy.sparse.csr_matrix(
+        (numpy.ones(keep.sum(), dtype=bool), (m.row[keep], m.col[keep])),
+        shape=m.shape)
+    a.sum_duplicates()
+    a.sort_indices()
+    return a
+
+
+def degrees(m, threshold=1, weighted=False):
+    """
+    Returns in and out degrees of every node
+
+    If weighted, degrees are the number of synapses (of edges with at
+    least threshold synapses) instead of the number of partners
+    """
+    a = binarize(m, threshold)
+    if weighted:
+        a = scipy.sparse.csr_matrix(m).multiply(a)
+    else:
+        a = a.astype('i8')
+    return (
+        numpy.asarray(a.sum(axis=0)).ravel(),
+        numpy.asarray(a.sum(axis=1)).ravel())
+
+
+def dyad_census(m, threshold=1):
+    """
+    Counts the 2 node motifs (pairs of nodes)
+
+    Returns a dict with the number of mutual (i <-> j), asymmetric
+    (i -> j) and null (unconnected) pairs
+    """
+    a = binarize(m, threshold)
+    n = a.shape[0]
+    mutual = a.multiply(a.T).nnz // 2
+    asymmetric = a.nnz - 2 * mutual
+    return {
+        'mutual': mutual, 'asymmetric': asymmetric,
+        'null': n * (n - 1) // 2 - mutual - asymmetric}
+
+
+def reciprocity(m, threshold=1):
+    """Returns the fraction of edges that are reciprocated"""
+    a = binarize(m, threshold)
+    if a.nnz == 0:
+        return 0.
+    return a.multiply(a.T).nnz / float(a.nnz)
+
+
+def _centered_pairs(u, chunk_size):
+    """
+    Generates all (center, a, b) triples where the entries a and b
+    (a < b, indices into u.indices and u.data) are both neighbors of
+    center in the csr matrix u (with sorted indices)
+
+    Triples are generated in chunks of about chunk_size
+    """
+    n = u.shape[0]
+    rows = numpy.repeat(numpy.arange(n), numpy.diff(u.indptr))
+    # each entry is paired with the following entries of its row
+    counts = u.indptr[rows + 1] - numpy.arange(u.nnz) - 1
+    ends = numpy.cumsum(counts)
+    start = 0
+    while start < u.nnz:
+        offset = ends[start] - counts[start]
+        stop = max(
+            numpy.searchsorted(ends, offset + chunk_size, side='right'),
+            start + 1)
+        p = numpy.arange(start, stop)
+        c = counts[start:stop]
+        pp = numpy.repeat(p, c)
+        q = pp + 1 + (
+            numpy.arange(len(pp)) - numpy.repeat(ends[p] - c - offset, c))
+        yield rows[pp], pp, q
+        start = stop
+
+
+def triad_census(m, threshold=1, chunk_size=1000000):
+    """
+    Counts the 3 node motifs (the 16 isomorphism classes of triads)
+
+    Connected triads are found by pairing the neighbors of each node so
+    the cost depends on the sum of the squared degrees, not on the
+    (cubic) number of triads.
+
+    Returns a dict of counts by triad name (see triad_names)
+    """
+    a = binarize(m, threshold).astype('i8')
+    n = a.shape[0]
+    # undirected neighbors, the values encode the edge directions:
+    #   1: i -> j, 2: j -> i, 3: both
+    u = (a + 2 * a.T).tocsr()
+    u.sort_indices()
+    rows = numpy.repeat(numpy.arange(n, dtype='i8'), numpy.diff(u.indptr))
+    keys = rows * n + u.indices
+    common = numpy.zeros(u.nnz, dtype='i8')
+    codes = numpy.array(triad_codes) - 1
+    counts = numpy.zeros(len(triad_names), dtype='i8')
+    for (v, p, q) in _centered_pairs(u, chunk_size):
+        i = u.indices[p].astype('i8')
+        j = u.indices[q].astype('i8')
+        k = numpy.minimum(numpy.searchsorted(keys, i * n + j), u.nnz - 1)
+        closed = keys[k] == (i * n + j)
+        code = u.data[p] + u.data[q] * 4 + numpy.where(
+            closed, u.data[k], 0) * 16
+        # closed triads are found once from each node, count the lowest
+        count = ~closed | (v < i)
+        counts += numpy.bincount(
+            codes[code[count]], minlength=len(triad_names))
+        # number of common neighbors of connected pairs (i, j)
+        common += numpy.bincount(k[closed], minlength=u.nnz)
+    # triads with only 1 connected pair (i, j)
+    upper = rows < u.indices
+    i = rows[upper]
+    j = u.indices[upper]
+    d = numpy.diff(u.indptr)
+    others = n - d[i] - d[j] + common[upper]
+    mutual = u.data[upper] == 3
+    counts[2] = others[mutual].sum()
+    counts[1] = others[~mutual].sum()
+    counts[0] = n * (n - 1) * (n - 2) // 6 - counts[1:].sum()
+    return dict(zip(triad_names, counts.tolist()))
+
+
+def hop_distances(m, sources, max_hops=None, threshold=1, reverse=False):
+    """
+    Breadth first search from sources following edges (or, if reverse,
+    edges backwards) for at most max_hops
+
+    The frontiers of all sources are expanded together as one sparse
+    matrix product per hop.
+
+    Returns an array (len(sources) x nodes) of the number of hops from
+    each source to each node, -1 for nodes that were not reached
+    """
+    a = binarize(m, threshold)
+    if reverse:
+        a = a.T.tocsr()
+    n = a.shape[0]
+    sources = numpy.atleast_1d(sources)
+    ns = len(sources)
+    hops = -numpy.ones((ns, n), dtype='i8')
+    hops[numpy.arange(ns), sources] = 0
+    frontier = scipy.sparse.csr_matrix(
+        (numpy.ones(ns, dtype=bool), (numpy.arange(ns), sources)),
+        shape=(ns, n))
+    hop = 0
+    while frontier.nnz and (max_hops is None or hop < max_hops):
+        hop += 1
+        f = (frontier * a).tocoo()
+        new = hops[f.row, f.col] == -1
+        r, c = f.row[new], f.col[new]
+        hops[r, c] = hop
+        frontier = scipy.sparse.csr_matrix(
+            (numpy.ones(len(r), dtype=bool), (r, c)), shape=(ns, n))
+    return hops
+
+
+def reachable(m, sources, k, threshold=1, reverse=False):
+    """
+    Returns a boolean array (len(sources) x nodes) of the nodes that are
+    reachable from each source within k hops, see hop_distances
+    """
+    return hop_distances(m, sources, k, threshold, reverse) >= 0
+
+
+def shortest_path(m, source, target, threshold=1):
+    """
+    Returns the nodes (source, ..., target) of a path from source to
+    target with the fewest synaptic hops or None if target is unreachable
+    """
+    if not has_scipy:
+        raise ImportError("shortest_path requires numpy and scipy")
+    a = binarize(m, threshold)
+    order, predecessors = scipy.sparse.csgraph.breadth_first_order(
+        a, source, directed=True, return_predecessors=True)
+    if source != target and predecessors[target] < 0:
+        return None
+    path = [target]
+    while path[-1] != source:
+        path.append(predecessors[path[-1]])
+    return [int(i) for i in path[::-1]]
@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+"""
+Spatial indices of the nodes (and connectors) of many skeletons
+
+NodeIndex: nodes are stored in one structured array (see node_dtype)
+sorted by z so z-sections are found with a binary search. Box, radius and
+nearest neighbor queries use a KD-tree (scipy.spatial.cKDTree) that is
+built the first time it is needed.
+
+SectionIndex: nodes and edges by z section (see section_node_dtype and
+section_edge_dtype) for slicing skeletons into images.
+"""
+
+import numpy
+
+try:
+    from scipy.spatial import cKDTree
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
+try:
+    xrange
+except NameError as E:
+    xrange = range
+
+
+node_dtype = [
+    ('skeleton', 'i8'), ('node', 'i8'), ('connector', '?'),
+    ('x', 'f8'), ('y', 'f8'), ('z', 'f8')]
+
+
+def neuron_nodes(n):
+    """Returns the nodes and connectors of neuron n as a node_dtype array"""
+    sid = int(n.skeleton_id)
+    rows = []
+    for (vertices, connector) in ((n.nodes, False), (n.connectors, True)):
+        for nid in vertices:
+            v = vertices[nid]
+            rows.append((
+                sid, int(nid), connector,
+                float(v['x']), float(v['y']), float(v['z'])))
+    return numpy.array(rows, dtype=node_dtype)
+
+
+class NodeIndex(object):
+    """
+    Spatial index of the nodes and connectors of many skeletons
+
+    nodes: node_dtype array sorted by (z, skeleton, node)
+    skeleton_ids: sorted ids of the skeletons that were indexed
+
+    Queries return node_dtype arrays. Use connectors=True (or False) to
+    only return connectors (or skeleton nodes). Skeletons can be added,
+    re-added (which replaces their nodes) or removed and the index can be
+    saved to (and loaded from) a .npz file.
+    """
+    def __init__(self):
+        self.nodes = numpy.zeros(0, dtype=node_dtype)
+        self.skeleton_ids = numpy.zeros(0, dtype='i8')
+        self._pending = []
+        self._tree = None
+
+    def __len__(self):
+        self._compact()
+        return len(self.nodes)
+
+    def add_neuron(self, n, compact=True):
+        """
+        Add (or replace) the nodes of neuron n
+
+        When adding many neurons, use compact=False to defer merging them
+        into the arrays until the next query (or _compact call)
+        """
+        sid = int(n.skeleton_id)
+        if sid in self.skeleton_ids or any(
+                p[0] == sid for p in self._pending):
+            self.remove_skeleton(sid)
+        self._pending.append((sid, neuron_nodes(n)))
+        if compact:
+            self._compact()
+
+    def add_source(self, source, sids=None, update=False):
+        """Add all skeletons in sids (default all on source), skeletons
+        that are already indexed are skipped unless update is True"""
+        if sids is None:
+            sids = source.skeleton_ids()
+        self._compact()
+        for sid in sids:
+            if not update and int(sid) in self.skeleton_ids:
+                continue
+            self.add_neuron(source.get_neuron(sid), compact=False)
+        self._compact()
+
+    def remove_skeleton(self, sid):
+        """Remove all nodes of skeleton sid"""
+        self._compact()
+        self.skeleton_ids = self.skeleton_ids[self.skeleton_ids != sid]
+        self.nodes = self.nodes[self.nodes['skeleton'] != sid]
+        self._tree = None
+
+    def _compact(self):
+        """Merge pending neurons into the arrays"""
+        if len(self._pending) == 0:
+            return
+        sids, nodes = zip(*self._pending)
+        self._pending = []
+        self.skeleton_ids = numpy.union1d(
+            self.skeleton_ids, numpy.array(sids, dtype='i8'))
+        nodes = numpy.hstack((self.nodes, ) + nodes)
+        self.nodes = nodes[numpy.lexsort(
+            (nodes['node'], nodes['skeleton'], nodes['z']))]
+        self._tree = None
+
+    @property
+    def points(self):
+        """N x 3 array of node locations (in the order of nodes)"""
+        self._compact()
+        return numpy.column_stack(
+            (self.nodes['x'], self.nodes['y'], self.nodes['z']))
+
+    @property
+    def tree(self):
+        if not has_scipy:
+            raise ImportError("NodeIndex queries require scipy")
+        self._compact()
+        if self._tree is None:
+            self._tree = cKDTree(self.points)
+        return self._tree
+
+    def _select(self, indices, connectors=None):
+        nodes = self.nodes[numpy.sort(indices)]
+        if connectors is None:
+            return nodes
+        return nodes[nodes['connector'] == connectors]
+
+    def z_section(self, z, tolerance=0., connectors=None):
+        """Returns the nodes with z - tolerance <= node z <= z + tolerance"""
+        self._compact()
+        s = numpy.searchsorted(self.nodes['z'], z - tolerance, 'left')
+        e = numpy.searchsorted(self.nodes['z'], z + tolerance, 'right')
+        return self._select(numpy.arange(s, e), connectors)
+
+    def box(self, lo, hi, connectors=None):
+        """Returns the nodes with lo <= (x, y, z) <= hi"""
+        self._compact()
+        lo = numpy.asarray(lo, dtype='f8')
+        hi = numpy.asarray(hi, dtype='f8')
+        # z is sorted, so only test x and y on the z range
+        s = numpy.searchsorted(self.nodes['z'], lo[2], 'left')
+        e = numpy.searchsorted(self.nodes['z'], hi[2], 'right')
+        nodes = self.nodes[s:e]
+        m = (
+            (nodes['x'] >= lo[0]) & (nodes['x'] <= hi[0]) &
+            (nodes['y'] >= lo[1]) & (nodes['y'] <= hi[1]))
+        return self._select(numpy.where(m)[0] + s, connectors)
+
+    def radius(self, point, r, connectors=None):
+        """Returns the nodes within r of point"""
+        return self._select(
+            numpy.array(self.tree.query_ball_point(point, r), dtype='i8'),
+            connectors)
+
+    def nearest(self, point, k=1, connectors=None):
+        """
+        Returns the k nearest nodes to point (sorted by distance) and
+        their distances
+        """
+        tree = self.tree
+        if connectors is None:
+            k = min(k, len(self.nodes))
+            if k == 0:
+                return self.nodes[:0], numpy.zeros(0)
+            d, i = tree.query(point, k)
+            d, i = numpy.atleast_1d(d), numpy.atleast_1d(i)
+            return self.nodes[i], d
+        # query more nodes until there are k of the requested type
+        n = k
+        while True:
+            n = min(n * 2, len(self.nodes))
+            d, i = tree.query(point, n)
+            d, i = numpy.atleast_1d(d), numpy.atleast_1d(i)
+            m = self.nodes['connector'][i] == connectors
+            if numpy.sum(m) >= k or n == len(self.nodes):
+                return self.nodes[i[m][:k]], d[m][:k]
+
+    def skeletons_in_box(self, lo, hi, connectors=None):
+        """Returns the ids of skeletons with nodes in a box"""
+        return numpy.unique(self.box(lo, hi, connectors)['skeleton'])
+
+    def save(self, fn):
+        self._compact()
+        numpy.savez_compressed(
+            fn, nodes=self.nodes, skeleton_ids=self.skeleton_ids)
+
+    @classmethod
+    def load(cls, fn):
+        index = cls()
+        d = numpy.load(fn)
+        index.nodes = d['nodes']
+        index.skeleton_ids = d['skeleton_ids']
+        return index
+
+
+section_node_dtype = [
+    ('skeleton', 'i8'), ('node', 'i8'), ('x', 'f8'), ('y', 'f8'),
+    ('z', 'f8'), ('section', 'i8')]
+
+
+section_edge_dtype = [
+    ('skeleton', 'i8'), ('u', 'i8'), ('v', 'i8'),
+    ('x0', 'f8'), ('y0', 'f8'), ('z0', 'f8'),
+    ('x1', 'f8'), ('y1', 'f8'), ('z1', 'f8')]
+
+
+class SectionIndex(object):
+    """
+    Index of the nodes and edges of many skeletons by z section
+
+    Section s contains z values in
+        [z_offset + (s - 0.5) * z_resolution,
+         z_offset + (s + 0.5) * z_resolution)
+    Nodes are sorted by section. Edges are stored with the first and last
+    section they pass through and are clipped to the section when queried.
+
+    Build with add_neuron (or add_arrays for custom node sets) and query
+    single sections with section or stream through many with sections.
+    """
+    def __init__(self, z_resolution=1., z_offset=0.):
+        self.z_resolution = float(z_resolution)
+        self.z_offset = float(z_offset)
+        self.nodes = numpy.zeros(0, dtype=section_node_dtype)
+        self.edges = numpy.zeros(0, dtype=section_edge_dtype)
+        self.edge_sections = numpy.zeros((0, 2), dtype='i8')
+        self._pending = []
+
+    def section_of(self, z):
+        """Section index (or indices) of z"""
+        return numpy.floor(
+            (numpy.asarray(z) - self.z_offset) / self.z_resolution +
+            0.5).astype('i8')
+
+    def section_bounds(self, section):
+        """Returns the (lower, upper) z of a section"""
+        return (
+            self.z_offset + (section - 0.5) * self.z_resolution,
+            self.z_offset + (section + 0.5) * self.z_resolution)
+
+    def add_arrays(self, sid, node_ids, points, edges, compact=True):
+        """
+        Add the nodes (node_ids and N x 3 points) of skeleton sid and
+        edges (E x 2 indices into points)
+        """
+        points = numpy.asarray(points, dtype='f8').reshape((-1, 3))
+        edges = numpy.asarray(edges, dtype='i8').reshape((-1, 2))
+        node_ids = numpy.asarray(node_ids, dtype='i8')
+        nodes = numpy.empty(len(points), dtype=section_node_dtype)
+        nodes['skeleton'] = sid
+        nodes['node'] = node_ids
+        nodes['x'], nodes['y'], nodes['z'] = points.T
+        nodes['section'] = self.section_of(points[:, 2])
+        e = numpy.empty(len(edges), dtype=section_edge_dtype)
+        e['skeleton'] = sid
+        e['u'] = node_ids[edges[:, 0]]
+        e['v'] = node_ids[edges[:, 1]]
+        e['x0'], e['y0'], e['z0'] = points[edges[:, 0]].T
+        e['x1'], e['y1'], e['z1'] = points[edges[:, 1]].T
+        sections = numpy.sort(numpy.column_stack((
+            nodes['section'][edges[:, 0]],
+            nodes['section'][edges[:, 1]])), axis=1)
+        self._pending.append((nodes, e, sections))
+        if compact:
+            self._compact()
+
+    def add_neuron(self, n, graph=None, compact=True):
+        """Add the nodes and edges of graph (default n.dgraph) of n"""
+        if graph is None:
+            graph = n.dgraph
+        nids = list(graph.nodes())
+        lookup = dict([(nid, i) for (i, nid) in enumerate(nids)])
+        points = [
+            (n.nodes[nid]['x'], n.nodes[nid]['y'], n.nodes[nid]['z'])
+            for nid in nids]
+        edges = [(lookup[u], lookup[v]) for (u, v) in graph.edges()]
+        self.add_arrays(
+            int(n.skeleton_id), [int(nid) for nid in nids], points, edges,
+            compact)
+
+    def add_source(self, source, sids=None, graph=None):
+        """Add the skeletons in sids (default all on source), graph is a
+        function that returns the graph to use for a neuron"""
+        if sids is None:
+            sids = source.skeleton_ids()
+        for sid in sids:
+            n = source.get_neuron(sid)
+            self.add_neuron(
+                n, None if graph is None else graph(n), compact=False)
+        self._compact()
+
+    def _compact(self):
+        """Merge pending skeletons into the arrays"""
+        if len(self._pending) == 0:
+            return
+        nodes, edges, sections = zip(*self._pending)
+        self._pending = []
+        nodes = numpy.hstack((self.nodes, ) + nodes)
+        self.nodes = nodes[numpy.argsort(nodes['section'], kind='mergesort')]
+        edges = numpy.hstack((self.edges, ) + edges)
+        sections = numpy.vstack((self.edge_sections, ) + sections)
+        order = numpy.argsort(sections[:, 0], kind='mergesort')
+        self.edges = edges[order]
+        self.edge_sections = sections[order]
+
+    def _clip_edges(self, edges, section):
+        """Clip edges to the z range of a section"""
+        lo, hi = self.section_bounds(section)
+        p0 = numpy.column_stack((edges['x0'], edges['y0'], edges['z0']))
+        p1 = numpy.column_stack((edges['x1'], edges['y1'], edges['z1']))
+        dz = p1[:, 2] - p0[:, 2]
+        flat = dz == 0.
+        sdz = numpy.where(flat, 1., dz)
+        ta = (lo - p0[:, 2]) / sdz
+        tb = (hi - p0[:, 2]) / sdz
+        t0 = numpy.where(flat, 0., numpy.clip(numpy.minimum(ta, tb), 0., 1.))
+        t1 = numpy.where(flat, 1., numpy.clip(numpy.maximum(ta, tb), 0., 1.))
+        a = p0 + t0[:, numpy.newaxis] * (p1 - p0)
+        b = p0 + t1[:, numpy.newaxis] * (p1 - p0)
+        clipped = edges.copy()
+        clipped['x0'], clipped['y0'], clipped['z0'] = a.T
+        clipped['x1'], clipped['y1'], clipped['z1'] = b.T
+        return clipped
+
+    def section(self, section):
+        """
+        Returns the nodes in a section and the edges that pass through it
+        (clipped to the section)
+        """
+        self._compact()
+        s = numpy.searchsorted(self.nodes['section'], section, 'left')
+        e = numpy.searchsorted(self.nodes['section'], section, 'right')
+        # edges starting at or before section
+        n = numpy.searchsorted(self.edge_sections[:, 0], section, 'right')
+        m = numpy.where(self.edge_sections[:n, 1] >= section)[0]
+        return self.nodes[s:e], self._clip_edges(self.edges[m], section)
+
+    def sections(self, start=None, stop=None):
+        """
+        Iterate through sections start to stop (inclusive, default all
+        sections with nodes), yielding (section, nodes, edges) with
+        edges clipped to the section (see section)
+
+        Edges are swept in order of their first section so each step only
+        looks at the edges that are still active.
+        """
+        self._compact()
+        if len(self.nodes) == 0:
+            return
+        if start is None:
+            start = self.nodes['section'][0]
+        if stop is None:
+            stop = self.nodes['section'][-1]
+        starts = self.edge_sections[:, 0]
+        ends = self.edge_sections[:, 1]
+        next_edge = numpy.searchsorted(starts, start, 'left')
+        # edges that started before start but are still active
+        active = numpy.where(ends[:next_edge] >= start)[0]
+        for section in xrange(start, stop + 1):
+            n = numpy.searchsorted(starts, section, 'right')
+            active = numpy.hstack((active, numpy.arange(next_edge, n)))
+            next_edge = n
+            active = active[ends[active] >= section]
+            s = numpy.searchsorted(self.nodes['section'], section, 'left')
+            e = numpy.searchsorted(self.nodes['section'], section, 'right')
+            yield (
+                section, self.nodes[s:e],
+                self._clip_edges(self.edges[active], section))
@@ -15,13 +15,32 @@ s = "the distance entering the definition of the potential synapse" huh?
 abs(sin(...)) = abs of sin of angle between unit vectors
 sig = gaussian sigma
 """
+import json
 import logging
 import itertools
+import os
 import numpy
 
+try:
+    import scipy.sparse
+    from scipy.spatial import cKDTree
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
+from .. import batch
+
 # import catmaid
 # TODO only axon/dendrite overlap, for now just calculate all
 
+try:
+    xrange
+except NameError as E:
+    xrange = range
+
+# cylinder pairs with a gaussian term below this are skipped
+default_tolerance = 1e-6
+
 
 class EdgeError(Exception):
     pass
@@ -118,221 +137,266 @@ def get_edge_array(n, edges):
     return numpy.array(uvs), numpy.array(vvs)
 
 
-def skeleton_overlap_v_verbose(
-        neuron_a, neuron_d, s=1000., sig=10000., g1=None, g2=None,
-        ordered_by='axon', op=numpy.sum, output=None):
-    if output is None:
-        output = {'midpoint': True}
-    if g1 is None:
-        axon = neuron_a.axons
-        if len(axon) != 1:
-            msg = "axon skeleton {} has != 1 [{}] axon".format(
-                neuron_a.name, len(axon))
-            logging.critical(msg)
-            raise Exception(msg)
-        axon = axon[axon.keys()[0]]['tree']
-    else:
-        axon = g1
+def overlap_cutoff(sig=10000., tolerance=default_tolerance):
+    """
+    Distance between cylinder midpoints beyond which the gaussian term
+    of the overlap, exp(-(r ** 2) / (4 * sig ** 2)), falls below tolerance
 
-    # precompute cylinders
-    if g2 is None:
-        dendrites = neuron_d.dendrites
-    else:
-        dendrites = g2
-    # get edges
-    ra, na, la = edge_to_cylinder_v(
-        *get_edge_array(neuron_a, axon.edges_iter()))
-    rd, nd, ld = edge_to_cylinder_v(
-        *get_edge_array(neuron_d, dendrites.edges_iter()))
+    A tolerance of None or 0 disables the cutoff (returns inf)
+    """
+    if not tolerance:
+        return numpy.inf
+    return 2. * sig * numpy.sqrt(-numpy.log(tolerance))
 
-    totals = []
-    if ordered_by == 'axon':
-        for i in xrange(len(la)):
-            r = op(2. * s * cylinder_overlap_v(
-                ra[i, numpy.newaxis], na[i, numpy.newaxis],
-                la[i, numpy.newaxis],
-                rd, nd, ld, sig=sig))
-            t = []
-            if output.get('midpoint', False):
-                t.extend(ra[i])
-            if isinstance(r, (tuple, list)):
-                t.extend(list(r))
-            else:
-                t.append(r)
-            if output.get('normal', False):
-                t.extend(na[i])
-            if output.get('length', False):
-                t.append(la[i])
-            totals.append(t)
-            #totals.append(
-            #    (ra[i][0], ra[i][1], ra[i][2], r))
-    elif ordered_by == 'dendrite':
-        for i in xrange(len(ld)):
-            r = op(2. * s * cylinder_overlap_v(
-                ra, na, la,
-                rd[i, numpy.newaxis], nd[i, numpy.newaxis],
-                ld[i, numpy.newaxis], sig=sig))
-            t = []
-            if output.get('midpoint', False):
-                t.extend(rd[i])
-            if isinstance(r, (tuple, list)):
-                t.extend(list(r))
-            else:
-                t.append(r)
-            if output.get('normal', False):
-                t.extend(nd[i])
-            if output.get('length', False):
-                t.append(ld[i])
-            totals.append(t)
-            #totals.append(
-            #    (rd[i][0], rd[i][1], rd[i][2], r))
-    return totals
 
+def axon_blocks(ra, cutoff, block_size=512):
+    """
+    Splits axon cylinders (with midpoints ra) into blocks of at most
+    block_size spatially close cylinders
 
-def skeleton_proximity_v(
-        neuron_a, neuron_d, s=1000., sig=10000., g1=None, g2=None):
-    # 1706 seconds
-    # passing instance of neurons
-    # if isinstance(fn_a, catmaid.Neuron):
-        # sk_a = fn_a
-    # else:
-        # sk_a = catmaid.Neuron(json.load(open(fn_a, 'r')))
-    # if isinstance(fn_a, catmaid.Neuron):
-        # sk_d = fn_d
-    # else:
-        # sk_d = catmaid.Neuron(json.load(open(fn_d, 'r')))
-    if g1 is None:
-        axon = neuron_a.axons
-        if len(axon) != 1:
-            msg = "axon skeleton {} has != 1 [{}] axon".format(
-                neuron_a.name, len(axon))
-            logging.critical(msg)
-            raise Exception(msg)
-        axon = axon[axon.keys()[0]]['tree']
+    Cylinders are sorted into a grid with cell size = cutoff so that the
+    dendrite cylinders near each block can be found with one KD-tree query.
+    Returns a list of index arrays.
+    """
+    if numpy.isinf(cutoff) or len(ra) == 0:
+        order = numpy.arange(len(ra))
     else:
-        axon = g1
+        cells = numpy.floor((ra - ra.min(axis=0)) / cutoff).astype('i8')
+        order = numpy.lexsort(cells.T[::-1])
+    return [
+        order[start:start + block_size]
+        for start in xrange(0, len(order), block_size)]
+
+
+def _overlap_blocks(
+        ra, na, la, rd, nd, ld, sig=10000., tolerance=default_tolerance,
+        proximity=False, blocks=None, dtree=None, column_block_size=8192):
+    """
+    Computes blocks of overlap (or proximity) of axon (a) and
+    dendrite (d) cylinders
+
+    Axon cylinders are processed in blocks (see axon_blocks). For each
+    block, the dendrite cylinders near the block are found with a KD-tree
+    (dtree, built over rd if not provided) and the overlap for the block
+    is computed with matrix products.
+
+    Yields (i, j, v, mask) for each block where i are axon cylinder
+    indices, j are dendrite cylinder indices, v is a len(i) x len(j)
+    array of overlaps and mask selects the pairs within the cutoff
+    (mask is None when there is no cutoff)
+    """
+    if len(la) == 0 or len(ld) == 0:
+        return
+    cutoff = overlap_cutoff(sig, tolerance)
+    norm = (4 * numpy.pi * sig ** 2) ** 1.5
+    dense = numpy.isinf(cutoff)
+    if blocks is None:
+        blocks = axon_blocks(ra, cutoff)
+    if dtree is None and not dense:
+        if not has_scipy:
+            raise ImportError(
+                "overlap with a tolerance requires scipy, use tolerance=None")
+        dtree = cKDTree(rd)
+    for i in blocks:
+        center = ra[i].mean(axis=0)
+        bra = ra[i] - center
+        if dense:
+            j = numpy.arange(len(ld))
+        else:
+            radius = numpy.sqrt(numpy.max(numpy.sum(bra ** 2., axis=1)))
+            j = numpy.array(
+                dtree.query_ball_point(center, cutoff + radius), dtype='i8')
+            j.sort()
+        bra2 = numpy.sum(bra ** 2., axis=1)[:, numpy.newaxis]
+        for cstart in xrange(0, len(j), column_block_size):
+            bj = j[cstart:cstart + column_block_size]
+            brd = rd[bj] - center
+            # squared distances, computed in place to limit temporaries
+            d2 = numpy.dot(bra, brd.T)
+            d2 *= -2.
+            d2 += bra2
+            d2 += numpy.sum(brd ** 2., axis=1)[numpy.newaxis, :]
+            numpy.maximum(d2, 0., d2)
+            m = None if dense else d2 <= cutoff * cutoff
+            v = d2
+            v /= -4 * sig ** 2.
+            numpy.exp(v, v)
+            v *= numpy.outer(la[i], ld[bj])
+            v /= norm
+            if not proximity:
+                dp = numpy.dot(na[i], nd[bj].T)
+                # abs(sin(arccos(dp)))
+                dp *= dp
+                numpy.minimum(dp, 1., dp)
+                numpy.subtract(1., dp, dp)
+                numpy.sqrt(dp, dp)
+                v *= dp
+            yield i, bj, v, m
+
+
+def overlap_pairs(
+        ra, na, la, rd, nd, ld, sig=10000., tolerance=default_tolerance,
+        proximity=False):
+    """
+    Computes the overlap (or proximity) of all pairs of axon (a) and
+    dendrite (d) cylinders that are within overlap_cutoff(sig, tolerance)
+
+    Yields (i, j, v) arrays where i are axon cylinder indices, j are
+    dendrite cylinder indices and v is the cylinder_overlap_v
+    (or cylinder_proximity_v) for each pair
+    """
+    for (i, j, v, m) in _overlap_blocks(
+            ra, na, la, rd, nd, ld, sig, tolerance, proximity):
+        if m is None:
+            pi, pj = numpy.indices(v.shape)
+            pi, pj = pi.ravel(), pj.ravel()
+        else:
+            pi, pj = numpy.nonzero(m)
+            if len(pi) == 0:
+                continue
+        yield i[pi], j[pj], v[pi, pj]
 
-    # precompute cylinders
-    if g2 is None:
-        dendrites = neuron_d.dendrites
-    else:
-        dendrites = g2
-    # get edges
-    ra, na, la = edge_to_cylinder_v(
-        *get_edge_array(neuron_a, axon.edges_iter()))
-    rd, nd, ld = edge_to_cylinder_v(
-        *get_edge_array(neuron_d, dendrites.edges_iter()))
 
+def overlap_total(
+        ra, na, la, rd, nd, ld, sig=10000., tolerance=default_tolerance,
+        proximity=False):
+    """Sum of the overlap (or proximity) of all axon and dendrite
+    cylinder pairs, see overlap_pairs"""
     total = 0.
-    for i in xrange(len(la)):
-        total += numpy.sum(cylinder_proximity_v(
-            ra[i, numpy.newaxis], na[i, numpy.newaxis], la[i, numpy.newaxis],
-            rd, nd, ld, sig=sig))
-    return total * 2. * s
+    for (_, _, v, m) in _overlap_blocks(
+            ra, na, la, rd, nd, ld, sig, tolerance, proximity):
+        total += v.sum() if m is None else v[m].sum()
+    return total
+
+
+def neuron_cylinders(neuron, graph):
+    """Returns (r, n, l) cylinders for the edges of graph (on neuron),
+    0 length edges are dropped"""
+    edges = list(graph.edges())
+    if len(edges) == 0:
+        return numpy.zeros((0, 3)), numpy.zeros((0, 3)), numpy.zeros(0)
+    c = edge_to_cylinder_v(*get_edge_array(neuron, edges))
+    if len(c[2]) != len(edges):
+        logging.error("Skipping {} bad (0 length) edges on {}".format(
+            len(edges) - len(c[2]), neuron))
+    return c
+
+
+def neuron_axon(neuron):
+    """Returns the tree of the only axon of neuron, raises an Exception
+    if the neuron does not have exactly 1 axon"""
+    axon = neuron.axons
+    if len(axon) != 1:
+        msg = "axon skeleton {} has != 1 [{}] axon".format(
+            neuron.name, len(axon))
+        logging.critical(msg)
+        raise Exception(msg)
+    return axon[axon.keys()[0]]['tree']
 
 
-def skeleton_overlap_v(
-        neuron_a, neuron_d, s=1000., sig=10000., g1=None, g2=None):
-    # 1706 seconds
-    # passing instance of neurons
-    # if isinstance(fn_a, catmaid.Neuron):
-        # sk_a = fn_a
-    # else:
-        # sk_a = catmaid.Neuron(json.load(open(fn_a, 'r')))
-    # if isinstance(fn_a, catmaid.Neuron):
-        # sk_d = fn_d
-    # else:
-        # sk_d = catmaid.Neuron(json.load(open(fn_d, 'r')))
+def _axon_and_dendrite_cylinders(neuron_a, neuron_d, g1=None, g2=None):
+    """Returns (ra, na, la), (rd, nd, ld) cylinders for the axon of
+    neuron_a (or g1) and the dendrites of neuron_d (or g2)"""
     if g1 is None:
-        axon = neuron_a.axons
-        if len(axon) != 1:
-            msg = "axon skeleton {} has != 1 [{}] axon".format(
-                neuron_a.name, len(axon))
-            logging.critical(msg)
-            raise Exception(msg)
-        axon = axon[axon.keys()[0]]['tree']
-    else:
-        axon = g1
-
-    # precompute cylinders
+        g1 = neuron_axon(neuron_a)
     if g2 is None:
-        dendrites = neuron_d.dendrites
+        g2 = neuron_d.dendrites
+    return neuron_cylinders(neuron_a, g1), neuron_cylinders(neuron_d, g2)
+
+
+def skeleton_overlap_v_verbose(
+        neuron_a, neuron_d, s=1000., sig=10000., g1=None, g2=None,
+        ordered_by='axon', op=numpy.sum, output=None,
+        tolerance=default_tolerance):
+    """
+    Per cylinder overlap of the axon of neuron_a and dendrites of neuron_d
+
+    For each axon (or dendrite if ordered_by='dendrite') cylinder, op is
+    applied to the overlap with all dendrite (or axon) cylinders within
+    overlap_cutoff(sig, tolerance). If no cylinder is within the cutoff
+    op is applied to [0.]
+    """
+    if output is None:
+        output = {'midpoint': True}
+    (ra, na, la), (rd, nd, ld) = _axon_and_dendrite_cylinders(
+        neuron_a, neuron_d, g1, g2)
+    if ordered_by == 'axon':
+        r, n, l = ra, na, la
+        key = 0
+    elif ordered_by == 'dendrite':
+        r, n, l = rd, nd, ld
+        key = 1
     else:
-        dendrites = g2
-    # get edges
-    ra, na, la = edge_to_cylinder_v(
-        *get_edge_array(neuron_a, axon.edges_iter()))
-    rd, nd, ld = edge_to_cylinder_v(
-        *get_edge_array(neuron_d, dendrites.edges_iter()))
+        return []
+    pairs = [(
+        p[key], 2. * s * p[2]) for p in overlap_pairs(
+            ra, na, la, rd, nd, ld, sig=sig, tolerance=tolerance)]
+    if len(pairs):
+        ids = numpy.hstack([p[0] for p in pairs])
+        vs = numpy.hstack([p[1] for p in pairs])
+    else:
+        ids = numpy.zeros(0, dtype='i8')
+        vs = numpy.zeros(0)
+    if op is numpy.sum:
+        rs = numpy.bincount(ids, weights=vs, minlength=len(l))
+    else:
+        order = numpy.argsort(ids, kind='mergesort')
+        bounds = numpy.searchsorted(ids[order], numpy.arange(len(l) + 1))
+        vs = vs[order]
+        rs = []
+        for i in xrange(len(l)):
+            v = vs[bounds[i]:bounds[i + 1]]
+            if len(v) == 0:
+                v = numpy.zeros(1)
+            rs.append(op(v))
+
+    totals = []
+    for i in xrange(len(l)):
+        t = []
+        if output.get('midpoint', False):
+            t.extend(r[i])
+        if isinstance(rs[i], (tuple, list)):
+            t.extend(list(rs[i]))
+        else:
+            t.append(rs[i])
+        if output.get('normal', False):
+            t.extend(n[i])
+        if output.get('length', False):
+            t.append(l[i])
+        totals.append(t)
+    return totals
+
+
+def skeleton_proximity_v(
+        neuron_a, neuron_d, s=1000., sig=10000., g1=None, g2=None,
+        tolerance=default_tolerance):
+    (ra, na, la), (rd, nd, ld) = _axon_and_dendrite_cylinders(
+        neuron_a, neuron_d, g1, g2)
+    return overlap_total(
+        ra, na, la, rd, nd, ld, sig=sig, tolerance=tolerance,
+        proximity=True) * 2. * s
 
-    total = 0.
-    for i in xrange(len(la)):
-        total += numpy.sum(cylinder_overlap_v(
-            ra[i, numpy.newaxis], na[i, numpy.newaxis], la[i, numpy.newaxis],
-            rd, nd, ld, sig=sig))
-    return total * 2. * s
-    # iterate over sk.dgraph.edges_iter
-    total = 0.
-    #n = len(axon.edges()) * 0.01
-    #i = 0
-    for _, _, a in axon.edges_iter(data=True):
-        #i += 1
-        if not a['valid']:
-            continue
-        for _, _, d in dendrites.edges_iter(data=True):  # 13.9%
-            if not d['valid']:
-                continue
-            total += cylinder_overlap(a, d, sig=sig)  # 82.7%
-
-    return total * 2. * s
-
-
-def skeleton_overlap(neuron_a, neuron_d, s=1000., sig=10000.):
-    # 1706 seconds
-    # passing instance of neurons
-    # if isinstance(fn_a, catmaid.Neuron):
-        # sk_a = fn_a
-    # else:
-        # sk_a = catmaid.Neuron(json.load(open(fn_a, 'r')))
-    # if isinstance(fn_a, catmaid.Neuron):
-        # sk_d = fn_d
-    # else:
-        # sk_d = catmaid.Neuron(json.load(open(fn_d, 'r')))
-    axon = neuron_a.axons
-    if len(axon) != 1:
-        msg = "axon skeleton {} has != 1 [{}] axon".format(
-            neuron_a.name, len(axon))
-        logging.critical(msg)
-        raise Exception(msg)
-    axon = axon[axon.keys()[0]]['tree']
-
-    # precompute cylinders
-    dendrites = neuron_d.dendrites
-    for (nron, g) in ((neuron_a, axon), (neuron_d, dendrites)):
-        for u, v, d in g.edges_iter(data=True):
-            try:
-                d['r'], d['n'], d['l'] = edge_to_cylinder(
-                    nron.skeleton['vertices'][u], nron.skeleton['vertices'][v])
-                d['valid'] = True
-            except EdgeError as e:
-                logging.error("Bad edge: {} -> {} on {}, Error: {}".format(
-                    u, v, nron, e))
-                d['valid'] = False
-
-    # iterate over sk.dgraph.edges_iter
-    total = 0.
-    #n = len(axon.edges()) * 0.01
-    #i = 0
-    for _, _, a in axon.edges_iter(data=True):
-        #i += 1
-        if not a['valid']:
-            continue
-        for _, _, d in dendrites.edges_iter(data=True):  # 13.9%
-            if not d['valid']:
-                continue
-            total += cylinder_overlap(a, d, sig=sig)  # 82.7%
 
-    return total * 2. * s
+def skeleton_overlap_v(
+        neuron_a, neuron_d, s=1000., sig=10000., g1=None, g2=None,
+        tolerance=default_tolerance):
+    (ra, na, la), (rd, nd, ld) = _axon_and_dendrite_cylinders(
+        neuron_a, neuron_d, g1, g2)
+    return overlap_total(
+        ra, na, la, rd, nd, ld, sig=sig, tolerance=tolerance) * 2. * s
+
+
+def skeleton_overlap(
+        neuron_a, neuron_d, s=1000., sig=10000.,
+        tolerance=default_tolerance):
+    total = skeleton_overlap_v(
+        neuron_a, neuron_d, s=s, sig=sig, tolerance=tolerance)
+    if numpy.isnan(total):
+        logging.critical("skeleton_overlap = nan, {}, {}".format(
+            neuron_a, neuron_d))
+        raise Exception("skeleton_overlap = nan, {}, {}".format(
+            neuron_a, neuron_d))
+    return total
 
 
 def test():
@@ -438,3 +502,166 @@ def overlap_list(source, skList):
         except Exception as e:
             overlap_dict[(sk_d, sk_a)] = ov_b
     return overlap_dict
+
+
+def population_cylinders(source, sk_list):
+    """
+    Loads each skeleton in sk_list once and concatenates the axon and
+    dendrite cylinders of all of them
+
+    Skeletons that do not have exactly 1 axon contribute no axon cylinders.
+    Returns (ra, na, la, ai), (rd, nd, ld, di) where ai and di are the
+    indices (in sk_list) of the skeleton each cylinder came from
+    """
+    axons = []
+    dendrites = []
+    for (index, sk) in enumerate(sk_list):
+        nron = source.get_neuron(sk)
+        if len(nron.axons) == 1:
+            axons.append((index, neuron_cylinders(nron, neuron_axon(nron))))
+        else:
+            logging.warning("Skipping axons of {}, has {} != 1 axon".format(
+                sk, len(nron.axons)))
+        dendrites.append((index, neuron_cylinders(nron, nron.dendrites)))
+    arrays = []
+    for cylinders in (axons, dendrites):
+        if len(cylinders) == 0:
+            arrays.append((
+                numpy.zeros((0, 3)), numpy.zeros((0, 3)), numpy.zeros(0),
+                numpy.zeros(0, dtype='i8')))
+            continue
+        arrays.append((
+            numpy.vstack([c[1][0] for c in cylinders]),
+            numpy.vstack([c[1][1] for c in cylinders]),
+            numpy.hstack([c[1][2] for c in cylinders]),
+            numpy.hstack([
+                numpy.ones(len(c[1][2]), dtype='i8') * c[0]
+                for c in cylinders])))
+    return arrays
+
+
+def _overlap_matrix_chunk(args):
+    """Overlap of the axon cylinders in blocks with all dendrite cylinders
+    accumulated into a sparse (skeleton x skeleton) matrix"""
+    index, blocks = args
+    st = batch.state()
+    n = st['n']
+    (ra, na, la, ai), (rd, nd, ld, di) = st['axons'], st['dendrites']
+    if 'dtree' not in st and not numpy.isinf(st['cutoff']):
+        st['dtree'] = cKDTree(rd)
+    keys = []
+    values = []
+    for (i, j, v, m) in _overlap_blocks(
+            ra, na, la, rd, nd, ld, sig=st['sig'],
+            tolerance=st['tolerance'], blocks=blocks,
+            dtree=st.get('dtree', None)):
+        # skip self overlap
+        same = ai[i][:, numpy.newaxis] == di[j][numpy.newaxis, :]
+        if m is None:
+            m = ~same
+        else:
+            m &= ~same
+        pi, pj = numpy.nonzero(m)
+        if len(pi) == 0:
+            continue
+        # reduce each block to 1 value per skeleton pair
+        k, inv = numpy.unique(
+            ai[i[pi]] * n + di[j[pj]], return_inverse=True)
+        keys.append(k)
+        values.append(numpy.bincount(inv, weights=v[pi, pj]))
+    if len(keys) == 0:
+        return index, scipy.sparse.csr_matrix((n, n))
+    keys = numpy.hstack(keys)
+    return index, scipy.sparse.coo_matrix(
+        (numpy.hstack(values), (keys // n, keys % n)), shape=(n, n)).tocsr()
+
+
+def _checkpoint_chunk_filename(checkpoint_dir, index):
+    return os.path.join(checkpoint_dir, 'chunk_{:06d}.npz'.format(index))
+
+
+def _save_checkpoint_chunk(checkpoint_dir, index, m):
+    """Save a chunk result to a temporary file and rename it into place
+    so an interrupted write never leaves a truncated chunk"""
+    fn = _checkpoint_chunk_filename(checkpoint_dir, index)
+    tmp = fn + '.tmp'
+    with open(tmp, 'wb') as f:
+        scipy.sparse.save_npz(f, m)
+    os.rename(tmp, fn)
+
+
+def _check_checkpoint(checkpoint_dir, params):
+    """Make sure a checkpoint directory was written with the same params"""
+    if not os.path.exists(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    fn = os.path.join(checkpoint_dir, 'params.json')
+    if os.path.exists(fn):
+        with open(fn, 'r') as f:
+            saved = json.load(f)
+        if saved != params:
+            raise ValueError(
+                "checkpoint {} was computed with different params".format(
+                    checkpoint_dir))
+    else:
+        with open(fn, 'w') as f:
+            json.dump(params, f)
+
+
+def overlap_matrix(
+        source, sk_list=None, s=1000., sig=10000.,
+        tolerance=default_tolerance, processes=None, chunk_size=64,
+        block_size=512, checkpoint_dir=None):
+    """
+    Computes skeleton_overlap for all (axon, dendrite) pairs of skeletons
+
+    Cylinders are extracted once per skeleton and all axon cylinders are
+    joined against all dendrite cylinders within
+    overlap_cutoff(sig, tolerance). Axon blocks (see axon_blocks) are
+    grouped into chunks of chunk_size blocks that are run in processes
+    worker processes (in this process if processes is None).
+
+    If checkpoint_dir is provided, the result of each chunk is saved there
+    and chunks that were already saved are not recomputed.
+
+    Returns a scipy.sparse.csr_matrix m where m[a, d] is the overlap of
+    the axon of sk_list[a] with the dendrites of sk_list[d]
+    """
+    if not has_scipy:
+        raise ImportError("overlap_matrix requires scipy")
+    if sk_list is None:
+        sk_list = source.skeleton_ids()
+    sk_list = list(sk_list)
+    n = len(sk_list)
+    axons, dendrites = population_cylinders(source, sk_list)
+    cutoff = overlap_cutoff(sig, tolerance)
+    blocks = axon_blocks(axons[0], cutoff, block_size)
+    chunks = [
+        (index, blocks[start:start + chunk_size]) for (index, start) in
+        enumerate(xrange(0, len(blocks), chunk_size))]
+
+    total = scipy.sparse.csr_matrix((n, n))
+    if checkpoint_dir is not None:
+        _check_checkpoint(checkpoint_dir, {
+            'sk_list': [str(sk) for sk in sk_list], 'sig': sig,
+            'tolerance': tolerance, 'chunk_size': chunk_size,
+            'block_size': block_size})
+        todo = []
+        for chunk in chunks:
+            fn = _checkpoint_chunk_filename(checkpoint_dir, chunk[0])
+            if os.path.exists(fn):
+                total = total + scipy.sparse.load_npz(fn)
+            else:
+                todo.append(chunk)
+        logging.info("{} of {} overlap chunks already computed".format(
+            len(chunks) - len(todo), len(chunks)))
+        chunks = todo
+
+    state = {
+        'axons': axons, 'dendrites': dendrites, 'n': n, 'sig': sig,
+        'tolerance': tolerance, 'cutoff': cutoff}
+    for (index, m) in batch.map_items(
+            _overlap_matrix_chunk, chunks, state, processes):
+        if checkpoint_dir is not None:
+            _save_checkpoint_chunk(checkpoint_dir, index, m)
+        total = total + m
+    return (total * 2. * s).tocsr()
@@ -4,6 +4,7 @@
 import logging
 
 import networkx
+import numpy
 
 
 def name(sk):
@@ -62,61 +63,115 @@ def synapses(sk):
     return syns
 
 
-def synapse_info(n):
-    """Get information for all synapses
+# one row per link between a skeleton node and a connector
+synapse_dtype = [
+    ('connector', 'i8'), ('node', 'i8'), ('type', 'S32'),
+    ('connector_x', 'f8'), ('connector_y', 'f8'), ('connector_z', 'f8'),
+    ('x', 'f8'), ('y', 'f8'), ('z', 'f8')]
+
+
+def synapse_table(n):
+    """Get a table (synapse_dtype array) of all synapse links built in
+    one pass over the connectivity
     """
-    sinfo = {}
     connectors = n.connectors
     edges = n.skeleton['connectivity']
     verts = n.skeleton['vertices']
+    rows = []
     for cid in edges:
         for pid in edges[cid]:
             if pid in connectors:
                 # this is an edge from this neuron to a connector
                 # this is either a pre or postsynaptic link
-                if pid not in sinfo:
-                    sinfo[pid] = []
-                if cid in [s['vertex_id'] for s in sinfo[pid]]:
-                    print(
-                        "Duplicate link between vertex %s and conn %s"
-                        % (cid, pid))
-                    print("Skipping this as it is a tracing error")
-                    print("\ttype: %s" % edges[cid][pid]['type'])
-                    raise Exception()
-                else:
-                    sinfo[pid].append({
-                        'connector': connectors[pid],
-                        'connector_id': pid,
-                        'vertex': verts[cid],
-                        'vertex_id': cid,
-                        #'edge': edges[cid][pid],
-                        'type': edges[cid][pid]['type'],
-                    })
+                c = connectors[pid]
+                v = verts[cid]
+                rows.append((
+                    int(pid), int(cid), edges[cid][pid]['type'],
+                    c['x'], c['y'], c['z'], v['x'], v['y'], v['z']))
+    return numpy.array(rows, dtype=synapse_dtype)
+
+
+def synapse_info(n):
+    """Get information for all synapses
+
+    A dict view of the synapse_table:
+        {connector_id: [{'connector', 'connector_id', 'vertex',
+                         'vertex_id', 'type'}, ...]}
+    """
+    sinfo = {}
+    table = n.synapse_table
+    if len(table) == 0:
+        return sinfo
+    verts = n.skeleton['vertices']
+    # the table stores ints, convert back to the type of the vertex keys
+    key = type(next(iter(verts)))
+    for (pid, cid, t) in zip(
+            table['connector'].tolist(), table['node'].tolist(),
+            table['type']):
+        pid = key(pid)
+        cid = key(cid)
+        sinfo.setdefault(pid, []).append({
+            'connector': verts[pid],
+            'connector_id': pid,
+            'vertex': verts[cid],
+            'vertex_id': cid,
+            'type': str(t),
+        })
     return sinfo
 
 
 def input_synapses(n):
-    inputs = []
-    syns = n.synapse_info
-    for si in syns:
-        for syn in syns[si]:
-            if syn['type'] == 'postsynaptic_to':
-                inputs.append(syn)
-        #if syns[si]['type'] == 'presynaptic_to':
-        #    inputs[si] = syns[si].copy()
-    return inputs
+    return [
+        syn for syns in n.synapse_info.values() for syn in syns
+        if syn['type'] == 'postsynaptic_to']
 
 
 def output_synapses(n):
-    outputs = []
-    syns = n.synapse_info
-    for si in syns:
-        for syn in syns[si]:
-            if syn['type'] == 'presynaptic_to':
-                outputs.append(syn)
-        #if syns[si]['type'] == 'postsynaptic_to':
-        #    outputs[si] = syns[si].copy()
-    return outputs
+    return [
+        syn for syns in n.synapse_info.values() for syn in syns
+        if syn['type'] == 'presynaptic_to']
+
+
+# keys that axons and projections add to node vertices
+_derived_vertex_keys = ('tree', 'terminals', 'trunk')
+
+
+def node_ids(n):
+    """Ids of all skeleton nodes sorted by (numeric) id"""
+    return sorted(n.nodes, key=int)
+
+
+def node_coordinates(n):
+    """Array (nodes x 3) of the node positions in node_ids order"""
+    nodes = n.nodes
+    return numpy.array(
+        [(nodes[nid]['x'], nodes[nid]['y'], nodes[nid]['z'])
+         for nid in n.node_ids], dtype='f8').reshape((-1, 3))
+
+
+def with_coordinates(n, coordinates):
+    """Get a skeleton with the node positions set to coordinates
+    (nodes x 3, in node_ids order)
+
+    Connectors and connectivity are shared with the skeleton of n
+    """
+    coordinates = numpy.asarray(coordinates, dtype='f8')
+    if coordinates.shape != (len(n.node_ids), 3):
+        raise ValueError(
+            "coordinates shape {} does not match the {} nodes of {}".format(
+                coordinates.shape, len(n.node_ids), n.skeleton_id))
+    sk = dict(n.skeleton)
+    verts = dict(sk['vertices'])
+    for (nid, (x, y, z)) in zip(n.node_ids, coordinates.tolist()):
+        v = dict([
+            (k, verts[nid][k]) for k in verts[nid]
+            if k not in _derived_vertex_keys])
+        v['x'] = x
+        v['y'] = y
+        v['z'] = z
+        verts[nid] = v
+    sk['vertices'] = verts
+    return sk
 
 
 def dedges(sk):
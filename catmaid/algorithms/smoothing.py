@@ -7,18 +7,27 @@ smooth all neurons in  a file source
 special requirements:
 pykalman
 
+Bifurcations with more than 2 neurites are moved to the closest point of
+the lines fit to their neurites (see newbifurcs) before the neurites are
+smoothed. Before neurites were collected at both of their ends no
+bifurcation reached 3 lines and none were moved, so kalman (and gaussian)
+results differ from those made before that fix at every such bifurcation
+and along the neurites starting there.
+
 """
 
 # TODO:
 #     Test for convergence for iterations
 
 import argparse
+import copy
 import pykalman
 import numpy
 import networkx
 import catmaid
-from catmaid.algorithms.morphology import node_array, node_position, unique_neurites, gaussian_smooth_neuron
-from catmaid.algorithms.skeleton_json_new_to_old import convert_new_to_old
+from catmaid.algorithms import batch
+from catmaid.algorithms.morphology import (
+    node_array, unique_neurites, gaussian_smooth_neuron)
 import json
 import os
 import sys
@@ -28,6 +37,21 @@ import multiprocessing as mp
 
 outdir = '../../data/skeletons_smooth'
 
+# smoothing variants by name: (method, use_missing, fix_applicate)
+# results of a variant are saved in <outdir>/skeletons_smooth_<name>/
+smoothing_variants = {
+    'kalman_unmasked_fixed': ('kalman', False, True),
+    'kalman_unmasked_not_fixed': ('kalman', False, False),
+    'kalman_masked_fixed': ('kalman', True, True),
+    'kalman_masked_not_fixed': ('kalman', True, False),
+    'gaussian_fixed': ('gaussian', None, True),
+    'gaussian_not_fixed': ('gaussian', None, False),
+}
+default_variants = (
+    'kalman_unmasked_fixed', 'kalman_unmasked_not_fixed',
+    'kalman_masked_fixed', 'kalman_masked_not_fixed',
+    'gaussian_fixed', 'gaussian_not_fixed')
+
 
 def smoothKalman(arr, initstate=None, its=4):
     '''
@@ -58,15 +82,139 @@ def mask_missing(arr, zres=60.):
         outputs an array with masked values for kalman filtering
     '''
     zdiff = numpy.diff(arr[:, 2])/zres
-    arggaps = sorted([i[0] for i in numpy.argwhere(zdiff > 1)])
-    added = 1
-    for arggap in arggaps:
-        missing_measurements = int(zdiff[arggap])
-        meas = numpy.empty([missing_measurements, 3]) * numpy.NaN
-        arr = numpy.insert(arr, arggap + int(added), meas, 0)
-        added += missing_measurements
-    marr = numpy.ma.masked_invalid(arr)
-    return marr
+    # number of masked measurements inserted after each measurement
+    missing = numpy.zeros(len(arr), dtype='i8')
+    gaps = zdiff > 1
+    missing[:-1][gaps] = zdiff[gaps].astype('i8')
+    marr = numpy.empty((len(arr) + missing.sum(), 3))
+    marr[:] = numpy.NaN
+    marr[numpy.arange(len(arr)) + numpy.cumsum(missing) - missing] = arr
+    return numpy.ma.masked_invalid(marr)
+
+
+def kalman_parameters(kf):
+    '''
+    Returns the parameters of a fitted pykalman.KalmanFilter that are
+        shared by all neurites (see fit_kalman and rts_smooth)
+    '''
+    return {
+        'transition_matrices': kf.transition_matrices,
+        'transition_offsets': kf.transition_offsets,
+        'transition_covariance': kf.transition_covariance,
+        'observation_matrices': kf.observation_matrices,
+        'observation_offsets': kf.observation_offsets,
+        'observation_covariance': kf.observation_covariance,
+        'initial_state_covariance': kf.initial_state_covariance,
+    }
+
+
+def fit_kalman(arrs, its=4, max_points=2000):
+    '''
+    Estimates kalman filter parameters once for many (masked) arrays
+        (for example all neurites of a neuron or of a dataset).
+    The longest arrays (up to max_points measurements, None for all) are
+        joined into one sequence, each translated to start at the end of
+        the previous one so no jumps are introduced, and the parameters
+        are estimated with its EM iterations.
+    Returns parameters for rts_smooth (see kalman_parameters)
+    '''
+    parts = []
+    end = None
+    total = 0
+    for arr in sorted(arrs, key=len, reverse=True):
+        if max_points is not None and total >= max_points:
+            break
+        arr = numpy.ma.masked_invalid(arr)
+        if max_points is not None:
+            arr = arr[:max_points - total]
+        if end is not None:
+            arr = arr - (arr[0] - end)
+        parts.append(arr)
+        end = arr[-1]
+        total += len(arr)
+    joined = numpy.ma.concatenate(parts)
+    kf = pykalman.KalmanFilter(initial_state_mean=joined[0].data,
+                               n_dim_obs=3,
+                               n_dim_state=3)
+    kf = kf.em(joined, n_iter=its, em_vars='all')
+    return kalman_parameters(kf)
+
+
+def _rts_batch(obs, observed, initstates, params):
+    '''
+    Kalman filter and RTS smoother for a batch of sequences
+        obs: observations (batch x time x 3), observed: (batch x time) mask
+        of observations to use, initstates: (batch x 3) initial states
+    Returns the smoothed state means (batch x time x 3)
+    '''
+    A = params['transition_matrices']
+    b = params['transition_offsets']
+    Q = params['transition_covariance']
+    C = params['observation_matrices']
+    d = params['observation_offsets']
+    R = params['observation_covariance']
+    nb, nt = obs.shape[:2]
+    pmeans = numpy.empty((nb, nt, 3))
+    pcovs = numpy.empty((nb, nt, 3, 3))
+    fmeans = numpy.empty((nb, nt, 3))
+    fcovs = numpy.empty((nb, nt, 3, 3))
+    for t in xrange(nt):
+        if t == 0:
+            pmeans[:, 0] = initstates
+            pcovs[:, 0] = params['initial_state_covariance']
+        else:
+            pmeans[:, t] = numpy.dot(fmeans[:, t - 1], A.T) + b
+            pcovs[:, t] = numpy.matmul(
+                numpy.matmul(A, fcovs[:, t - 1]), A.T) + Q
+        fmeans[:, t] = pmeans[:, t]
+        fcovs[:, t] = pcovs[:, t]
+        m = observed[:, t]
+        if not numpy.any(m):
+            continue
+        P = pcovs[m, t]
+        PCt = numpy.matmul(P, C.T)
+        S = numpy.matmul(C, PCt) + R
+        K = numpy.matmul(PCt, numpy.linalg.pinv(S))
+        r = obs[m, t] - (numpy.dot(pmeans[m, t], C.T) + d)
+        fmeans[m, t] = pmeans[m, t] + numpy.einsum('bij,bj->bi', K, r)
+        fcovs[m, t] = P - numpy.matmul(K, numpy.matmul(C, P))
+    smeans = numpy.empty((nb, nt, 3))
+    smeans[:, -1] = fmeans[:, -1]
+    for t in xrange(nt - 2, -1, -1):
+        J = numpy.matmul(
+            numpy.matmul(fcovs[:, t], A.T), numpy.linalg.pinv(pcovs[:, t + 1]))
+        smeans[:, t] = fmeans[:, t] + numpy.einsum(
+            'bij,bj->bi', J, smeans[:, t + 1] - pmeans[:, t + 1])
+    return smeans
+
+
+def rts_smooth(arrs, params, batch_size=256):
+    '''
+    Kalman (RTS) smoothing of many (masked) arrays with shared parameters
+        (see fit_kalman). Arrays are sorted by length and smoothed in
+        batches of batch_size, shorter arrays in a batch are padded with
+        masked measurements at the end (which does not change their
+        smoothed states). The initial state of each array is its first
+        measurement.
+    Returns a list of smoothed state means (one array per input array)
+    '''
+    arrs = [numpy.ma.masked_invalid(arr) for arr in arrs]
+    order = sorted(xrange(len(arrs)), key=lambda i: len(arrs[i]))
+    states = [None] * len(arrs)
+    for start in xrange(0, len(order), batch_size):
+        batch = order[start:start + batch_size]
+        nt = len(arrs[batch[-1]])
+        obs = numpy.zeros((len(batch), nt, 3))
+        observed = numpy.zeros((len(batch), nt), dtype=bool)
+        for (i, ai) in enumerate(batch):
+            arr = arrs[ai]
+            obs[i, :len(arr)] = arr.filled(0.)
+            observed[i, :len(arr)] = ~numpy.any(
+                numpy.ma.getmaskarray(arr), axis=1)
+        smeans = _rts_batch(obs, observed, obs[:, 0], params)
+        for (i, ai) in enumerate(batch):
+            states[ai] = smeans[i, :len(arrs[ai])]
+    return states
 
 
 def array_pathlength(arr):
@@ -74,8 +222,22 @@ def array_pathlength(arr):
                 for obsidx, obs in enumerate(arr[1:])])
 
 
+def _check_smoothed(trace, states, fix_applicate=False, QC='noQC'):
+    if fix_applicate:
+        states[:, 2] = trace[:, 2]
+    if QC == 'strictLT':
+        if (array_pathlength(states) >= array_pathlength(trace)):
+            logging.debug('found neurite with {} nodes which '
+                          'was smoothed unsuccessfully.'.format(len(trace)))
+            return trace
+        else:
+            return states
+    else:
+        return states
+
+
 def smooth_tracing(trace, zres=None, firstpos=None, use_missing=True,
-                   fix_applicate=False, QC='noQC'):
+                   fix_applicate=False, QC='noQC', its=4):
     '''
     This function takes an arbitrary list of 3d points and inserts
         masked states (missing measurements) until all states are sequential.
@@ -88,85 +250,117 @@ def smooth_tracing(trace, zres=None, firstpos=None, use_missing=True,
                       and added to smoothing results
         fix_applicate = a flag used to have the z axis fixed during smoothing
         QC = a quality control metric ['noQC', 'strictLT']
+        its = the number of EM iterations used to fit the kalman filter
     '''
-    zs = trace[:, 2].copy()
-    arr = mask_missing(trace) if use_missing else trace
-    states = smoothKalman(arr, initstate=firstpos)[0]
+    trace = trace.copy()
+    if use_missing:
+        arr = mask_missing(trace) if zres is None else mask_missing(
+            trace, zres)
+    else:
+        arr = trace
+    states = smoothKalman(arr, initstate=firstpos, its=its)[0]
     states = states[~arr.mask[:, 0]] if use_missing else states
-    if fix_applicate:
-        states[:, 2] = zs
-    if QC == 'strictLT':
-        if (array_pathlength(states) >= array_pathlength(trace)):
-            logging.debug('found neurite with {} nodes which '
-                          'was smoothed unsuccessfully.'.format(len(trace)))
-            return trace
+    return _check_smoothed(trace, states, fix_applicate, QC)
+
+
+def smooth_tracings(traces, zres=None, use_missing=True, fix_applicate=False,
+                    QC='noQC', params=None, its=4, batch_size=256):
+    '''
+    Smooths many traces (see smooth_tracing) with one set of kalman
+        filter parameters. If params is None they are estimated once
+        for all traces (see fit_kalman) instead of once per trace.
+    Returns a list of numpy arrays of the smoothed traces
+    '''
+    if len(traces) == 0:
+        return []
+    arrs = []
+    for trace in traces:
+        if use_missing:
+            arrs.append(mask_missing(trace) if zres is None else mask_missing(
+                trace, zres))
         else:
-            return states
-    else:
-        return states
+            arrs.append(numpy.ma.masked_invalid(trace))
+    if params is None:
+        params = fit_kalman(arrs, its=its)
+    smoothed = []
+    for (trace, arr, states) in zip(
+            traces, arrs, rts_smooth(arrs, params, batch_size)):
+        if use_missing:
+            states = states[~numpy.ma.getmaskarray(arr)[:, 0]]
+        smoothed.append(_check_smoothed(
+            trace.copy(), states, fix_applicate, QC))
+    return smoothed
 
 
-# TODO this does not need to generate a skeleton so explicitly....
 def updateNodePosition(neu, posdict):
-    nodelist, connectors = [], []
-    for nid in neu.nodes.keys():
-        try:
-            p = neu.dedges[nid]
-            assert len(p) == 1
-            p = p[0]
-        except:
-            p = None
-        r = neu.nodes[nid]['radius']
-        c = neu.nodes[nid]['confidence']
-        ct, et = None, None  # We don't use Edition/creation times
-        if nid in posdict.keys():
-            x, y, z = posdict[nid].flatten()
-        else:
-            x = neu.nodes[nid]['x']
-            y = neu.nodes[nid]['y']
-            z = neu.nodes[nid]['z']
-        nodelist.append([nid, p, None, x, y, z, r, c, ct, et])
-    connectors = []
-    for stid in neu.skeleton['connectivity'].keys():
-        for cid in neu.skeleton['connectivity'][stid].keys():
-            t = neu.skeleton['connectivity'][stid][cid]['type']
-            if not (t == 'neurite'):
-                post = (t == 'postsynaptic_to')
-                x = neu.skeleton['vertices'][cid]['x']
-                y = neu.skeleton['vertices'][cid]['y']
-                z = neu.skeleton['vertices'][cid]['z']
-                ct = None
-                connectors.append([stid, cid, post, x, y, z, ct])
-
-    sk = [neu.name, nodelist, neu.tags, connectors, None,
-          neu.skeleton_id, neu.skeleton['neuron']['id'], neu.annotations]
-    skel = convert_new_to_old(sk)
-    return catmaid.neuron.Neuron(skel)
+    '''
+    Returns a new neuron (see Neuron.with_coordinates) with the positions
+        of the nodes in posdict {nid: position} updated
+    '''
+    coordinates = neu.node_coordinates.copy()
+    index = {nid: i for (i, nid) in enumerate(neu.node_ids)}
+    for nid in posdict:
+        coordinates[index[nid]] = numpy.ravel(posdict[nid])
+    return neu.with_coordinates(coordinates)
 
 
 def newbifurcs(neu, neurites, maxpts=8, minpts=3):
-    bifpos = {}
-    bifneurites = {neurite[0]: [] for neurite in neurites}
-    bifneurites.update({neurite[-1]: [] for neurite in neurites})
+    '''
+    Re-estimates the xy position of each bifurcation as the closest point
+        to the lines fit (see defline) to the first points of the neurites
+        that start or end at it (only for bifurcations with > 2 lines).
+    All lines are fit at once from the principal axes of their stacked
+        points and all bifurcations are solved (see lineintersect3D) in
+        one batch.
+    Returns a dict of positions for the first and last node of each neurite
+    (unmoved for bifurcations with <= 2 lines and for leaves)
+
+    Note: before neurites were collected at both ends no bifurcation was
+    ever moved, smoothed skeletons made before then differ near branches.
+    '''
+    index = {nid: i for (i, nid) in enumerate(neu.node_ids)}
+    coordinates = neu.node_coordinates
+    ends = sorted(set(
+        [neurite[0] for neurite in neurites] +
+        [neurite[-1] for neurite in neurites]), key=index.get)
+    bifpos = {bif: coordinates[index[bif]].copy() for bif in ends}
+    # the first nopts nodes of each neurite, from both of its ends
+    npts = maxpts - 1
+    lines = []
+    bifs = []
     for neurite in neurites:
-        if neurite[-1] in bifneurites.keys():
-            bifneurites[neurite[-1]].append(neurite[::-1])
-        elif neurite[0] in bifneurites.keys():
-            bifneurites[neurite[0]].append(neurite)
-    for bif in bifneurites.keys():
-        bifpos[bif] = node_position(neu.nodes[bif])
-        startpts, endpts = [], []
-        for nrt in bifneurites[bif]:
-            if len(nrt) > minpts:
-                nopts = min((maxpts-1), len(nrt))
-                lnst, lnend = defline(node_array(neu, nrt[:nopts]))
-                startpts.append(lnst)
-                endpts.append(lnend)
-        # fewer trivial solutions
-        if len(startpts) > 2:
-            startpts = numpy.vstack(startpts)
-            endpts = numpy.vstack(endpts)
-            bifpos[bif][:2] = lineintersect3D(startpts, endpts)[:2]
+        if len(neurite) <= minpts:
+            continue
+        for nrt in (neurite, neurite[::-1]):
+            nodes = [index[nid] for nid in nrt[:npts]]
+            lines.append(nodes + [-1] * (npts - len(nodes)))
+            bifs.append(nrt[0])
+    if len(lines) == 0:
+        return bifpos
+    lines = numpy.array(lines)
+    valid = lines >= 0
+    points = coordinates[lines] * valid[:, :, numpy.newaxis]
+    means = points.sum(axis=1) / valid.sum(axis=1)[:, numpy.newaxis]
+    centered = (points - means[:, numpy.newaxis]) * \
+        valid[:, :, numpy.newaxis]
+    # principal axis of each line (as in defline)
+    directions = numpy.linalg.eigh(
+        numpy.einsum('lki,lkj->lij', centered, centered))[1][:, :, -1]
+    # sum (n n^T - I) over the lines of each bifurcation (lineintersect3D)
+    bif_index = {bif: i for (i, bif) in enumerate(ends)}
+    lb = numpy.array([bif_index[bif] for bif in bifs])
+    M = numpy.einsum('li,lj->lij', directions, directions) - numpy.eye(3)
+    S = numpy.zeros((len(ends), 3, 3))
+    C = numpy.zeros((len(ends), 3))
+    numpy.add.at(S, lb, M)
+    numpy.add.at(C, lb, numpy.einsum('lij,lj->li', M, means))
+    # fewer trivial solutions
+    solve = numpy.bincount(lb, minlength=len(ends)) > 2
+    solve[solve] = numpy.abs(numpy.linalg.det(S[solve])) > 1e-9
+    if numpy.any(solve):
+        positions = numpy.linalg.solve(S[solve], C[solve][:, :, numpy.newaxis])
+        for (i, p) in zip(numpy.where(solve)[0], positions[:, :, 0]):
+            bifpos[ends[i]][:2] = p[:2]
     return bifpos
 
 
@@ -231,40 +425,105 @@ def smoothn_everything(args):
     ns, neuron, main_dir = args
     print "smoothign {}".format(neuron)
     sid = neuron.skeleton_id
-    # Smooth Kalman unmasked, applicate Fixing
-    ns.use_missing = False
-    ns.fix_applicate = True
-    fn = '{}/skeletons_smooth_kalman_unmasked_fixed/{}.json'.format(
-        main_dir, sid)
-    # need to set params here
-    ns.smoothtoFile(neuron, fn)
-    # Smooth Kalman unmasked, not fixed
-    ns.fix_applicate = False
-    fn = '{}/skeletons_smooth_kalman_unmasked_not_fixed/{}.json'.format(
-        main_dir, sid)
-    ns.smoothtoFile(neuron, fn)
-    ns.use_missing = True
-    ns.fix_applicate = True
-    # Smooth Kalman masked, applicate Fixing
-    fn = '{}/skeletons_smooth_kalman_masked_fixed/{}.json'.format(
-        main_dir, sid)
-    ns.smoothtoFile(neuron, fn)
-    # Smooth Kalman masked, not fixed
-    ns.fix_applicate = False
-    fn = '{}/skeletons_smooth_kalman_masked_not_fixed/{}.json'.format(
-        main_dir, sid)
-    ns.smoothtoFile(neuron, fn)
-    # Smooth with Gaussian
-    ns.fix_applicate = True
-    fn = '{}/skeletons_smooth_gaussian_fixed/{}.json'.format(main_dir, sid)
-    ns.smooth_gaussian(neuron, fn)
-    # Smooth with gaussian not fixed
-    ns.fix_applicate = False
-    fn = '{}/skeletons_smooth_gaussian_not_fixed/{}.json'.format(main_dir, sid)
-    ns.smooth_gaussian(neuron, fn)
+    for variant in default_variants:
+        smooth_variant(
+            ns, neuron, variant, variant_filename(main_dir, variant, sid))
     print "Successfully smoothed and saved {}".format(sid)
 
 
+def variant_filename(main_dir, variant, sid):
+    return os.path.join(
+        main_dir, 'skeletons_smooth_{}'.format(variant),
+        '{}.json'.format(sid))
+
+
+def smooth_variant(ns, neuron, variant, fn):
+    """Smooth neuron with a copy of NeuronSmoother ns configured for
+    variant (see smoothing_variants) and save the result to fn"""
+    method, use_missing, fix_applicate = smoothing_variants[variant]
+    ns = copy.copy(ns)
+    ns.fix_applicate = fix_applicate
+    if method == 'kalman':
+        ns.use_missing = use_missing
+        ns.smoothtoFile(neuron, fn)
+    else:
+        ns.smooth_gaussian(neuron, fn)
+
+
+def _write_skeleton(skeleton, fn):
+    # write to a temporary file first so an interrupted run never leaves
+    # a partial result that would be skipped on restart
+    tmp = fn + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(skeleton, f)
+    os.rename(tmp, fn)
+
+
+def _smooth_skeleton(sid):
+    """Load skeleton sid from the source and save all missing variants"""
+    st = batch.state()
+    done = []
+    try:
+        neuron = st['source'].get_neuron(sid)
+        for variant in st['variants']:
+            fn = variant_filename(st['outdir'], variant, sid)
+            if os.path.exists(fn):
+                continue
+            smooth_variant(st['smoother'], neuron, variant, fn)
+            done.append(variant)
+    except Exception as E:
+        logging.exception("Failed to smooth {}".format(sid))
+        return sid, done, repr(E)
+    return sid, done, None
+
+
+def smooth_source(
+        source, outdir, variants=None, smoother=None, sk_list=None,
+        processes=None):
+    """
+    Smooth all skeletons in sk_list (all in source if None) with each of
+    variants (see smoothing_variants, default_variants if None) saving
+    the results to outdir (see variant_filename)
+
+    Skeleton ids are sent to processes worker processes (run in this
+    process if processes is None) that load their neurons from source.
+    Results that already exist are skipped so an interrupted run can be
+    restarted.
+
+    Returns a dict of errors by skeleton id for skeletons that failed
+    """
+    if smoother is None:
+        smoother = NeuronSmoother(60.)
+    if variants is None:
+        variants = default_variants
+    for variant in variants:
+        if variant not in smoothing_variants:
+            raise ValueError("Unknown smoothing variant {}".format(variant))
+        vdir = os.path.dirname(variant_filename(outdir, variant, 0))
+        if not os.path.isdir(vdir):
+            os.makedirs(vdir)
+    if sk_list is None:
+        sk_list = source.skeleton_ids()
+    todo = [
+        sid for sid in sk_list if not all(
+            os.path.exists(variant_filename(outdir, variant, sid))
+            for variant in variants)]
+    logging.info("{} of {} skeletons already smoothed".format(
+        len(sk_list) - len(todo), len(sk_list)))
+
+    errors = {}
+    state = {
+        'source': source, 'outdir': outdir, 'variants': list(variants),
+        'smoother': smoother}
+    results = batch.map_items(_smooth_skeleton, todo, state, processes)
+    for (i, (sid, done, error)) in enumerate(results):
+        if error is not None:
+            errors[sid] = error
+        logging.info("Smoothed {} [{} of {}]: {}".format(
+            sid, i + 1, len(todo), ', '.join(done)))
+    return errors
+
+
 def directory(path):
     if not os.path.isdir(os.path.abspath(path)):
         err_msg = "path is not a directory (%s)"
@@ -274,10 +533,22 @@ def directory(path):
 
 class NeuronSmoother:
     # TODO replace "z" res with arbitrary dim
-    '''NeuronSmoother to handle kalman smoothing parameters'''
+    '''NeuronSmoother to handle kalman smoothing parameters
+
+    kalman_mode selects how kalman filter parameters are estimated:
+        'neurite': with EM for every neurite
+        'neuron': once per neuron, all neurites are smoothed in batches
+    kalman_params (see fit_kalman) are used for all neurons if provided
+    '''
     def __init__(self, zres, its=4, bifurc_interp_consider=(3, 8),
-                 use_missing=True, fix_applicate=False, QC='strictLT'):
+                 use_missing=True, fix_applicate=False, QC='strictLT',
+                 kalman_mode='neurite', kalman_params=None):
         self.iterations = its
+        if kalman_mode not in ('neurite', 'neuron'):
+            raise ValueError(
+                "Unknown kalman_mode {}".format(kalman_mode))
+        self.kalman_mode = kalman_mode
+        self.kalman_params = kalman_params
         self.zres = zres
         self.minbifurc = min(bifurc_interp_consider)
         self.maxbifurc = max(bifurc_interp_consider)
@@ -296,47 +567,63 @@ class NeuronSmoother:
         else:
             self.QC = QC
 
-    def smooth(self, neuron):
+    def smooth_coordinates(self, neuron):
         '''
         This function smooths all node positions in a catmaid_tools
-         neuron object and returns a new skeleton object
+         neuron object and returns an array of the smoothed positions
+         aligned with neuron.node_ids (see Neuron.node_coordinates)
         '''
         # neurites = segmentNeurites(neuron)  FIXME
         neurites = unique_neurites(neuron)
-        smoothneurites = []
-        smoothednodes = {}
+        coordinates = neuron.node_coordinates.copy()
+        if len(neurites) == 0:
+            return coordinates
         bifurcs = newbifurcs(neuron, neurites,
                              minpts=self.minbifurc,
                              maxpts=self.maxbifurc)
+        traces = []
         for neurite in neurites:
             neuritepts = node_array(neuron, neurite)
             neuritepts[0] = bifurcs[neurite[0]]
             neuritepts[-1] = bifurcs[neurite[-1]]
-            smoothneurites.append(smooth_tracing(
-                neuritepts, zres=self.zres, firstpos=None,
+            traces.append(neuritepts)
+        if self.kalman_mode == 'neurite' and self.kalman_params is None:
+            smoothneurites = [smooth_tracing(
+                trace, zres=self.zres, firstpos=None,
                 use_missing=self.use_missing, fix_applicate=self.fix_applicate,
-                QC=self.QC))
-            smoothpos = smoothneurites[-1]
-            smoothednodes.update({nid: smoothpos[i]
-                                  for i, nid in enumerate(neurite)})
-        return updateNodePosition(neuron, smoothednodes)
+                QC=self.QC, its=self.iterations) for trace in traces]
+        else:
+            smoothneurites = smooth_tracings(
+                traces, zres=self.zres, use_missing=self.use_missing,
+                fix_applicate=self.fix_applicate, QC=self.QC,
+                params=self.kalman_params, its=self.iterations)
+        index = {nid: i for (i, nid) in enumerate(neuron.node_ids)}
+        order = [index[nid] for neurite in neurites for nid in neurite]
+        coordinates[order] = numpy.vstack(smoothneurites)
+        return coordinates
+
+    def smooth(self, neuron):
+        '''
+        This function smooths all node positions in a catmaid_tools
+         neuron object and returns a new neuron object
+        '''
+        return neuron.with_coordinates(self.smooth_coordinates(neuron))
 
     def smooth_gaussian(self, neuron, filename):
         '''
         This funciton smooths all node positions in a catmaid_tools
         neuron object with a gaussian filter. Returns a new skeleton object
         '''
+        fix_axes = [2, ] if self.fix_applicate else None
         new_skel = gaussian_smooth_neuron(neuron, sigma=self.gaussian_sigma,
                                           min_effect=self.gaussian_min_effect,
-                                          fix_axes=self.fix_applicate)
+                                          fix_axes=fix_axes)
         new_neuron = catmaid.neuron.Neuron(new_skel)
-        with open(filename, 'w') as f:
-            json.dump(new_neuron.skeleton, f)
+        _write_skeleton(new_neuron.skeleton, filename)
 
     def smoothtoFile(self, neuron, filename):
         sneu = self.smooth(neuron)
-        with open(filename, 'w') as f:
-            json.dump(sneu.skeleton, f)
+        _write_skeleton(sneu.skeleton, filename)
 
 
 if __name__ == "__main__":
@@ -352,6 +639,14 @@ if __name__ == "__main__":
     parser.add_argument(
         '-t', '--threads', type=int, required=False,
         help="The number of threads to use for smoothing")
+    parser.add_argument(
+        '-v', '--variants', nargs='+', choices=default_variants,
+        required=False,
+        help="The smoothing variants to compute [default: all]")
+    parser.add_argument(
+        '-k', '--kalman-mode', choices=('neurite', 'neuron'),
+        default='neurite',
+        help="Estimate kalman filter parameters per neurite or per neuron")
     opts = parser.parse_args()
     if opts.source:
         indir = opts.source
@@ -364,8 +659,6 @@ if __name__ == "__main__":
         outdir = outdir
     print "Connecting to source"
     s = catmaid.get_source(indir)
-    if outdir[-1] != '/':
-        outdir += '/'
     if opts.threads:
         cpu_count = mp.cpu_count()
         if opts.threads > cpu_count:
@@ -374,12 +667,13 @@ if __name__ == "__main__":
             cpu_count = opts.threads
     else:
         cpu_count = int(mp.cpu_count() / 2)
-    if cpu_count < 0:
+    if cpu_count < 1:
         cpu_count = 1
-    print "Creating pool operator with {} CPUS".format(cpu_count)
-    pool = mp.Pool(processes=cpu_count)
     print "Creating Smoothing Object"
-    zf_ns = NeuronSmoother(60.)
-    print "Starting Smoothing Operation"
-    pool.map(smoothn_everything,
-             [(zf_ns, n, outdir) for n in s.all_neurons_iter()])
+    zf_ns = NeuronSmoother(60., kalman_mode=opts.kalman_mode)
+    print "Starting Smoothing Operation with {} CPUS".format(cpu_count)
+    errors = smooth_source(
+        s, outdir, variants=opts.variants, smoother=zf_ns,
+        processes=cpu_count)
+    for sid in sorted(errors):
+        print "Failed to smooth {}: {}".format(sid, errors[sid])
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Vectorised geometry on arrays of line segments
+
+Segments are given as arrays of start and end points (N x 3) so that
+whole skeletons (or populations of skeletons) can be processed at once.
+Candidate segment pairs are found with scipy.spatial.cKDTree before any
+exact geometry is computed.
+"""
+
+try:
+    import numpy
+    has_numpy = True
+except ImportError:
+    has_numpy = False
+
+try:
+    from scipy.spatial import cKDTree
+    has_scipy = has_numpy
+except ImportError:
+    has_scipy = False
+
+
+def segment_midpoints(starts, ends):
+    """Returns the midpoints and half lengths of segments"""
+    v = ends - starts
+    return starts + v / 2., numpy.sqrt(numpy.sum(v ** 2., axis=1)) / 2.
+
+
+def _length_buckets(half_lengths):
+    """Bucket segments by (log2) half length"""
+    return numpy.ceil(numpy.log2(half_lengths + 1.)).astype('i8')
+
+
+def segment_index(starts, ends):
+    """
+    Build a reusable spatial index of segments for segment_candidates
+
+    Segments are bucketed by (log2) half length and each bucket gets a
+    KD-tree over its midpoints. Returns a list of
+    (indices, tree, max half length) for each bucket.
+    """
+    if not has_scipy:
+        raise ImportError("segment_index requires numpy and scipy")
+    mid, half = segment_midpoints(starts, ends)
+    if len(mid) == 0:
+        return []
+    buckets = _length_buckets(half)
+    groups = []
+    for b in numpy.unique(buckets):
+        bi = numpy.where(buckets == b)[0]
+        groups.append((bi, cKDTree(mid[bi]), half[bi].max()))
+    return groups
+
+
+def segment_candidates(
+        a_starts, a_ends, b_starts, b_ends, distance, b_index=None):
+    """
+    Find all (i, j) pairs of segments a[i] and b[j] that might be
+    within distance of each other.
+
+    Segments are bucketed by length so that a few long segments do not
+    inflate the search radius of all the others. Each pair of buckets is
+    searched with a KD-tree over segment midpoints using the radius
+    distance + (longest half length in a bucket) + (in b bucket).
+    All returned pairs satisfy this bound, some may still be further apart
+    than distance.
+
+    b_index (from segment_index(b_starts, b_ends)) can be provided to
+    reuse the index of b for many calls.
+
+    Returns two arrays (i and j) of indices into a and b
+    """
+    if not has_scipy:
+        raise ImportError("segment_candidates requires numpy and scipy")
+    if b_index is None:
+        b_index = segment_index(b_starts, b_ends)
+    a_mid, a_half = segment_midpoints(a_starts, a_ends)
+    b_half = segment_midpoints(b_starts, b_ends)[1]
+    if len(a_mid) == 0 or len(b_index) == 0:
+        return numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8')
+    a_buckets = _length_buckets(a_half)
+    ias = []
+    jbs = []
+    for ab in numpy.unique(a_buckets):
+        ai = numpy.where(a_buckets == ab)[0]
+        a_tree = cKDTree(a_mid[ai])
+        a_max = a_half[ai].max()
+        for (bi, b_tree, b_max) in b_index:
+            pairs = a_tree.sparse_distance_matrix(
+                b_tree, distance + a_max + b_max, output_type='ndarray')
+            if len(pairs) == 0:
+                continue
+            # remove pairs that are out of range for their own lengths
+            i = ai[pairs['i']]
+            j = bi[pairs['j']]
+            m = pairs['v'] <= (distance + a_half[i] + b_half[j])
+            ias.append(i[m])
+            jbs.append(j[m])
+    if len(ias) == 0:
+        return numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8')
+    return numpy.hstack(ias), numpy.hstack(jbs)
+
+
+def _dot(a, b):
+    return numpy.einsum('ij,ij->i', a, b)
+
+
+def _quadratic_interval(a, b, c):
+    """
+    Vectorised solution of a * t ** 2 + 2 * b * t + c <= 0 for a >= 0
+
+    Returns (lo, hi), empty intervals have lo > hi
+    """
+    lo = numpy.empty(len(a))
+    hi = numpy.empty(len(a))
+    lo[:] = numpy.inf
+    hi[:] = -numpy.inf
+    flat = a == 0.
+    inside = flat & (c <= 0.)
+    lo[inside] = -numpy.inf
+    hi[inside] = numpy.inf
+    disc = b * b - a * c
+    m = ~flat & (disc >= 0.)
+    sd = numpy.sqrt(disc[m])
+    lo[m] = (-b[m] - sd) / a[m]
+    hi[m] = (-b[m] + sd) / a[m]
+    return lo, hi
+
+
+def capsule_intervals(p0, p1, q0, q1, radius):
+    """
+    For each pair of segments p (p0 -> p1) and q (q0 -> q1) find the
+    interval [lo, hi] of t in [0, 1] where p0 + t * (p1 - p0) is within
+    radius of segment q (inside the capsule around q)
+
+    The capsule is the union of a cylinder and two spheres and is convex
+    so the interval is the hull of the line intersection with all three.
+
+    Returns (lo, hi), empty intervals have lo > hi
+    """
+    d = p1 - p0
+    dd = _dot(d, d)
+    r2 = radius * radius
+    lo = numpy.empty(len(p0))
+    hi = numpy.empty(len(p0))
+    lo[:] = numpy.inf
+    hi[:] = -numpy.inf
+    # spheres at both ends of q
+    for c in (q0, q1):
+        w = p0 - c
+        slo, shi = _quadratic_interval(dd, _dot(d, w), _dot(w, w) - r2)
+        m = slo <= shi
+        lo[m] = numpy.minimum(lo[m], slo[m])
+        hi[m] = numpy.maximum(hi[m], shi[m])
+    # cylinder along q, limited to the slab between the ends of q
+    e = q1 - q0
+    ee = _dot(e, e)
+    valid = ee > 0.
+    see = numpy.where(valid, ee, 1.)
+    w = p0 - q0
+    s0 = _dot(w, e) / see
+    ds = _dot(d, e) / see
+    wp = w - s0[:, numpy.newaxis] * e
+    dp = d - ds[:, numpy.newaxis] * e
+    clo, chi = _quadratic_interval(
+        _dot(dp, dp), _dot(dp, wp), _dot(wp, wp) - r2)
+    # 0 <= s0 + t * ds <= 1
+    moving = ds != 0.
+    sds = numpy.where(moving, ds, 1.)
+    ta = -s0 / sds
+    tb = (1. - s0) / sds
+    slab_lo = numpy.where(moving, numpy.minimum(ta, tb), -numpy.inf)
+    slab_hi = numpy.where(moving, numpy.maximum(ta, tb), numpy.inf)
+    outside = ~moving & ((s0 < 0.) | (s0 > 1.))
+    slab_lo[outside] = numpy.inf
+    slab_hi[outside] = -numpy.inf
+    clo = numpy.maximum(clo, slab_lo)
+    chi = numpy.minimum(chi, slab_hi)
+    m = valid & (clo <= chi)
+    lo[m] = numpy.minimum(lo[m], clo[m])
+    hi[m] = numpy.maximum(hi[m], chi[m])
+    # limit to the segment p
+    return numpy.maximum(lo, 0.), numpy.minimum(hi, 1.)
+
+
+def merge_intervals(ids, lo, hi):
+    """
+    Merge overlapping [lo, hi] intervals (in [0, 1]) that share an id
+
+    Returns ids, lo and hi of the merged (disjoint) intervals
+    """
+    m = lo <= hi
+    ids, lo, hi = ids[m], lo[m], hi[m]
+    if len(ids) == 0:
+        return ids, lo, hi
+    order = numpy.lexsort((lo, ids))
+    ids, lo, hi = ids[order], lo[order], hi[order]
+    new_id = numpy.ones(len(ids), dtype=bool)
+    new_id[1:] = ids[1:] != ids[:-1]
+    # running max of hi within each id: ids are sorted, so the running max
+    # of the (id, hi) ranks restarts at every id and maps back to hi exactly
+    by_hi = numpy.lexsort((hi, ids))
+    rank = numpy.empty(len(ids), dtype=int)
+    rank[by_hi] = numpy.arange(len(ids))
+    prev_hi = hi[by_hi[numpy.maximum.accumulate(rank)]]
+    starts = new_id
+    starts[1:] |= lo[1:] > prev_hi[:-1]
+    first = numpy.where(starts)[0]
+    return ids[first], lo[first], numpy.maximum.reduceat(hi, first)
+
+
+def segment_distances(p0, p1, q0, q1):
+    """
+    Minimum distance between each pair of segments p (p0 -> p1)
+    and q (q0 -> q1)
+
+    Returns distances and the parameters (s, t) of the closest points
+    p0 + s * (p1 - p0) and q0 + t * (q1 - q0)
+    """
+    d1 = p1 - p0
+    d2 = q1 - q0
+    r = p0 - q0
+    a = _dot(d1, d1)
+    e = _dot(d2, d2)
+    f = _dot(d2, r)
+    c = _dot(d1, r)
+    b = _dot(d1, d2)
+    denom = a * e - b * b
+    # closest points of the infinite lines (or 0 for parallel lines)
+    sa = numpy.where(a > 0., a, 1.)
+    se = numpy.where(e > 0., e, 1.)
+    s = numpy.where(
+        denom > 0., (b * f - c * e) / numpy.where(denom > 0., denom, 1.), 0.)
+    s = numpy.clip(s, 0., 1.)
+    t = numpy.where(e > 0., (b * s + f) / se, 0.)
+    # clamp t and recompute s for the clamped t (t is 0 for a point q)
+    t_low = (t < 0.) | (e == 0.)
+    t_high = t > 1.
+    t = numpy.clip(t, 0., 1.)
+    s = numpy.where(
+        t_low, numpy.clip(-c / sa, 0., 1.),
+        numpy.where(t_high, numpy.clip((b - c) / sa, 0., 1.), s))
+    s = numpy.where(a > 0., s, 0.)
+    v = (p0 + s[:, numpy.newaxis] * d1) - (q0 + t[:, numpy.newaxis] * d2)
+    return numpy.sqrt(_dot(v, v)), s, t
@@ -1,43 +1,87 @@
 #!/usr/bin/env python
+import os
+
+try:
+    import numpy
+    import scipy.io
+    import scipy.sparse
+    has_scipy = True
+except ImportError:
+    has_scipy = False
+
 try:
     xrange
 except NameError as e:
     xrange = range
 
+
 def diagram_filter(diagram, sids=None, save=False):
     if sids is None:
         return diagram
     data = {'edges': [], 'nodes': []}
-    in_graph_sids = set(sids)
+    sids = set(sids)
+    linked_sids = set()
 
     for e in diagram['data']['edges']:
         if e['source'] in sids or e['target'] in sids:
             data['edges'].append(e)
-            in_graph_sids.add(e['source'])
-            in_graph_sids.add(e['target'])
-    
+            linked_sids.add(e['source'])
+            linked_sids.add(e['target'])
+
     for n in diagram['data']['nodes']:
-        if n['id'] in in_graph_sids:
+        if n['id'] in sids or n['id'] in linked_sids:
             data['nodes'].append(n)
 
     return {'data': data, 'dataSchema': diagram['dataSchema']}
 
-def to_adjacency_matrix(wd, save=False):
+
+def save_adjacency_matrix(
+        m, sids, adjacency_fn='adjacency.mat', skeletons_fn='skeletons.mat'):
     """
-    returns adjacency matrix and corresponding skeleton list form wiring
-    diagram
+    Saves an adjacency matrix (dense or scipy.sparse, which is saved as a
+    sparse matlab matrix) and the corresponding skeleton list as .mat files
+    """
+    if not has_scipy:
+        raise ImportError("save_adjacency_matrix requires numpy and scipy")
+    scipy.io.savemat(adjacency_fn, mdict={'adjacency': m})
+    scipy.io.savemat(
+        skeletons_fn, mdict={'skeletons': numpy.array(sids, dtype='i8')})
+
+
+def to_adjacency_matrix(
+        wd, save=False, dense=False, adjacency_fn=None, skeletons_fn=None):
+    """
+    returns adjacency matrix and corresponding (sorted) skeleton list from
+    wiring diagram
+
+    The matrix is a scipy.sparse.csr_matrix where m[i, j] is the number of
+    connectors from sids[i] to sids[j] (a numpy array if dense is True).
+    If adjacency_fn is provided, the matrix and skeleton list are saved to
+    adjacency_fn and skeletons_fn (default skeletons.mat in the same
+    directory, see save_adjacency_matrix). save is unused.
     """
+    if not has_scipy:
+        raise ImportError("to_adjacency_matrix requires numpy and scipy")
     # get all skeletons
-    sids = sorted([n['id'] for n in wd['data']['nodes']])
+    sids = sorted([int(n['id']) for n in wd['data']['nodes']])
     nsids = len(sids)
     lookup = dict([(sids[i], i) for i in xrange(nsids)])
     # matrix: row & columns = skeletons, values = N connections
-    m = []
-    for i in xrange(nsids):
-        m.append([0] * nsids)
-    for e in wd['data']['edges']:
-        # [source, target]
-        m[lookup[e['source']]][lookup[e['target']]] = e['number_of_connector']
+    edges = wd['data']['edges']
+    rows = numpy.array(
+        [lookup[int(e['source'])] for e in edges], dtype='i8')
+    columns = numpy.array(
+        [lookup[int(e['target'])] for e in edges], dtype='i8')
+    values = numpy.array(
+        [e['number_of_connector'] for e in edges], dtype='i8')
+    m = scipy.sparse.csr_matrix(
+        (values, (rows, columns)), shape=(nsids, nsids))
+    if dense:
+        m = m.toarray()
     # save matrix & skeleton list
-    sids = [int(sid) for sid in sids]
+    if adjacency_fn is not None:
+        if skeletons_fn is None:
+            skeletons_fn = os.path.join(
+                os.path.dirname(adjacency_fn), 'skeletons.mat')
+        save_adjacency_matrix(m, sids, adjacency_fn, skeletons_fn)
     return m, sids
@@ -28,6 +28,7 @@ except ImportError as E:
 
 from . import algorithms
 from . import errors
+from . import tiles
 
 
 class Connection:
@@ -40,6 +41,7 @@ class Connection:
         self._projects = None
         self._pid = project
         self._cache = {}
+        self.tile_cache = None
         self.cookies = cookielib.CookieJar()
         self.opener = urllib2.build_opener(
             urllib2.HTTPRedirectHandler(),
@@ -375,9 +377,15 @@ class Connection:
                 limit=js['iTotalRecords'])
         return js['aaData']
 
-    def adjacency_matrix(self, project=None, save=False, sids=None):
+    def adjacency_matrix(self, project=None, save=False, sids=None,
+                         dense=False):
+        """Returns a (sparse unless dense is True) adjacency matrix and
+        the sorted skeleton list, see wiring.to_adjacency_matrix
+
+        save is passed to wiring_diagram, use
+        wiring.save_adjacency_matrix to save the matrix"""
         return algorithms.wiring.to_adjacency_matrix(
-            self.wiring_diagram(project, save, sids), save)
+            self.wiring_diagram(project, save, sids), dense=dense)
 
     def user_stats(self, project=None):
         """Only works for catmaid1 server"""
@@ -406,93 +414,55 @@ class Connection:
                       in a specific project.
            catmaid_url = A url to the desired catmaid database. This is only
                          required when fetching with tiletype 3.
+
+           Urls are built by a cached tiles.TileSource (see tile_source),
+           use its urls method to build many urls at once.
            """
-        # Set stack info
+        return self.tile_source(stack_id, tiletype, xyz_format).url(
+            row, column, z_index, zoom)
+
+    def tile_source(self, stack_id=None, tiletype=4, xyz_format=None,
+                    project=None):
+        """Returns the (cached) tiles.TileSource that builds tile urls of a
+        stack (the only stack in the project if stack_id is None)"""
+        pid = self.find_pid(project)
+        key = (pid, stack_id, tiletype, xyz_format)
+        sources = self._cache.setdefault('tile_source', {})
+        if key in sources:
+            return sources[key]
+        info = self.stack_info(pid)
         if stack_id is not None:
-            stack_info = self.stack_info()[stack_id]
-        else:
-            if len(self.stack_info().keys()) > 1:
-                raise Exception("Must specify desired stack. More than 1"
-                                "stack in project.")
-            else:
-                stack_info = self.stack_info().values()[0]
-                stack_id = stack_info[u'sid']
-        if len(stack_info['mirrors']) > 1:
-            print("WARNING: More than 1 mirror information present in stack "
-                  "info. Grabbing image dimensions from first mirror")
-        mirror_info = stack_info[u'mirrors'][0]
-        tile_width = mirror_info[u'tile_width']
-        tile_height = mirror_info[u'tile_height']
-        max_row = (stack_info[u'dimension'][u'y'] / tile_height) - 1
-        max_col = (stack_info[u'dimension'][u'x'] / tile_width) - 1
-        if not 0 <= row <= max_row:
-            raise errors.InvalidUrl("Invalid row %s" % row)
-        if not 0 <= column <= max_col:
-            raise errors.InvalidUrl("Invalid column %s" % row)
-        info = {'base': str(mirror_info[u'image_base']), 'z_index': z_index,
-                'row': row, 'column': column, 'zoom': zoom,
-                'ext': str(mirror_info[u'file_extension']),
-                'tile_width': tile_width, 'tile_height': tile_height,
-                'project_id': stack_info[u'pid'],
-                'stack_id': stack_id, 'row_by_height': (row * tile_height),
-                'col_by_width': (column * tile_width),
-                'catmaid_url': self.server, 'zoomlevel': (2**(-zoom))}
-        tile_types = {
-            1: '{base}{z_index}/{row}_{column}_{zoom}.{ext}',
-            2: ('{base}?x={col_by_width}&y={row_by_height}&z={z_index}&width='
-                '{tile_width}&height={tile_height}&scale={zoomlevel}'
-                '&row={row}&col={column}'),
-            3: ('{catmaid_url}{project_id}/stack/{stack_id}/tile?x='
-                '{col_by_width}&y={row_by_height}&z={z_index}&width='
-                '{tile_width}&height={tile_height}&scale={zoomlevel}&row={row}'
-                '&col={column}&file_extension={ext}&basename={base}&type=all'),
-            4: '{base}{z_index}/{zoom}/{row}_{column}.{ext}',
-            5: '{base}{zoom}/{z_index}/{row}/{column}.{ext}',
-            '6_xy': ('{base}{tile_width}_{tile_height}/{col_by_width}_'
-                     '{row_by_height}_{z_index}/{ext}'),
-            '6_xz': ('{base}{tile_width}_{tile_height}/{col_by_width}_'
-                     '{z_index}_{row_by_height}/{ext}'),
-            '6_yz': ('{base}{tile_width}_{tile_height}/{z_index}_'
-                     '{row_by_height}_{col_by_width}/{ext}'),
-            7: ('{base}largeDataTileSource/{tile_width}/{tile_height}/{zoom}/'
-                '{z_index}/{row}/{column}.{ext}'),
-            '8_xy': '{base}xy/{zoom}/{column}_{row}_{z_index}',
-            '8_xz': '{base}xz/{zoom}/{column}_{z_index}_{row}',
-            '8_yz': '{base}yz/{zoom}/{z_index}_{row}_{column}',
-            9: '{base}{z_index}/{row}_{column}_{zoom}.{ext}'}
-        if tiletype == 8 or tiletype == 6:
-            raise NotImplementedError
-            """if xyz_format is None:
-                raise Exception("Format must be provided for DVID Imagetiles!")
-            elif xyz_format == 'xy' or xyz_format == 'xz':
-                tile_name = '{}_{}'.format(tile_type, xyz_format)
-                return tile_types[tile_name].format(**info)
-            elif xyz_format == 'zy' or xyz_format == 'yz':
-                return tile_types[8_yz].format(**info)
-            else:
-                raise Exception("XYZ Format not recognised!")
-        elif tiletype == 6:
-            if xyz_format is None:
-                raise Exception("Format must be provided for DVID Imagetiles!")
-            elif xyz_format == 'xy' or xyz_format == 'xz':
-                tile_name = '{}_{}'.format(tile_type, xyz_format)
-                return tile_types[tile_name].format(**info)
-            elif xyz_format == 'zy' or xyz_format == 'yz':
-                return tile_types[6_yz].format(**info)
-            else:
-                raise Exception("XYZ Format not recognised!")"""
+            stack_info = info[stack_id]
+        elif len(info) > 1:
+            raise Exception("Must specify desired stack. More than 1 "
+                            "stack in project.")
         else:
-            url = tile_types[tiletype].format(**info)
-        if url[:4] != 'http':
-            url = self.djangourl(url)
-        return url
+            stack_info = info.values()[0]
+        sources[key] = tiles.TileSource(
+            stack_info, self.server, tiletype, xyz_format, stack_id)
+        return sources[key]
 
     def fetch_tile(self, row=None, column=None, z_index=None, zoom=0,
                    tiletype=4, xyz_format=None, stack_id=None, url=None):
         """This function will return a single catmaid tile (row, column).
            If a URL is provided for the tile, this function does not requires
            any further information. If no URL is provided, this function
-           requires a row, column, and z index."""
+           requires a row, column, and z index.
+
+           If a tile_cache is enabled (see enable_tile_cache), tiles
+           requested by row, column and z index (with or without a URL) are
+           cached (by project and stack, see tiles.TileSource.cache_key) and
+           a copy of the cached tile is returned. Tiles that are being
+           prefetched (see prefetch_tiles) are waited for instead of
+           fetched again."""
+        key = None
+        if self.tile_cache is not None and None not in (row, column, z_index):
+            key = self.tile_source(stack_id, tiletype, xyz_format).cache_key(
+                row, column, z_index, zoom)
+            self.tile_cache.wait(key)
+            tile = self.tile_cache.get(key)
+            if tile is not None:
+                return numpy.array(tile)
         if url is None:
             if row is None:
                 raise Exception('Must provide row if not providing URL')
@@ -503,8 +473,140 @@ class Connection:
 
             url = self.fetch_tile_url(row, column, z_index, zoom,
                                       tiletype, xyz_format, stack_id)
-        tile = self.fetch(url)
-        return numpy.array(Image.open(StringIO(tile)))
+        tile = numpy.array(Image.open(StringIO(self.fetch(url))))
+        if key is not None:
+            self.tile_cache.put(key, tile)
+        return tile
+
+    def enable_tile_cache(self, max_bytes=256 * 2 ** 20, directory=None,
+                          max_disk_bytes=None, compress=True):
+        """Cache tiles fetched with fetch_tile in memory (up to max_bytes)
+        and, if a directory is provided, on disk (see tiles.TileCache)"""
+        self.tile_cache = tiles.TileCache(
+            max_bytes, directory, max_disk_bytes, compress)
+        return self.tile_cache
+
+    def _prefetch_tile(self, key):
+        project, stack_id, tiletype, zoom, z_index, row, column = key
+        xyz_format = None
+        if isinstance(tiletype, (str, unicode)):
+            tiletype, xyz_format = tiletype.split('_')
+            tiletype = int(tiletype)
+        try:
+            url = self.tile_source(
+                stack_id, tiletype, xyz_format, project).url(
+                    row, column, z_index, zoom)
+        except errors.InvalidUrl:
+            return None
+        return numpy.array(Image.open(StringIO(self.fetch(url))))
+
+    def prefetch_tiles(self, rows, columns, z_indices, zoom=0, tiletype=4,
+                       xyz_format=None, stack_id=None):
+        """Fetch tiles (all combinations of rows, columns and z_indices)
+        into the tile_cache in background threads, for example the
+        sections ahead of a sequential z scan"""
+        if self.tile_cache is None:
+            raise Exception("prefetch_tiles requires a tile_cache")
+        source = self.tile_source(stack_id, tiletype, xyz_format)
+        self.tile_cache.prefetch(self._prefetch_tile, [
+            source.cache_key(row, column, z, zoom)
+            for z in z_indices for row in rows for column in columns])
+
+    def _plan_volume(self, bbox, zoom, stack_id, tiletype, xyz_format):
+        source = self.tile_source(stack_id, tiletype, xyz_format)
+        shape, plan = source.plan(bbox, zoom)
+        # the tile coordinates are passed so tiles can be cached
+        tiles = [
+            ((z, vs, ts), {
+                'row': row, 'column': column, 'z_index': z, 'zoom': zoom,
+                'tiletype': tiletype, 'xyz_format': xyz_format,
+                'stack_id': stack_id, 'url': url})
+            for (z, row, column, url, vs, ts) in plan if url is not None]
+        return shape, tiles
+
+    def iter_volume(self, bbox, zoom=0, stack_id=None, tiletype=4,
+                    xyz_format=None, threads=8, prefetch=0, z_indices=None,
+                    skip_missing=False):
+        """
+        Generates the (z_index, section) of a sub-volume (see fetch_volume)
+        one section at a time, for volumes that do not fit in memory
+
+        The tiles of each section are fetched concurrently, if a
+        tile_cache is enabled the tiles of the next prefetch sections are
+        fetched in the background.
+        z_indices restricts the sections to these (in the bbox z range, in
+        the given order), for example to leave out broken slices, other
+        sections are neither fetched nor prefetched.
+        Sections for which every tile failed are logged and not generated
+        if skip_missing (otherwise they are 0).
+        """
+        shape, tiles = self._plan_volume(
+            bbox, zoom, stack_id, tiletype, xyz_format)
+        sections = {}
+        for (index, kwargs) in tiles:
+            sections.setdefault(index[0], []).append((index, kwargs))
+        z0 = bbox[0][2]
+        if z_indices is None:
+            z_indices = range(z0, z0 + shape[0])
+        else:
+            z_indices = [z for z in z_indices if z0 <= z < z0 + shape[0]]
+        rows = sorted(set(kw['row'] for (_, kw) in tiles))
+        columns = sorted(set(kw['column'] for (_, kw) in tiles))
+        for (i, z) in enumerate(z_indices):
+            if prefetch and self.tile_cache is not None:
+                self.prefetch_tiles(
+                    rows, columns, z_indices[i + 1:i + prefetch + 1],
+                    zoom, tiletype, xyz_format, stack_id)
+            section = None
+            for ((_, vs, ts), tile) in algorithms.images.fetch_tiles(
+                    self, sections.get(z, []), threads):
+                if tile is None:
+                    continue
+                if section is None:
+                    section = numpy.zeros(
+                        shape[1:] + tile.shape[2:], dtype=tile.dtype)
+                _paste(section, vs, tile, ts)
+            if section is None:
+                if sections.get(z):
+                    logging.warning(
+                        "No tiles could be fetched for section %s" % z)
+                    if skip_missing:
+                        continue
+                section = numpy.zeros(shape[1:], dtype='uint8')
+            yield z, section
+
+    def fetch_volume(self, bbox, zoom=0, stack_id=None, tiletype=4,
+                     xyz_format=None, out=None, filename=None, threads=8):
+        """
+        Fetch a (z, y, x) sub-volume of a stack
+
+        bbox is ((x0, y0, z0), (x1, y1, z1)) in stack pixels (at zoom 0)
+        and section indices (upper bounds excluded), see
+        tiles.TileSource.plan. The tiles of all sections are fetched
+        concurrently in threads worker threads and written into out (an
+        array of the volume shape), a memory mapped npy file (if filename
+        is provided) or a new array with the dtype of the tiles.
+        Tiles outside of the stack or that failed are left as 0.
+
+        Returns the volume array
+        """
+        shape, tiles = self._plan_volume(
+            bbox, zoom, stack_id, tiletype, xyz_format)
+        z0 = bbox[0][2]
+        volume = out
+        for ((z, vs, ts), tile) in algorithms.images.fetch_tiles(
+                self, tiles, threads):
+            if tile is None:
+                continue
+            if volume is None:
+                volume = _allocate_volume(
+                    shape + tile.shape[2:], tile.dtype, filename)
+            _paste(volume[z - z0], vs, tile, ts)
+        if volume is None:
+            volume = _allocate_volume(shape, 'uint8', filename)
+        if isinstance(volume, numpy.memmap):
+            volume.flush()
+        return volume
 
     def openURL(self, project=None, neuron=None, x=None, y=None, z=None,
                 zoom=0, skID=None, nodeID=None, stack_index=0,
@@ -584,6 +686,23 @@ class Connection:
         self._cache = {}
 
 
+def _paste(section, volume_slices, tile, tile_slices):
+    """Copy the tile_slices of a tile into the volume_slices of a section,
+    clipped to the tile (edge tiles can be smaller)"""
+    t = tile[tile_slices]
+    v = section[volume_slices]
+    h = min(t.shape[0], v.shape[0])
+    w = min(t.shape[1], v.shape[1])
+    v[:h, :w] = t[:h, :w]
+
+
+def _allocate_volume(shape, dtype, filename=None):
+    if filename is None:
+        return numpy.zeros(shape, dtype=dtype)
+    return numpy.lib.format.open_memmap(
+        filename, mode='w+', dtype=dtype, shape=shape)
+
+
 def connect(
         server=None, user=None, password=None, project=None, api_token=None):
     """ connect using environment variables or user input if
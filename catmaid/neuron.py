@@ -90,6 +90,13 @@ class Neuron(object):
     ----------
     skeleton: either a skeleton(dictonary) or a filename with a skeleton in it.
     """
+    # lazy attributes that do not depend on node positions
+    # these are shared with neurons made by with_coordinates
+    _topology_attributes = (
+        'edges', 'dedges', 'redges', 'skeleton_id', 'name', 'dgraph',
+        'graph', 'soma', 'connectors', 'tags', 'root', 'leaves',
+        'annotations', 'bifurcations', 'node_ids')
+
     def __init__(self, skeleton):
         self.skeleton = load_skeleton(skeleton)
 
@@ -100,6 +107,16 @@ class Neuron(object):
     def nodes(self):
         return algorithms.skeleton.nodes(self.skeleton)
 
+    @lazyproperty
+    def node_ids(self):
+        """ node ids in the order of node_coordinates """
+        return algorithms.skeleton.node_ids(self)
+
+    @lazyproperty
+    def node_coordinates(self):
+        """ [node][x, y, z] array """
+        return algorithms.skeleton.node_coordinates(self)
+
     @lazyproperty
     def edges(self):
         """ [child][parent] """
@@ -143,6 +160,10 @@ class Neuron(object):
     def synapses(self):
         return algorithms.skeleton.synapses(self.skeleton)
 
+    @lazyproperty
+    def synapse_table(self):
+        return algorithms.skeleton.synapse_table(self)
+
     @lazyproperty
     def synapse_info(self):
         return algorithms.skeleton.synapse_info(self)
@@ -199,9 +220,22 @@ class Neuron(object):
     def bifurcations(self):
         return algorithms.skeleton.bifurcations(self)
 
-    def smoothed(self, *args, **kwargs):
+    def with_coordinates(self, coordinates):
+        """Return a neuron with the same topology, tags and connectors
+        with node positions from coordinates (in node_ids order)"""
+        n = Neuron(algorithms.skeleton.with_coordinates(self, coordinates))
+        for name in self._topology_attributes:
+            attr = '_{}'.format(name)
+            if hasattr(self, attr):
+                setattr(n, attr, getattr(self, attr))
+        return n
+
+    def smoothed(self, sigma=300., min_effect=1e-6, fix_axes=None):
         """Return a smoothed version of this neuron
-        produced using algorithms.morphology.gaussian_smooth_neuron"""
+        produced using algorithms.morphology.gaussian_smooth_neuron,
+        z is kept fixed unless other fix_axes are given ([] for none)"""
+        if fix_axes is None:
+            fix_axes = [2, ]
         return Neuron(
             algorithms.morphology.gaussian_smooth_neuron(
-                self, *args, **kwargs))
+                self, sigma, min_effect, fix_axes))
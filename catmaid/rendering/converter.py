@@ -149,14 +149,14 @@ def convert_source(src, path=None, sids=None, fn_format=None,
         sids = src.skeleton_ids()
 
     fails = []
-    conns = {}
+    index = algorithms.population.network.ConnectorIndex()
     for sid in sids:
         n = None
         t = None
         try:
             n = src.get_neuron(sid)
-            # add to conns
-            conns = algorithms.population.network.add_neuron_to_conns(n, conns)
+            # add to connector index
+            index.add_neuron(n, compact=False)
             # convert to tree
             t = neuron_to_tree(n)
             # save tree
@@ -170,6 +170,8 @@ def convert_source(src, path=None, sids=None, fn_format=None,
         del t
 
     # save conns
+    index.save(os.path.join(path, 'connectors.npz'))
+    conns = index.to_conns()
     fn = os.path.join(path, 'conns.p')
     logging.debug("Saving conns to: {}".format(fn))
     with open(fn, 'w') as f:
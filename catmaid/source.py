@@ -257,14 +257,73 @@ class Source(object):
         ov = population.synapses.skeleton_overlap(n_a, n_d, s, sig)
         return ov
 
-    def list_overlap(self, sk_list, s=1000., sig=10000.):
-        ov_dict = population.synapses.overlap_list(self, sk_list)
-        return ov_dict
+    def list_overlap(self, sk_list=None, s=1000., sig=10000., **kwargs):
+        """Returns a sparse matrix m where m[a, d] is the overlap of the
+        axon of sk_list[a] with the dendrites of sk_list[d]
+        see population.synapses.overlap_matrix for kwargs"""
+        return population.synapses.overlap_matrix(
+            self, sk_list, s=s, sig=sig, **kwargs)
+
+    def _index_filename(self, name):
+        """Default filename for indices of this source (None: not saved)"""
+        return None
+
+    def _load_index(self, cls, fn, sids=None, update=False):
+        """Load (from fn), update and save an index of class cls,
+        see connector_index"""
+        if fn is not None and os.path.exists(fn):
+            index = cls.load(fn)
+        else:
+            index = cls()
+        n = len(index.skeleton_ids)
+        index.add_source(self, sids, update)
+        if fn is not None and (update or len(index.skeleton_ids) != n):
+            index.save(fn)
+        return index
+
+    def connector_index(self, fn=None, sids=None, update=False):
+        """
+        Returns a population.network.ConnectorIndex of the skeletons in sids
+        (default all skeletons)
+
+        If fn (default, next to the skeletons of a FileSource) exists the
+        index is loaded from it and only skeletons that are not indexed
+        yet (all in sids if update is True) are added. The index is then
+        saved to fn.
+        """
+        if fn is None:
+            fn = self._index_filename('connectors.npz')
+        return self._load_index(
+            population.network.ConnectorIndex, fn, sids, update)
+
+    def node_index(self, fn=None, sids=None, update=False):
+        """
+        Returns a population.node_index.NodeIndex (for box, radius,
+        nearest neighbor and z-section queries) of the nodes and connectors
+        of the skeletons in sids (default all skeletons)
+
+        The index is loaded, updated and saved like connector_index
+        (default nodes.npz next to the skeletons of a FileSource)
+        """
+        if fn is None:
+            fn = self._index_filename('nodes.npz')
+        return self._load_index(
+            population.node_index.NodeIndex, fn, sids, update)
 
     def get_tags(self, save=True):
         """gets all tags and saves file if save==True"""
         population.all_tags.get_tags(self, save)
 
+    def myelination_report(self, sk_list=None, fn=None, processes=None):
+        """Returns a table of the myelination of all axons (see
+        population.myelination.myelination_table) and saves it to
+        fn (csv or npz) if provided"""
+        table = population.myelination.myelination_table(
+            self, sk_list, processes=processes)
+        if fn is not None:
+            population.myelination.save_table(table, fn)
+        return table
+
     def unlabeled_leaves(self, save=True):
         """gets all unlabeled leaves and saves to file if save==True"""
         population.unlabeled_leaves.get_unlabeled_leaves(self, save=save)
@@ -290,12 +349,14 @@ class ServerSource(Source):
             yield int(sk_id)
 
     # TODO find a place for this
-    def get_graph(self, sk_list=None, directed=False):
+    def get_graph(self, sk_list=None, directed=False, dense=False):
+        """Returns a sparse (numpy array if dense) adjacency matrix and
+        the skeleton list that defines the rows/columns"""
         if sk_list is None:
-            adj, sk_list = self._skel_source.adjacency_matrix()
+            adj, sk_list = self._skel_source.adjacency_matrix(dense=dense)
         else:
             adj, sk_list = population.graph_tools.get_adj_mat(
-                self, sk_list, directed)
+                self, sk_list, directed, dense)
         return adj, sk_list
 
 
@@ -333,8 +394,13 @@ class FileSource(Source):
                 raise Exception
             yield int(m[0])
 
+    def _index_filename(self, name):
+        return os.path.join(self._skel_source, name)
+
     # TODO find a place for this
-    def get_graph(self, sk_list=None, directed=False):
+    def get_graph(self, sk_list=None, directed=False, dense=False):
+        """Returns a sparse (numpy array if dense) adjacency matrix and
+        the skeleton list that defines the rows/columns"""
         adj, sk_list = population.graph_tools.get_adj_mat(
-            self, sk_list, directed)
+            self, sk_list, directed, dense)
         return adj, sk_list
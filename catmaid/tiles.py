@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""
+Image tiles of catmaid stacks
+
+TileSource builds the urls of the tiles of one stack (see
+Connection.tile_source). TileCache keeps decoded tiles (numpy arrays) in
+memory up to a byte budget and (optionally) on disk, least recently used
+tiles are evicted first. Tiles are keyed by (project, stack, tiletype,
+zoom, z, row, column), see TileSource.cache_key.
+See Connection.enable_tile_cache.
+"""
+
+import collections
+import glob
+import logging
+import math
+import os
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+from . import errors
+
+
+# url templates by tiletype, see
+# http://catmaid.readthedocs.io/en/stable/tile_sources.html
+# tiletypes 6 and 8 have one template per xyz_format
+tile_templates = {
+    1: '{base}{z_index}/{row}_{column}_{zoom}.{ext}',
+    2: ('{base}?x={col_by_width}&y={row_by_height}&z={z_index}&width='
+        '{tile_width}&height={tile_height}&scale={zoomlevel}'
+        '&row={row}&col={column}'),
+    3: ('{catmaid_url}{project_id}/stack/{stack_id}/tile?x='
+        '{col_by_width}&y={row_by_height}&z={z_index}&width='
+        '{tile_width}&height={tile_height}&scale={zoomlevel}&row={row}'
+        '&col={column}&file_extension={ext}&basename={base}&type=all'),
+    4: '{base}{z_index}/{zoom}/{row}_{column}.{ext}',
+    5: '{base}{zoom}/{z_index}/{row}/{column}.{ext}',
+    '6_xy': ('{base}{tile_width}_{tile_height}/{col_by_width}_'
+             '{row_by_height}_{z_index}/{ext}'),
+    '6_xz': ('{base}{tile_width}_{tile_height}/{col_by_width}_'
+             '{z_index}_{row_by_height}/{ext}'),
+    '6_yz': ('{base}{tile_width}_{tile_height}/{z_index}_'
+             '{row_by_height}_{col_by_width}/{ext}'),
+    7: ('{base}largeDataTileSource/{tile_width}/{tile_height}/{zoom}/'
+        '{z_index}/{row}/{column}.{ext}'),
+    '8_xy': '{base}xy/{zoom}/{column}_{row}_{z_index}',
+    '8_xz': '{base}xz/{zoom}/{column}_{z_index}_{row}',
+    '8_yz': '{base}yz/{zoom}/{z_index}_{row}_{column}',
+    9: '{base}{z_index}/{row}_{column}_{zoom}.{ext}'}
+
+# template fields that differ per tile
+tile_fields = (
+    'row', 'column', 'z_index', 'zoom', 'row_by_height', 'col_by_width',
+    'zoomlevel')
+
+
+def template_key(tiletype, xyz_format=None):
+    """Returns the tile_templates key of a tiletype (and xyz_format)"""
+    if tiletype not in (6, 8):
+        if tiletype not in tile_templates:
+            raise ValueError("Unknown tiletype {}".format(tiletype))
+        return tiletype
+    if xyz_format is None:
+        raise ValueError(
+            "xyz_format must be provided for tiletype {}".format(tiletype))
+    if xyz_format == 'zy':
+        # 'yz' and 'zy' are the same
+        xyz_format = 'yz'
+    if xyz_format not in ('xy', 'xz', 'yz'):
+        raise ValueError("Unknown xyz_format {}".format(xyz_format))
+    return '{}_{}'.format(tiletype, xyz_format)
+
+
+class TileSource(object):
+    """
+    Tile urls of one stack (from its Connection.stack_info) for one
+    tiletype (and xyz_format for tiletypes 6 and 8)
+
+    The url template is filled with the stack constants once so each url
+    only formats the row, column, z_index and zoom of the tile. Tiles are
+    valid for 0 <= row < rows(zoom) and 0 <= column < columns(zoom).
+    """
+    def __init__(self, stack_info, server, tiletype=4, xyz_format=None,
+                 stack_id=None):
+        if len(stack_info['mirrors']) > 1:
+            logging.warning(
+                "More than 1 mirror information present in stack info. "
+                "Grabbing image dimensions from first mirror")
+        mirror = stack_info['mirrors'][0]
+        self.stack_id = stack_info['sid'] if stack_id is None else stack_id
+        self.project_id = stack_info['pid']
+        self.tiletype = tiletype
+        self.xyz_format = xyz_format
+        self.key = template_key(tiletype, xyz_format)
+        self.tile_width = mirror['tile_width']
+        self.tile_height = mirror['tile_height']
+        self.dimension = stack_info['dimension']
+        constants = {
+            'base': str(mirror['image_base']),
+            'ext': str(mirror['file_extension']),
+            'tile_width': self.tile_width, 'tile_height': self.tile_height,
+            'project_id': self.project_id, 'stack_id': self.stack_id,
+            'catmaid_url': server}
+        # escape braces of the constants for the per tile format
+        fields = dict([
+            (k, str(v).replace('{', '{{').replace('}', '}}'))
+            for (k, v) in constants.items()])
+        fields.update([(k, '{' + k + '}') for k in tile_fields])
+        template = tile_templates[self.key]
+        self.template = template.format(**fields)
+        if self.template[:4] != 'http':
+            self.template = server + self.template
+
+    def cache_key(self, row, column, z_index, zoom=0):
+        """Returns the TileCache key of a tile"""
+        return (
+            self.project_id, self.stack_id, self.key, zoom, z_index, row,
+            column)
+
+    def rows(self, zoom=0):
+        """Number of rows of tiles at zoom"""
+        return int(self.dimension['y'] * 2. ** -zoom) // self.tile_height
+
+    def columns(self, zoom=0):
+        """Number of columns of tiles at zoom"""
+        return int(self.dimension['x'] * 2. ** -zoom) // self.tile_width
+
+    def valid(self, rows, columns, zoom=0):
+        """Returns a boolean array of (broadcast) rows and columns
+        that are tiles of the stack"""
+        rows = numpy.asarray(rows)
+        columns = numpy.asarray(columns)
+        return (
+            (rows >= 0) & (rows < self.rows(zoom)) &
+            (columns >= 0) & (columns < self.columns(zoom)))
+
+    def _format(self, row, column, z_index, zoom):
+        return self.template.format(
+            row=row, column=column, z_index=z_index, zoom=zoom,
+            row_by_height=row * self.tile_height,
+            col_by_width=column * self.tile_width,
+            zoomlevel=2 ** (-zoom))
+
+    def url(self, row, column, z_index, zoom=0):
+        """Returns the url of one tile, raises errors.InvalidUrl for
+        tiles outside of the stack"""
+        if not 0 <= row < self.rows(zoom):
+            raise errors.InvalidUrl("Invalid row %s" % row)
+        if not 0 <= column < self.columns(zoom):
+            raise errors.InvalidUrl("Invalid column %s" % column)
+        return self._format(row, column, z_index, zoom)
+
+    def urls(self, rows, columns, z_indices, zoom=0):
+        """
+        Returns a list of urls of the tiles of (broadcast) arrays of rows,
+        columns and z_indices, None for tiles outside of the stack
+        """
+        rows, columns, z_indices = numpy.broadcast_arrays(
+            rows, columns, z_indices)
+        valid = self.valid(rows, columns, zoom).ravel()
+        return [
+            self._format(r, c, z, zoom) if v else None
+            for (r, c, z, v) in zip(
+                rows.ravel().tolist(), columns.ravel().tolist(),
+                z_indices.ravel().tolist(), valid.tolist())]
+
+    def plan(self, bbox, zoom=0):
+        """
+        Plans the tiles of a sub-volume
+
+        bbox is ((x0, y0, z0), (x1, y1, z1)) in stack pixels (at zoom 0)
+        and section indices, the upper bounds are excluded. x and y are
+        scaled to zoom.
+
+        Returns the (z, y, x) shape of the volume and a list of
+        (z_index, row, column, url, (y, x) volume slices, (y, x) tile
+        slices) for every tile that overlaps the volume, url is None for
+        tiles outside of the stack
+        """
+        (x0, y0, z0), (x1, y1, z1) = bbox
+        scale = 2. ** -zoom
+        x0, y0 = int(math.floor(x0 * scale)), int(math.floor(y0 * scale))
+        x1, y1 = int(math.ceil(x1 * scale)), int(math.ceil(y1 * scale))
+        shape = (max(z1 - z0, 0), max(y1 - y0, 0), max(x1 - x0, 0))
+        if 0 in shape:
+            return shape, []
+        pieces = []
+        for (row, rs, ts) in _tile_spans(y0, y1, self.tile_height):
+            for (column, cs, tcs) in _tile_spans(x0, x1, self.tile_width):
+                pieces.append((row, column, (rs, cs), (ts, tcs)))
+        rows = [p[0] for p in pieces]
+        columns = [p[1] for p in pieces]
+        tiles = []
+        for z in range(z0, z1):
+            urls = self.urls(rows, columns, z, zoom)
+            tiles.extend([
+                (z, row, column, url, vs, ts) for (
+                    (row, column, vs, ts), url) in zip(pieces, urls)])
+        return shape, tiles
+
+
+def _tile_spans(start, stop, size):
+    """Generates (tile, volume slice, tile slice) of the tiles (of size)
+    covering start <= i < stop"""
+    for tile in range(start // size, (stop - 1) // size + 1):
+        a = max(start, tile * size)
+        b = min(stop, (tile + 1) * size)
+        yield tile, slice(a - start, b - start), slice(
+            a - tile * size, b - tile * size)
+
+
+class TileCache(object):
+    """
+    LRU cache of tiles in memory (max_bytes) and on disk (in directory,
+    up to max_disk_bytes, None for no limit)
+
+    Tiles on disk are stored compressed (npz) if compress is True or as
+    raw arrays (npy) that are memory mapped when loaded.
+
+    Cached tiles are read-only, copy them before drawing on them.
+    Prefetching uses background threads, stop them with close.
+    """
+    def __init__(self, max_bytes=256 * 2 ** 20, directory=None,
+                 max_disk_bytes=None, compress=True, prefetch_threads=4):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.compress = compress
+        self.prefetch_threads = prefetch_threads
+        self._setup()
+        if directory is not None:
+            self._scan_disk()
+
+    def _setup(self):
+        self._tiles = collections.OrderedDict()
+        self._disk = collections.OrderedDict()
+        self.nbytes = 0
+        self.disk_nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        self._pool = None
+        # key: Event set when the prefetch of key is done
+        self._pending = {}
+
+    def __getstate__(self):
+        # only the configuration is pickled, memory contents are dropped
+        return dict([
+            (k, getattr(self, k)) for k in (
+                'max_bytes', 'directory', 'max_disk_bytes', 'compress',
+                'prefetch_threads')])
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._setup()
+        if self.directory is not None:
+            self._scan_disk()
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def __contains__(self, key):
+        key = tuple(key)
+        with self._lock:
+            return key in self._tiles or key in self._disk
+
+    def _ext(self):
+        return 'npz' if self.compress else 'npy'
+
+    def filename(self, key):
+        """Filename of a tile in the disk cache"""
+        project, stack, tiletype, zoom, z, row, column = key
+        return os.path.join(
+            self.directory, str(project), str(stack), str(tiletype),
+            str(zoom), str(z), '{}_{}.{}'.format(row, column, self._ext()))
+
+    def _scan_disk(self):
+        """Find tiles already in the disk cache (oldest first)"""
+        pattern = os.path.join(
+            self.directory, '*', '*', '*', '*', '*', '*_*.' + self._ext())
+        files = []
+        for fn in glob.glob(pattern):
+            parts = fn[len(self.directory):].strip(os.sep).split(os.sep)
+            row, column = os.path.splitext(parts[5])[0].split('_')
+            # tiletypes with an xyz_format are stored as for example 6_xy
+            tiletype = int(parts[2]) if parts[2].isdigit() else parts[2]
+            key = (int(parts[0]), int(parts[1]), tiletype, int(parts[3]),
+                   int(parts[4]), int(row), int(column))
+            st = os.stat(fn)
+            files.append((st.st_mtime, key, st.st_size))
+        for (_, key, size) in sorted(files):
+            self._disk[key] = size
+            self.disk_nbytes += size
+
+    def _load(self, key):
+        fn = self.filename(key)
+        try:
+            if self.compress:
+                with numpy.load(fn) as f:
+                    tile = f['tile']
+            else:
+                tile = numpy.load(fn, mmap_mode='r')
+        except (IOError, ValueError, KeyError) as e:
+            logging.warning("Failed to load cached tile %s: %s", fn, e)
+            self._remove_file(key)
+            return None
+        os.utime(fn, None)
+        return tile
+
+    def _save(self, key, tile):
+        fn = self.filename(key)
+        d = os.path.dirname(fn)
+        if not os.path.isdir(d):
+            try:
+                os.makedirs(d)
+            except OSError:
+                # made by another thread
+                pass
+        # write to a temporary file so partial tiles are never loaded
+        tmp = '{}.{}.tmp'.format(fn, threading.current_thread().ident)
+        with open(tmp, 'wb') as f:
+            if self.compress:
+                numpy.savez_compressed(f, tile=tile)
+            else:
+                numpy.save(f, tile)
+        os.rename(tmp, fn)
+        size = os.path.getsize(fn)
+        with self._lock:
+            self.disk_nbytes -= self._disk.pop(key, 0)
+            self._disk[key] = size
+            self.disk_nbytes += size
+            if self.max_disk_bytes is not None:
+                while self.disk_nbytes > self.max_disk_bytes and \
+                        len(self._disk) > 1:
+                    self._remove_file(next(iter(self._disk)))
+
+    def _remove_file(self, key):
+        with self._lock:
+            self.disk_nbytes -= self._disk.pop(key, 0)
+        try:
+            os.remove(self.filename(key))
+        except OSError:
+            pass
+
+    def get(self, key):
+        """Returns the tile for key or None if it is not cached"""
+        key = tuple(key)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles[key] = tile = self._tiles.pop(key)
+                self.hits += 1
+                return tile
+            on_disk = key in self._disk
+            if on_disk:
+                self._disk[key] = self._disk.pop(key)
+        tile = None
+        if on_disk:
+            tile = self._load(key)
+        with self._lock:
+            if tile is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._add(key, tile)
+        return tile
+
+    def _add(self, key, tile):
+        tile.setflags(write=False)
+        with self._lock:
+            if key in self._tiles:
+                self.nbytes -= self._tiles.pop(key).nbytes
+            self._tiles[key] = tile
+            self.nbytes += tile.nbytes
+            while self.nbytes > self.max_bytes and len(self._tiles) > 1:
+                self.nbytes -= self._tiles.popitem(last=False)[1].nbytes
+
+    def put(self, key, tile):
+        """Add (a read-only copy of) a tile to the cache (and the disk
+        cache)"""
+        key = tuple(key)
+        tile = numpy.array(tile)
+        self._add(key, tile)
+        if self.directory is not None:
+            self._save(key, tile)
+
+    def clear(self, disk=False):
+        """Remove all tiles from memory (and disk if disk is True)"""
+        with self._lock:
+            self._tiles.clear()
+            self.nbytes = 0
+            if disk:
+                for key in list(self._disk.keys()):
+                    self._remove_file(key)
+
+    def close(self):
+        """Stop the prefetch threads, pending prefetches are dropped"""
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+            for event in self._pending.values():
+                event.set()
+            self._pending.clear()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def _prefetch(self, args):
+        fetch, key = args
+        try:
+            if self.get(key) is None:
+                tile = fetch(key)
+                if tile is not None:
+                    self.put(key, tile)
+        except Exception as e:
+            logging.debug("Failed to prefetch tile %s: %s", key, e)
+        finally:
+            with self._lock:
+                event = self._pending.pop(key, None)
+            if event is not None:
+                event.set()
+
+    def wait(self, key, timeout=None):
+        """Wait (up to timeout seconds) until a pending prefetch of key
+        is done, returns at once if key is not being prefetched"""
+        with self._lock:
+            event = self._pending.get(tuple(key))
+        if event is not None:
+            event.wait(timeout)
+
+    def prefetch(self, fetch, keys):
+        """
+        Fetch tiles in the background with fetch(key) (returning a tile
+        or None) for keys that are not cached or already being fetched
+        """
+        todo = []
+        with self._lock:
+            for key in keys:
+                key = tuple(key)
+                if key in self._pending or key in self._tiles or \
+                        key in self._disk:
+                    continue
+                self._pending[key] = threading.Event()
+                todo.append((fetch, key))
+            if len(todo) == 0:
+                return
+            if self._pool is None:
+                self._pool = ThreadPool(self.prefetch_threads)
+        for args in todo:
+            self._pool.apply_async(self._prefetch, (args, ))
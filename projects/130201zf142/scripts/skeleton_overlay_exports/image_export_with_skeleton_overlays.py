@@ -173,7 +173,8 @@ def soma_through_projection_to_leaf(source, skeleton_id=None, neuron=None):
 
 def setup_skel_paths(source, skels_list):
     """
-    Creates dictionaries in the format of 'Skel_ID: x,y,z coordinates'.
+    Creates dictionaries in the format of
+    'Skel_ID: (node: x,y,z coordinates, [(child, parent), ...])'.
     Takes a source(catmaid) along with two lists of skeleton ids.
     Outputs a dictonary for the input skeletons.
     """
@@ -191,7 +192,12 @@ def setup_skel_paths(source, skels_list):
                                    neu.nodes[item]['y'],
                                    neu.nodes[item]['z']]) / resXYZ
                 coordinate_dict[item] = xyz
-            paths[skel_ID] = coordinate_dict
+            # parent/child edges between path nodes
+            edges = [
+                (child, parent) for child in coordinate_dict
+                for parent in neu.dedges.get(child, {})
+                if parent in coordinate_dict]
+            paths[skel_ID] = (coordinate_dict, edges)
     return paths
 
 
@@ -199,20 +205,31 @@ def setup_dicts(zstoget, paths, source):
     """
     Takes the dictionary created by the setup_skel_paths function and outputs
     a dictionary for the skels. The format of these dictionaries is
-    'z_index: points, colors'.
+    'z_index: points, colors, edges, edge colors' where edges are the
+    parent/child edges (x0, y0, x1, y1) clipped to the section.
     """
+    # index path nodes and edges by (z index) section once instead of per z
+    index = catmaid.algorithms.population.node_index.SectionIndex()
+    for sid in paths.keys():
+        nodes, edges = paths[sid]
+        nids = list(nodes.keys())
+        i = dict([(n, j) for (j, n) in enumerate(nids)])
+        index.add_arrays(
+            int(sid), nids, [nodes[n] for n in nids],
+            [(i[c], i[p]) for (c, p) in edges], compact=False)
     Zdict = {}
     for z in zstoget:
         pts, cols = [], []
-        for sid in paths.keys():
-            nodes = paths[sid]
-            for node in nodes:
-                if nodes[node][2] == z:
-                    zpts = numpy.array([int(sid), nodes[node][0], nodes[node][1]])
-                    pts.append(zpts)
-                    cols.append(colord[sid])
+        nodes, edges = index.section(index.section_of(z))
+        for node in nodes:
+            pts.append(numpy.array([node['skeleton'], node['x'], node['y']]))
+            cols.append(colord[node['skeleton']])
         if len(pts) > 1:
-            Zdict[z] = {'pts': pts, 'cols': cols}
+            Zdict[z] = {
+                'pts': pts, 'cols': cols,
+                'edges': numpy.column_stack((
+                    edges['x0'], edges['y0'], edges['x1'], edges['y1'])),
+                'edge_cols': [colord[sid] for sid in edges['skeleton']]}
     return Zdict
 
 
@@ -243,6 +260,9 @@ def gen_imgs(connection, Zdict, image_copy=False):
                                                 int(Yavg), int(z),
                                                 imgshape=(4096, 3072),
                                                 points=pts, colors=cols,
+                                                edges=Zdict[z]['edges'],
+                                                edge_colors=Zdict[z][
+                                                    'edge_cols'],
                                                 stack_id=6, tiletype=4,
                                                 add_points=True,
                                                 image_copy=image_copy)
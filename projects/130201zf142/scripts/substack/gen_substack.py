@@ -1,13 +1,12 @@
 import argparse
 import catmaid
-import catmaid.algorithms.images as IM
 import os
 import scipy.misc
-import urllib2
 
 
 conn = catmaid.connect()
 s = catmaid.get_source(conn)
+conn.enable_tile_cache()
 
 
 def gen_images(connection, zrange, center, outdir,
@@ -16,25 +15,30 @@ def gen_images(connection, zrange, center, outdir,
         raise Exception("Must pass in a tuple for the image range!")
     if not isinstance(center, tuple):
         raise Exception("Must pass in a tuple for the center position")
-    broken_slices = [int(a) for a in
-                     conn.stack_info()[6][u'broken_slices'].keys()]
-    for z in range(zrange[0], zrange[1]):
-        if z not in broken_slices:
-            print "Outputting image for z: {}".format(z)
-            fn = '{}_sub.png'.format(str(int(z)).zfill(5))
-            try:
-                image, no_overlay = IM.img_from_catmaid(connection, center[0],
-                                                        center[1], int(z),
-                                                        imgshape=imgshape,
-                                                        stack_id=6, tiletype=4,
-                                                        add_points=False,
-                                                        image_copy=False)
-                if not os.path.exists(outdir):
-                    os.makedirs(outdir)
-                scipy.misc.imsave((outdir + fn), image)
-            except urllib2.HTTPError as e:
-                print("Could not grab image for z: {} due to {}. Moving on "
-                      "to next image".format(z, e))
+    broken_slices = set([int(a) for a in
+                         conn.stack_info()[6][u'broken_slices'].keys()])
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    left = center[0] - imgshape[0] / 2
+    top = center[1] - imgshape[1] / 2
+    bbox = ((left, top, zrange[0]),
+            (left + imgshape[0], top + imgshape[1], zrange[1]))
+    # sections are streamed, broken slices are never fetched and sections
+    # whose tiles all failed are skipped
+    z_indices = [z for z in range(zrange[0], zrange[1])
+                 if z not in broken_slices]
+    written = set()
+    for (z, image) in connection.iter_volume(
+            bbox, stack_id=6, tiletype=4, prefetch=1, z_indices=z_indices,
+            skip_missing=True):
+        print "Outputting image for z: {}".format(z)
+        fn = '{}_sub.png'.format(str(int(z)).zfill(5))
+        scipy.misc.imsave((outdir + fn), image)
+        written.add(z)
+    for z in z_indices:
+        if z not in written:
+            print("Could not grab image for z: {}, "
+                  "skipped".format(z))
 
 
 def directory(path):
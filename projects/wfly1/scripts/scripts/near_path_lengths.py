@@ -20,20 +20,12 @@ if len(sys.argv) > 1:
     distance = float(sys.argv[1])
 
 
-def npl(a, d, s):
-    na = s.get_neuron(a)
-    #if len(na.axons) != 1:
-    #    return float('nan')
-    nd = s.get_neuron(d)
-    try:
-        #return catmaid.algorithms.population.distance.near_path_length(
-        #    nd, na, g1=nd.dendrites, g2=na.axons.values()[0]['tree'],
-        #    distance=distance, resample_distance=resample_distance)
-        return catmaid.algorithms.population.distance.near_path_length(
-            nd, na, g1=nd.dendrites, g2=na.dendrites,
-            distance=distance, resample_distance=resample_distance)
-    except Exception as e:
-        return e
+def npl(chunk, s):
+    # (a, d) -> (d, a) so each neuron a is loaded and indexed once per chunk
+    return catmaid.algorithms.population.distance.near_path_lengths(
+        s, [(d, a) for (a, d) in chunk],
+        g1=lambda n: n.dendrites, g2=lambda n: n.dendrites,
+        distance=distance, resample_distance=resample_distance)
 
 
 n_jobs = -1
@@ -87,9 +79,14 @@ else:
 
 
 
+# group pairs by the indexed neuron and split into chunks
+pairs = sorted(pairs)
+n_chunks = 200
+chunk_size = max(1, len(pairs) // n_chunks + 1)
+chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
 rs = joblib.parallel.Parallel(n_jobs=n_jobs, verbose=50)(
-    joblib.parallel.delayed(npl)(
-        a, d, s) for (a, d) in pairs)
+    joblib.parallel.delayed(npl)(chunk, s) for chunk in chunks)
+rs = [r for chunk_rs in rs for r in chunk_rs]
 
 fails = []
 if output_file is not None:
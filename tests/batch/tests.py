@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+import unittest
+
+import catmaid
+
+
+def _scaled(item):
+    if item < 0:
+        raise ValueError("negative item")
+    return item * catmaid.algorithms.batch.state()['scale']
+
+
+class BatchTest(unittest.TestCase):
+    def test_map_items(self):
+        batch = catmaid.algorithms.batch
+        for processes in (None, 2):
+            r = batch.map_items(_scaled, range(5), {'scale': 2}, processes)
+            self.assertEqual(sorted(r), [0, 2, 4, 6, 8])
+            self.assertEqual(batch.state(), {})
+
+    def test_map_items_cleanup(self):
+        batch = catmaid.algorithms.batch
+        for processes in (None, 2):
+            r = batch.map_items(_scaled, [1, -1, 2], {'scale': 2}, processes)
+            self.assertRaises(ValueError, list, r)
+            self.assertEqual(batch.state(), {})
+            # closing early also clears the state
+            r = batch.map_items(_scaled, range(5), {'scale': 2}, processes)
+            next(r)
+            r.close()
+            self.assertEqual(batch.state(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
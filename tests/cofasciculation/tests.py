@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+import numpy
+
+import catmaid
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixtures import FakeSource, make_skeleton  # noqa: E402
+
+
+# a straight line along x from 0 to 2000
+line_nron = catmaid.neuron.Neuron(make_skeleton(
+    {'1': (0., 0., 0.), '2': (1000., 0., 0.), '3': (2000., 0., 0.)},
+    {'2': '1', '3': '2'}))
+# crosses over line_nron 500 above its middle node (and along y)
+cross_nron = catmaid.neuron.Neuron(make_skeleton(
+    {'11': (1000., -1000., 500.), '12': (1000., 1000., 500.),
+     '13': (1000., 1000., 500.)},
+    {'12': '11', '13': '12'}, sid=2))
+
+# a single long edge, parallel to line_nron (500 away) from 1500 to 500
+offset_nron = catmaid.neuron.Neuron(make_skeleton(
+    {'21': (1500., 500., 0.), '22': (500., 500., 0.)},
+    {'22': '21'}, sid=3))
+
+
+class CofasciculationTest(unittest.TestCase):
+    def test_cofasciculation2(self):
+        cof = catmaid.algorithms.population.cofasciculation
+        r = cof.cofasciculation2(
+            line_nron, line_nron.dgraph, cross_nron, cross_nron.dgraph,
+            distance_threshold=600., angle_threshold=None)
+        # the 0 length edge (12 -> 13) is skipped
+        self.assertEqual(len(r), 2)
+        self.assertEqual(list(r['u2']), [11, 11])
+        # true segment distance, not the distance between end points
+        numpy.testing.assert_allclose(r['distance'], [500., 500.])
+        numpy.testing.assert_allclose(r['angle'], [numpy.pi / 2.] * 2)
+        self.assertEqual(len(cof.cofasciculation2(
+            line_nron, line_nron.dgraph, cross_nron, cross_nron.dgraph,
+            distance_threshold=400., angle_threshold=None)), 0)
+        self.assertEqual(len(cof.cofasciculation2(
+            line_nron, line_nron.dgraph, cross_nron, cross_nron.dgraph,
+            distance_threshold=600., angle_threshold=45.)), 0)
+
+    def test_cofasciculation(self):
+        cof = catmaid.algorithms.population.cofasciculation
+        r = cof.cofasciculation(
+            line_nron, line_nron.dgraph, line_nron, line_nron.dgraph,
+            distance=10.)
+        # each edge is near itself and its neighbour
+        self.assertEqual(len(r), 4)
+        self.assertTrue(numpy.all(r['metric'] > 0.))
+        self.assertEqual(len(cof.cofasciculation(
+            line_nron, line_nron.dgraph, cross_nron, cross_nron.dgraph,
+            distance=600.)['metric'].nonzero()[0]), 0)
+
+    def test_bundle_matrix(self):
+        cof = catmaid.algorithms.population.cofasciculation
+        source = FakeSource({0: line_nron, 1: offset_nron, 2: cross_nron})
+        m = cof.bundle_matrix(
+            source, distance_threshold=600., angle_threshold=30.,
+            chunk_size=1).toarray()
+        expected = numpy.zeros((3, 3))
+        # 500 to 1500 + sqrt(600 ** 2 - 500 ** 2) on each end
+        expected[0, 1] = 1000. + 2 * numpy.sqrt(600. ** 2 - 500. ** 2)
+        expected[1, 0] = 1000.
+        numpy.testing.assert_allclose(m, expected)
+        # without an angle threshold, the crossing edges count
+        m = cof.bundle_matrix(
+            source, distance_threshold=600., angle_threshold=None).toarray()
+        self.assertTrue(m[0, 2] > 0.)
+        self.assertTrue(m[2, 0] > 0.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+import numpy
+
+import catmaid
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixtures import FakeSource, make_skeleton  # noqa: E402
+
+
+# a straight line along x from 0 to 2000
+line_nron = catmaid.neuron.Neuron(make_skeleton(
+    {'1': (0., 0., 0.), '2': (1000., 0., 0.), '3': (2000., 0., 0.)},
+    {'2': '1', '3': '2'}))
+# a single long edge, parallel to line_nron (500 away) from 500 to 1500
+offset_nron = catmaid.neuron.Neuron(make_skeleton(
+    {'11': (500., 500., 0.), '12': (1500., 500., 0.)},
+    {'12': '11'}, sid=2))
+# length of line_nron within 600 of offset_nron:
+# 500 to 1500 + sqrt(600 ** 2 - 500 ** 2) on each end
+exact_600 = 1000. + 2 * numpy.sqrt(600. ** 2 - 500. ** 2)
+
+
+class NearPathLengthTest(unittest.TestCase):
+    def npl(self, **kwargs):
+        return catmaid.algorithms.population.distance.near_path_length(
+            line_nron, offset_nron, line_nron.dgraph, offset_nron.dgraph,
+            **kwargs)
+
+    def test_nodes(self):
+        # only nodes are considered, no node of line_nron is near
+        self.assertEqual(self.npl(distance=600.), 0.)
+        # resampling approaches the exact value
+        length = self.npl(distance=600., resample_distance=10.)
+        self.assertTrue(abs(length - exact_600) <= 20.)
+
+    def test_md(self):
+        r = catmaid.algorithms.population.distance.near_path_length_md(
+            line_nron, offset_nron, line_nron.dgraph, offset_nron.dgraph,
+            distances=[100., 600.], resample_distance=10.)
+        self.assertEqual(r[100.]['l'], 0.)
+        self.assertAlmostEqual(r[600.]['l'], self.npl(
+            distance=600., resample_distance=10.))
+
+    def test_exact(self):
+        self.assertEqual(self.npl(distance=400., exact=True), 0.)
+        length, segs = self.npl(distance=600., exact=True, segments=True)
+        self.assertAlmostEqual(length, exact_600)
+        self.assertAlmostEqual(
+            numpy.linalg.norm(segs[:, 3:] - segs[:, :3], axis=1).sum(),
+            exact_600)
+
+    def test_near_path_lengths(self):
+        distance = catmaid.algorithms.population.distance
+        source = FakeSource({1: line_nron, 2: offset_nron})
+
+        def g(n):
+            return n.dgraph
+
+        built = []
+        segment_tree = distance.segment_tree
+
+        def counting_segment_tree(n, graph=None, resample_distance=None):
+            built.append(n.skeleton_id)
+            return segment_tree(n, graph, resample_distance)
+
+        distance.segment_tree = counting_segment_tree
+        try:
+            pairs = [(1, 2), (2, 2), (1, 1), (1, 2)]
+            r = distance.near_path_lengths(
+                source, pairs, g1=g, g2=g, distance=600., exact=True)
+            # each indexed neuron is built once
+            self.assertEqual(sorted(built), [1, 2])
+            self.assertAlmostEqual(r[0], exact_600)
+            self.assertEqual(r[0], r[3])
+            del built[:]
+            rc = distance.near_path_lengths(
+                source, pairs, g1=g, g2=g, distance=600., exact=True,
+                max_cached=1)
+            # 2 is dropped for 1 and rebuilt
+            self.assertEqual(built, [2, 1, 2])
+            self.assertEqual(rc, r)
+        finally:
+            distance.segment_tree = segment_tree
+
+
+class HausdorffTest(unittest.TestCase):
+    def test_hausdorff(self):
+        h = catmaid.algorithms.population.distance.hausdorff(
+            offset_nron, line_nron, offset_nron.dgraph, line_nron.dgraph)
+        self.assertAlmostEqual(h, numpy.sqrt(2 * 500. ** 2))
+        # resampling line_nron brings it closer to offset_nron
+        h = catmaid.algorithms.population.distance.hausdorff(
+            offset_nron, line_nron, offset_nron.dgraph, line_nron.dgraph,
+            resample_distance=10.)
+        self.assertAlmostEqual(h, 500.)
+        h = catmaid.algorithms.population.distance.hausdorff(
+            offset_nron, line_nron, offset_nron.dgraph, line_nron.dgraph,
+            resample_distance=10., symmetric=True)
+        self.assertAlmostEqual(h, numpy.sqrt(2 * 500. ** 2))
+
+    def test_hausdorff_pairs(self):
+        source = FakeSource({1: line_nron, 2: offset_nron})
+        r = catmaid.algorithms.population.distance.hausdorff_pairs(
+            source, [(1, 2), (2, 1)], g1=lambda n: n.dgraph,
+            g2=lambda n: n.dgraph, resample_distance=10., percentiles=[50])
+        self.assertEqual(r[0]['directed'], r[1]['reverse'])
+        self.assertEqual(r[0]['symmetric'], r[1]['symmetric'])
+        self.assertAlmostEqual(r[1]['directed'], 500.)
+        self.assertAlmostEqual(r[1]['directed_p50'], 500.)
+
+
+class MergeIntervalsTest(unittest.TestCase):
+    def test_merge_intervals(self):
+        merge = catmaid.algorithms.spatial.merge_intervals
+        ids = numpy.array([3, 1, 1, 1, 3, 2])
+        lo = numpy.array([0.5, 0.0, 0.2, 0.7, 0.0, 0.6])
+        hi = numpy.array([0.9, 0.4, 0.3, 0.8, 0.1, 0.5])
+        ids, lo, hi = merge(ids, lo, hi)
+        # the empty interval of id 2 is dropped
+        self.assertEqual(ids.tolist(), [1, 1, 3, 3])
+        self.assertEqual(lo.tolist(), [0.0, 0.7, 0.0, 0.5])
+        self.assertEqual(hi.tolist(), [0.4, 0.8, 0.1, 0.9])
+
+    def test_large_ids(self):
+        # ids as large as a pair index (i * n + j) keep hi exact
+        big = 2 ** 52
+        ids = numpy.array([big, big, big + 1, big + 1], dtype='i8')
+        lo = numpy.array([0.1, 0.3, 0.0, 0.2])
+        hi = numpy.array([0.2, 0.4, 0.25, 0.3])
+        ids, lo, hi = catmaid.algorithms.spatial.merge_intervals(
+            ids, lo, hi)
+        self.assertEqual(ids.tolist(), [big, big, big + 1])
+        self.assertEqual(lo.tolist(), [0.1, 0.3, 0.0])
+        self.assertEqual(hi.tolist(), [0.2, 0.4, 0.3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Skeleton and source fixtures shared by the test suites
+
+The suites are run from their own directory (tests/<topic>/tests.py) and
+put this directory on sys.path before importing fixtures.
+"""
+
+import json
+
+import catmaid
+
+
+def vertex(xyz, vtype='skeleton'):
+    """A catmaid1 vertex at xyz"""
+    x, y, z = xyz
+    return {
+        'x': x, 'y': y, 'z': z, 'radius': -1, 'type': vtype,
+        'labels': [], 'confidence': 5}
+
+
+def make_skeleton(nodes, parents, sid=1, connectors=None, links=()):
+    """Build a catmaid1 skeleton from {nid: (x, y, z)} nodes, {child: parent}
+    edges, {cid: (x, y, z)} connectors and [(nid, cid, type)] synapse links"""
+    verts = {}
+    conns = {}
+    for nid in nodes:
+        verts[nid] = vertex(nodes[nid])
+    for cid in parents:
+        conns[cid] = {parents[cid]: {'type': 'neurite'}}
+    for cid in (connectors or {}):
+        verts[cid] = vertex(connectors[cid], 'connector')
+    for (nid, cid, t) in links:
+        conns.setdefault(nid, {})[cid] = {'type': t}
+    return {
+        'neuron': {'neuronname': 'test', 'id': sid, 'annotations': []},
+        'vertices': verts, 'connectivity': conns, 'id': sid}
+
+
+def chain_skeleton(sid, nodes, connectors=None, links=()):
+    """Build a catmaid1 skeleton with a chain of {nid: (x, y, z)} nodes
+    (linked in id order), see make_skeleton for connectors and links"""
+    nids = sorted(nodes)
+    return make_skeleton(
+        nodes, dict(zip(nids[1:], nids[:-1])), sid=sid,
+        connectors=connectors, links=links)
+
+
+def load_skeleton(fn):
+    """Load a catmaid1 skeleton saved as json"""
+    with open(fn, 'r') as f:
+        return json.load(f)
+
+
+class FakeSource(object):
+    """A source serving neurons from a {skeleton id: neuron} dict"""
+    def __init__(self, neurons):
+        self.neurons = neurons
+
+    @classmethod
+    def from_skeletons(cls, skeletons):
+        return cls(dict([
+            (sk['id'], catmaid.neuron.Neuron(sk)) for sk in skeletons]))
+
+    def skeleton_ids(self):
+        return sorted(self.neurons.keys())
+
+    def get_neuron(self, sk):
+        return self.neurons[sk]
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import scipy.io
+
+import catmaid
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixtures import FakeSource, chain_skeleton  # noqa: E402
+
+
+def on_x(ids):
+    """{id: (id, 0, 0)} locations"""
+    return dict([(i, (float(i), 0., 0.)) for i in ids])
+
+
+# 1 -> 2 (twice) and 3 through connector 100, 2 -> 1 through 200
+source = FakeSource.from_skeletons([
+    chain_skeleton(1, on_x([11, 12]), on_x([100, 200]), [
+        (11, 100, 'presynaptic_to'), (12, 200, 'postsynaptic_to')]),
+    chain_skeleton(2, on_x([21, 22]), on_x([100, 200]), [
+        (21, 100, 'postsynaptic_to'), (22, 100, 'postsynaptic_to'),
+        (21, 200, 'presynaptic_to')]),
+    chain_skeleton(3, on_x([31, 32]), on_x([100]), [
+        (32, 100, 'postsynaptic_to')]),
+])
+
+
+class SynapseTableTest(unittest.TestCase):
+    def test_synapse_table(self):
+        n = source.get_neuron(2)
+        t = n.synapse_table
+        self.assertEqual(
+            sorted(zip(t['connector'], t['node'], t['type'])),
+            [(100, 21, 'postsynaptic_to'), (100, 22, 'postsynaptic_to'),
+             (200, 21, 'presynaptic_to')])
+        self.assertEqual(list(t['connector_x'][t['connector'] == 200]), [200.])
+        si = n.synapse_info
+        self.assertEqual(sorted(si.keys()), [100, 200])
+        self.assertEqual(len(si[100]), 2)
+        self.assertEqual(si[200][0]['vertex_id'], 21)
+        self.assertEqual(si[200][0]['connector']['x'], 200.)
+        self.assertEqual(len(n.output_synapses), 1)
+        self.assertEqual(len(n.input_synapses), 2)
+
+
+class GraphToolsTest(unittest.TestCase):
+    def test_get_sparse_graph(self):
+        gt = catmaid.algorithms.population.graph_tools
+        d, u, index = gt.get_sparse_graph(source, [3, 1, 2])
+        self.assertEqual(index, {3: 0, 1: 1, 2: 2})
+        self.assertEqual(
+            d.toarray().tolist(), [[0, 0, 0], [1, 0, 2], [0, 1, 0]])
+        self.assertEqual(
+            u.toarray().tolist(), [[0, 1, 1], [1, 0, 2], [1, 2, 0]])
+
+    def test_get_graph(self):
+        gt = catmaid.algorithms.population.graph_tools
+        g = gt.get_graph(source)
+        self.assertEqual(sorted(g.nodes()), [1, 2, 3])
+        self.assertEqual(g[1][2]['weight'], 2)
+        self.assertEqual(g[2][3]['weight'], 1)
+        g = gt.get_graph(source, directed=True)
+        self.assertEqual(g[1][2]['weight'], 2)
+        self.assertEqual(g[2][1]['weight'], 1)
+        self.assertFalse(g.has_edge(3, 1))
+        adj, sk_list = gt.get_adj_mat(source, directed=True)
+        self.assertEqual(sk_list, [1, 2, 3])
+        self.assertEqual(
+            adj.toarray().tolist(), [[0, 2, 1], [1, 0, 0], [0, 0, 0]])
+        adj, sk_list = gt.get_adj_mat(source, [2, 3], dense=True)
+        self.assertEqual(adj.tolist(), [[0, 1], [1, 0]])
+
+    def test_to_adjacency_matrix(self):
+        wiring = catmaid.algorithms.wiring
+        wd = {
+            'data': {
+                'nodes': [{'id': 30}, {'id': 10}, {'id': 20}],
+                'edges': [
+                    {'source': 10, 'target': 30, 'number_of_connector': 4},
+                    {'source': 30, 'target': 20, 'number_of_connector': 1}]},
+            'dataSchema': {}}
+        m, sids = wiring.to_adjacency_matrix(wd)
+        self.assertEqual(sids, [10, 20, 30])
+        self.assertEqual(
+            m.toarray().tolist(), [[0, 0, 4], [0, 0, 0], [0, 1, 0]])
+        d, fsids = wiring.to_adjacency_matrix(
+            wiring.diagram_filter(wd, [10]), dense=True)
+        self.assertEqual(fsids, [10, 30])
+        self.assertEqual(d.tolist(), [[0, 4], [0, 0]])
+        tmp = tempfile.mkdtemp()
+        try:
+            afn = os.path.join(tmp, 'adjacency.mat')
+            sfn = os.path.join(tmp, 'skeletons.mat')
+            wiring.save_adjacency_matrix(m, sids, afn, sfn)
+            a = scipy.io.loadmat(afn)['adjacency']
+            self.assertEqual(a.toarray().tolist(), m.toarray().tolist())
+            os.remove(afn)
+            os.remove(sfn)
+            # save does not write .mat files, adjacency_fn does
+            cwd = os.getcwd()
+            os.chdir(tmp)
+            try:
+                wiring.to_adjacency_matrix(wd, save=True)
+                self.assertEqual(os.listdir(tmp), [])
+            finally:
+                os.chdir(cwd)
+            wiring.to_adjacency_matrix(wd, adjacency_fn=afn)
+            self.assertEqual(sorted(os.listdir(tmp)), [
+                'adjacency.mat', 'skeletons.mat'])
+            s = scipy.io.loadmat(sfn)['skeletons']
+            self.assertEqual(s.ravel().tolist(), sids)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class ConnectorIndexTest(unittest.TestCase):
+    def test_lookups(self):
+        index = catmaid.algorithms.population.network.ConnectorIndex()
+        for sid in source.skeleton_ids():
+            index.add_neuron(source.get_neuron(sid))
+        self.assertEqual(len(index), 2)
+        self.assertTrue(100 in index)
+        self.assertFalse(300 in index)
+        c = index.connector(100)
+        self.assertEqual(c['location'], (100., 0., 0.))
+        self.assertEqual(c['pre'], [(1, 11)])
+        self.assertEqual(c['post'], [(2, 21), (2, 22), (3, 32)])
+        sc = index.skeleton_connectors(2)
+        self.assertEqual(list(sc['pre']), [200])
+        self.assertEqual(list(sc['post']), [100])
+        self.assertEqual(len(index.skeleton_links(2)), 3)
+        self.assertEqual(
+            list(index.in_box((150., -1., -1.), (250., 1., 1.))), [200])
+        self.assertEqual(
+            index.to_conns(),
+            catmaid.algorithms.population.network.find_conns(
+                source.get_neuron(sid) for sid in source.skeleton_ids()))
+
+    def test_update(self):
+        index = catmaid.algorithms.population.network.ConnectorIndex()
+        index.add_source(source)
+        # re-adding a skeleton replaces its links
+        index.add_neuron(source.get_neuron(2))
+        self.assertEqual(len(index.links), 6)
+        # and updates the locations of its connectors
+        moved = chain_skeleton(
+            2, on_x([21, 22]), on_x([200]), [(21, 200, 'presynaptic_to')])
+        moved['vertices'][200]['y'] = 5.
+        index.add_neuron(catmaid.neuron.Neuron(moved))
+        self.assertEqual(index.connector(200)['location'], (200., 5., 0.))
+        self.assertEqual(index.connector(100)['location'], (100., 0., 0.))
+        index.add_neuron(source.get_neuron(2))
+        index.remove_skeleton(3)
+        self.assertEqual(list(index.skeleton_ids), [1, 2])
+        self.assertEqual(index.connector(100)['post'], [(2, 21), (2, 22)])
+        index.remove_skeleton(1)
+        self.assertEqual(index.connector(200)['post'], [])
+        index.remove_skeleton(2)
+        self.assertEqual(len(index), 0)
+        index.add_neuron(source.get_neuron(2))
+        self.assertEqual(len(index), 2)
+        tmp = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmp, 'connectors.npz')
+            index.save(fn)
+            loaded = catmaid.algorithms.population.network.ConnectorIndex.load(
+                fn)
+            self.assertEqual(loaded.to_conns(), index.to_conns())
+            # only skeletons that were not indexed are added
+            loaded.add_source(source)
+            self.assertEqual(list(loaded.skeleton_ids), [1, 2, 3])
+            self.assertEqual(len(loaded.links), 6)
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import unittest
+
+import numpy
+
+import catmaid
+
+
+class FakeConnection(object):
+    """Serves 4 x 4 tiles of 3 x 3 rows and columns, each filled with
+    10 * row + column + 1, the tile at (1, 1) fails"""
+    def __init__(self, shape=(4, 4)):
+        self.shape = shape
+        self.fetched = []
+
+    def fetch_tile_url(self, row, column, z_index, zoom=0, tiletype=4,
+                       xyz_format=None, stack_id=None):
+        if not (0 <= row < 3 and 0 <= column < 3):
+            raise catmaid.errors.InvalidUrl("Invalid tile")
+        return '{}/{}_{}'.format(z_index, row, column)
+
+    def fetch_tile(self, url=None, **kwargs):
+        self.fetched.append(url)
+        row, column = [int(i) for i in url.split('/')[1].split('_')]
+        if (row, column) == (1, 1):
+            raise IOError("failed")
+        return numpy.ones(self.shape, dtype='uint8') * (10 * row + column + 1)
+
+
+class MontageTest(unittest.TestCase):
+    def test_get_web_montage(self):
+        for threads in (None, 4):
+            conn = FakeConnection()
+            m = catmaid.algorithms.images.get_web_montage(
+                conn, (0, 1), (2, 3), 5, shp=(4, 4), threads=threads)
+            self.assertEqual(m.shape, (12, 12))
+            self.assertEqual(m.dtype, numpy.uint8)
+            self.assertEqual(
+                m[::4, ::4].tolist(),
+                [[2, 3, 0], [0, 13, 0], [22, 23, 0]])
+            self.assertEqual(len(conn.fetched), 6)
+        self.assertRaises(
+            ValueError, catmaid.algorithms.images.get_web_montage,
+            FakeConnection((4, 5)), (0, 0), (0, 0), 5, shp=(4, 4))
+
+
+class OverlayTest(unittest.TestCase):
+    def test_draw_points(self):
+        img = numpy.zeros((20, 30, 3), dtype='uint8')
+        xy = [(5.5, 4.), (28., 18.), (-10., 5.)]
+        drawn = catmaid.algorithms.images.draw_points(
+            img, xy, 3., [(1, 2, 3), (4, 5, 6), (7, 8, 9)])
+        self.assertEqual(drawn.tolist(), [True, True, False])
+        y, x = numpy.mgrid[:20, :30]
+        drawn = numpy.zeros((20, 30), dtype=bool)
+        for ((px, py), c) in zip(xy[:2], (1, 4)):
+            mask = (x - px) ** 2 + (y - py) ** 2 <= 9
+            self.assertTrue((img[mask, 0] == c).all())
+            drawn |= mask
+        self.assertEqual((img[..., 0] > 0).tolist(), drawn.tolist())
+
+    def test_draw_lines(self):
+        img = numpy.zeros((10, 10, 3), dtype='uint8')
+        catmaid.algorithms.images.draw_lines(
+            img, [(1, 1), (0, 9)], [(8, 1), (9, 0)], (1, 1, 1))
+        self.assertEqual(img[1, 1:9, 0].tolist(), [1] * 8)
+        self.assertEqual(
+            img[numpy.arange(10), 9 - numpy.arange(10), 0].tolist(),
+            [1] * 10)
+        self.assertEqual(img[..., 0].sum(), 18 - 1)
+
+    def test_add_points_to_image(self):
+        image = numpy.zeros((10, 20), dtype='uint8')
+        points = [(1, 12, 12), (2, 27, 17), (1, 22, 12), (2, 12, 17)]
+        # only the given edges are drawn, not list neighbors
+        edges = [(12, 12, 22, 12), (12, 17, 27, 17)]
+        img = catmaid.algorithms.images.add_points_to_image(
+            points, image, None, (10, 10), 0, radius=1., edges=edges,
+            colors=[(1, 0, 0), (2, 0, 0), (1, 0, 0), (2, 0, 0)],
+            edge_colors=[(1, 0, 0), (2, 0, 0)])
+        self.assertEqual(img.shape, (10, 20, 3))
+        self.assertEqual(img[2, 2:13, 0].tolist(), [1] * 11)
+        self.assertEqual(img[7, 2:18, 0].tolist(), [2] * 16)
+        self.assertEqual(img[3:7, 2, 0].tolist(), [1, 0, 0, 2])
+        # the first two points are not connected
+        self.assertEqual(img[3:7, 5:11, 0].max(), 0)
+        img = catmaid.algorithms.images.add_points_to_image(
+            points, image, None, (10, 10), 0, radius=1.)
+        self.assertEqual(img[2, 5, 0], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import unittest
+
+import numpy
+
+import catmaid
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixtures import make_skeleton  # noqa: E402
+
+
+# a 'Y' shaped neuron with edges of length 100, 35 and 250
+y_nron = catmaid.neuron.Neuron(make_skeleton(
+    {'1': (0., 0., 0.), '2': (100., 0., 0.), '3': (100., 35., 0.),
+     '4': (100., 0., 250.)},
+    {'2': '1', '3': '2', '4': '2'}))
+
+
+class ResampleTest(unittest.TestCase):
+    def test_resample_tree(self):
+        nodes = numpy.array([[0., 0., 0.], [100., 0., 0.], [100., 0., 30.]])
+        edges = numpy.array([[0, 1], [1, 2]])
+        points, segments, edge_ids = \
+            catmaid.algorithms.morphology.resample_tree(nodes, edges, 40.)
+        # 100 -> 3 sub-edges, 30 -> 1 sub-edge
+        self.assertEqual(len(segments), 4)
+        self.assertEqual(list(edge_ids), [0, 0, 0, 1])
+        self.assertEqual(len(points), 5)
+        numpy.testing.assert_allclose(points[:3], nodes)
+        numpy.testing.assert_allclose(points[3:], [[40., 0, 0], [80., 0, 0]])
+        self.assertEqual(segments[0, 0], 0)
+        self.assertEqual(segments[2, 1], 1)
+        self.assertEqual(tuple(segments[3]), (1, 2))
+        # sub-edges are connected
+        for i in (0, 1):
+            self.assertEqual(segments[i, 1], segments[i + 1, 0])
+
+    def test_resample_tree_no_resampling(self):
+        nodes = numpy.array([[0., 0., 0.], [100., 0., 0.]])
+        edges = numpy.array([[0, 1]])
+        points, segments, edge_ids = \
+            catmaid.algorithms.morphology.resample_tree(
+                nodes, edges, numpy.inf)
+        numpy.testing.assert_allclose(points, nodes)
+        self.assertEqual(segments.tolist(), [[0, 1]])
+
+    def test_resampled_edge_array(self):
+        ea = catmaid.algorithms.morphology.resampled_edge_array(
+            y_nron, distance=40.)
+        lengths = numpy.linalg.norm(ea[:, 3:] - ea[:, :3], axis=1)
+        self.assertEqual(len(ea), 3 + 1 + 7)
+        self.assertTrue(numpy.all(lengths <= 40. + 1e-9))
+        self.assertAlmostEqual(lengths.sum(), 385.)
+
+    def test_resampled_node_array(self):
+        na = catmaid.algorithms.morphology.resampled_node_array(
+            y_nron, distance=40.)
+        # 4 nodes + 2 + 0 + 6 interpolated points
+        self.assertEqual(na.shape, (12, 3))
+
+
+
+class SmoothedTest(unittest.TestCase):
+    def test_smoothed(self):
+        # a chain along x that zig zags in y and z
+        nids = [str(i) for i in range(10)]
+        n = catmaid.neuron.Neuron(make_skeleton(
+            dict([(nid, (i * 100., (i % 2) * 50., (i % 2) * 60.))
+                  for (i, nid) in enumerate(nids)]),
+            dict(zip(nids[1:], nids[:-1]))))
+        c = n.node_coordinates
+        # z is kept by default
+        s = n.smoothed().node_coordinates
+        self.assertEqual(s[:, 2].tolist(), c[:, 2].tolist())
+        self.assertTrue(numpy.abs(s[:, 1] - c[:, 1]).max() > 1.)
+        # unless other (or no) axes are fixed
+        s = n.smoothed(fix_axes=[]).node_coordinates
+        self.assertTrue(numpy.abs(s[:, 2] - c[:, 2]).max() > 1.)
+        s = n.smoothed(fix_axes=[1]).node_coordinates
+        self.assertEqual(s[:, 1].tolist(), c[:, 1].tolist())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+import unittest
+
+import networkx
+import numpy
+import scipy.sparse
+
+import catmaid
+
+
+na = catmaid.algorithms.population.network_analysis
+
+
+def random_network(n, p, seed=0):
+    r = numpy.random.RandomState(seed)
+    d = (r.rand(n, n) < p) * r.randint(1, 4, (n, n))
+    G = networkx.DiGraph()
+    G.add_nodes_from(range(n))
+    G.add_edges_from(
+        (i, j) for i in range(n) for j in range(n) if d[i, j] and i != j)
+    return scipy.sparse.csr_matrix(d), G
+
+
+class NetworkAnalysisTest(unittest.TestCase):
+    def test_degrees(self):
+        # 0 -> 1 (2 synapses), 1 -> 0, 1 -> 2, 2 -> 2
+        m = scipy.sparse.csr_matrix(numpy.array([
+            [0, 2, 0], [1, 0, 1], [0, 0, 5]]))
+        i, o = na.degrees(m)
+        self.assertEqual(i.tolist(), [1, 1, 1])
+        self.assertEqual(o.tolist(), [1, 2, 0])
+        i, o = na.degrees(m, weighted=True)
+        self.assertEqual(i.tolist(), [1, 2, 1])
+        i, o = na.degrees(m, threshold=2)
+        self.assertEqual(o.tolist(), [1, 0, 0])
+        self.assertEqual(
+            na.dyad_census(m),
+            {'mutual': 1, 'asymmetric': 1, 'null': 1})
+        self.assertAlmostEqual(na.reciprocity(m), 2 / 3.)
+
+    def test_triad_census(self):
+        for (n, p) in ((30, .1), (40, .3), (5, .9), (3, 0.)):
+            m, G = random_network(n, p)
+            self.assertEqual(
+                na.triad_census(m, chunk_size=7),
+                networkx.triadic_census(G))
+
+    def test_paths(self):
+        m, G = random_network(40, .05, seed=1)
+        sources = [0, 5]
+        h = na.hop_distances(m, sources)
+        for (k, s) in enumerate(sources):
+            d = networkx.single_source_shortest_path_length(G, s)
+            self.assertEqual(
+                h[k].tolist(), [d.get(t, -1) for t in range(40)])
+            r = networkx.single_source_shortest_path_length(G, s, cutoff=2)
+            self.assertEqual(
+                numpy.where(na.reachable(m, sources, 2)[k])[0].tolist(),
+                sorted(r))
+            for t in range(40):
+                path = na.shortest_path(m, s, t)
+                if t not in d:
+                    self.assertIsNone(path)
+                    continue
+                self.assertEqual(path[0], s)
+                self.assertEqual(path[-1], t)
+                self.assertEqual(len(path) - 1, d[t])
+                for (u, v) in zip(path[:-1], path[1:]):
+                    self.assertTrue(G.has_edge(u, v))
+
+
+if __name__ == '__main__':
+    unittest.main()
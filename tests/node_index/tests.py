@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+
+import catmaid
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixtures import FakeSource, chain_skeleton  # noqa: E402
+
+
+# skeleton 1 runs along z at (0, 0), skeleton 2 along x at z = 50
+# connector 100 is presynaptic to the first node of skeleton 1
+source = FakeSource.from_skeletons([
+    chain_skeleton(1, dict([
+        (10 + i, (0., 0., i * 50.)) for i in range(5)]),
+        {100: (10., 0., 50.)}, [(10, 100, 'presynaptic_to')]),
+    chain_skeleton(2, dict([
+        (20 + i, (i * 100., 0., 50.)) for i in range(3)])),
+])
+
+
+class NodeIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = catmaid.algorithms.population.node_index.NodeIndex()
+        self.index.add_source(source)
+
+    def test_queries(self):
+        index = self.index
+        self.assertEqual(len(index), 9)
+        # z is sorted
+        self.assertTrue(numpy.all(numpy.diff(index.nodes['z']) >= 0))
+        z = index.z_section(50.)
+        self.assertEqual(sorted(z['node']), [11, 20, 21, 22, 100])
+        self.assertEqual(list(index.z_section(50., connectors=True)['node']),
+                         [100])
+        self.assertEqual(len(index.z_section(25., tolerance=25.)), 6)
+        b = index.box((-1., -1., 0.), (150., 1., 100.))
+        self.assertEqual(sorted(b['node']), [10, 11, 12, 20, 21, 100])
+        self.assertEqual(
+            list(index.skeletons_in_box((50., -1., 0.), (150., 1., 100.))),
+            [2])
+        r = index.radius((0., 0., 50.), 15., connectors=False)
+        self.assertEqual(sorted(r['node']), [11, 20])
+        n, d = index.nearest((0., 0., 200.), k=2)
+        self.assertEqual(list(n['node']), [14, 13])
+        numpy.testing.assert_allclose(d, [0., 50.])
+        n, d = index.nearest((0., 0., 200.), k=1, connectors=True)
+        self.assertEqual(list(n['node']), [100])
+
+    def test_update(self):
+        index = self.index
+        index.remove_skeleton(2)
+        self.assertEqual(list(index.skeleton_ids), [1])
+        self.assertEqual(len(index.z_section(50.)), 2)
+        index.add_neuron(source.get_neuron(2))
+        index.add_neuron(source.get_neuron(2))
+        self.assertEqual(len(index), 9)
+        tmp = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmp, 'nodes.npz')
+            index.save(fn)
+            loaded = catmaid.algorithms.population.node_index.NodeIndex.load(
+                fn)
+            self.assertEqual(loaded.nodes.tolist(), index.nodes.tolist())
+            self.assertEqual(len(loaded.radius((0., 0., 0.), 1.)), 1)
+        finally:
+            shutil.rmtree(tmp)
+
+
+class SectionIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = catmaid.algorithms.population.node_index.SectionIndex(
+            z_resolution=50.)
+        self.index.add_source(source)
+
+    def test_section(self):
+        index = self.index
+        self.assertEqual(list(index.section_of([0., 24., 26., 200.])),
+                         [0, 0, 1, 4])
+        nodes, edges = index.section(1)
+        self.assertEqual(sorted(nodes['node']), [11, 20, 21, 22])
+        # 2 edges of skeleton 1 cross section 1 and 2 lie in it
+        self.assertEqual(len(edges), 4)
+        e = edges[edges['skeleton'] == 1]
+        self.assertEqual(sorted(zip(e['z0'], e['z1'])), [
+            (25., 50.), (50., 75.)])
+        e = edges[edges['skeleton'] == 2]
+        self.assertEqual(sorted(e['x0']), [0., 100.])
+        nodes, edges = index.section(5)
+        self.assertEqual(len(nodes), 0)
+        self.assertEqual(len(edges), 0)
+
+    def test_sections(self):
+        index = self.index
+        sections = list(index.sections())
+        self.assertEqual([s[0] for s in sections], [0, 1, 2, 3, 4])
+        for (s, nodes, edges) in sections:
+            n, e = index.section(s)
+            self.assertEqual(sorted(nodes.tolist()), sorted(n.tolist()))
+            self.assertEqual(sorted(edges.tolist()), sorted(e.tolist()))
+        self.assertEqual([s[0] for s in index.sections(2, 3)], [2, 3])
+        self.assertEqual(len(list(index.sections(2, 3))[0][2]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy
+import pykalman
+
+import catmaid
+from catmaid.algorithms import smoothing
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+import fixtures  # noqa: E402
+
+
+def make_skeleton(sid):
+    """A Y shaped skeleton with 3 neurites of 6 nodes along z"""
+    nodes = {}
+    parents = {}
+    branches = ((0, 0), (1, 0), (-1, 0))
+    nid = sid * 100
+    parent = None
+    bifurcation = None
+    for (b, (dx, dy)) in enumerate(branches):
+        if b > 0:
+            parent = bifurcation
+        for i in range(6):
+            z = (i if b == 0 else 5 + i + 1) * 60.
+            nodes[str(nid)] = (10. * dx * i + (i % 2) * 3., 10. * dy * i, z)
+            if parent is not None:
+                parents[str(nid)] = str(parent)
+            parent = nid
+            nid += 1
+        if b == 0:
+            bifurcation = parent
+    return fixtures.make_skeleton(nodes, parents, sid=sid)
+
+
+class WithCoordinatesTest(unittest.TestCase):
+    def test_with_coordinates(self):
+        sk = make_skeleton(1)
+        sk['vertices']['1000'] = {
+            'x': 1., 'y': 2., 'z': 3., 'type': 'connector', 'labels': []}
+        sk['connectivity']['101']['1000'] = {'type': 'presynaptic_to'}
+        sk['vertices']['105']['labels'].append('bifurcation')
+        n = catmaid.neuron.Neuron(sk)
+        dgraph = n.dgraph
+        c = n.node_coordinates
+        self.assertEqual(len(n.node_ids), 18)
+        self.assertEqual(n.node_ids[:2], ['100', '101'])
+        self.assertEqual(c[1].tolist(), [3., 0., 60.])
+        m = n.with_coordinates(c + 1.)
+        self.assertEqual(m.node_ids, n.node_ids)
+        self.assertEqual(m.node_coordinates.tolist(), (c + 1.).tolist())
+        self.assertEqual(n.node_coordinates.tolist(), c.tolist())
+        self.assertIs(m.dgraph, dgraph)
+        self.assertEqual(m.tags, {'bifurcation': ['105']})
+        self.assertIs(m.connectors['1000'], n.connectors['1000'])
+        self.assertEqual(len(m.output_synapses), 1)
+        self.assertRaises(ValueError, n.with_coordinates, c[1:])
+
+    def test_smooth_coordinates(self):
+        n = catmaid.neuron.Neuron(make_skeleton(1))
+        ns = smoothing.NeuronSmoother(
+            60., kalman_mode='neuron', fix_applicate=True)
+        c = ns.smooth_coordinates(n)
+        self.assertEqual(c.shape, (18, 3))
+        self.assertEqual(c[:, 2].tolist(), n.node_coordinates[:, 2].tolist())
+        self.assertEqual(
+            ns.smooth(n).node_coordinates.tolist(), c.tolist())
+
+    def test_single_node(self):
+        sk = make_skeleton(1)
+        sk['vertices'] = {'100': sk['vertices']['100']}
+        sk['connectivity'] = {}
+        n = catmaid.neuron.Neuron(sk)
+        for mode in ('neurite', 'neuron'):
+            ns = smoothing.NeuronSmoother(60., kalman_mode=mode)
+            self.assertEqual(
+                ns.smooth_coordinates(n).tolist(),
+                n.node_coordinates.tolist())
+        self.assertEqual(smoothing.smooth_tracings([]), [])
+
+
+class BifurcationTest(unittest.TestCase):
+    def test_newbifurcs(self):
+        n = catmaid.neuron.Neuron(make_skeleton(1))
+        neurites = catmaid.algorithms.morphology.unique_neurites(n)
+        self.assertEqual(
+            sorted(neurites),
+            [tuple(str(i) for i in (100, 101, 102, 103, 104, 105)),
+             tuple(str(i) for i in (105, 106, 107, 108, 109, 110, 111)),
+             tuple(str(i) for i in (105, 112, 113, 114, 115, 116, 117))])
+        bifpos = smoothing.newbifurcs(n, neurites, maxpts=5, minpts=3)
+        self.assertEqual(sorted(bifpos), ['100', '105', '111', '117'])
+        # the bifurcation is moved to the closest point of 3 lines
+        lines = [
+            smoothing.defline(catmaid.algorithms.morphology.node_array(
+                n, [str(nid) for nid in nids])) for nids in (
+                    (105, 104, 103, 102), (105, 106, 107, 108),
+                    (105, 112, 113, 114))]
+        p = smoothing.lineintersect3D(
+            numpy.vstack([line[0] for line in lines]),
+            numpy.vstack([line[1] for line in lines]))
+        numpy.testing.assert_allclose(bifpos['105'][:2], p[:2])
+        self.assertEqual(bifpos['105'][2], n.nodes['105']['z'])
+        self.assertEqual(
+            bifpos['111'].tolist(),
+            n.node_coordinates[n.node_ids.index('111')].tolist())
+
+
+class KalmanTest(unittest.TestCase):
+    def test_mask_missing(self):
+        arr = numpy.array([
+            [0., 0., 0.], [1., 1., 60.], [2., 2., 180.], [3., 3., 120.],
+            [4., 4., 300.]])
+        m = smoothing.mask_missing(arr, 60.)
+        self.assertEqual(
+            m.mask[:, 0].tolist(),
+            [False, False, True, True, False, False, True, True, True,
+             False])
+        self.assertEqual(m.compressed().reshape((-1, 3)).tolist(),
+                         arr.tolist())
+
+    def test_rts_smooth(self):
+        r = numpy.random.RandomState(0)
+        arrs = []
+        for n in (2, 5, 9, 17, 30):
+            z = numpy.cumsum(r.choice([60., 120., 60.], n))
+            arrs.append(smoothing.mask_missing(numpy.column_stack((
+                numpy.cumsum(r.randn(n) * 20.),
+                numpy.cumsum(r.randn(n) * 20.), z)), 60.))
+        params = smoothing.fit_kalman(arrs)
+        states = smoothing.rts_smooth(arrs, params, batch_size=2)
+        for (arr, s) in zip(arrs, states):
+            kf = pykalman.KalmanFilter(
+                initial_state_mean=arr[0].data, n_dim_obs=3, n_dim_state=3,
+                **params)
+            numpy.testing.assert_allclose(
+                s, kf.smooth(arr)[0], rtol=1e-9, atol=1e-6)
+        smoothed = smoothing.smooth_tracings(
+            [arr.compressed().reshape((-1, 3)) for arr in arrs], zres=60.,
+            fix_applicate=True, params=params)
+        for (arr, s) in zip(arrs, smoothed):
+            self.assertEqual(
+                s[:, 2].tolist(),
+                arr.compressed().reshape((-1, 3))[:, 2].tolist())
+
+
+class SmoothSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.skeletons = os.path.join(self.tmp, 'skeletons')
+        self.out = os.path.join(self.tmp, 'smooth')
+        os.makedirs(self.skeletons)
+        for sid in (1, 2):
+            with open(os.path.join(
+                    self.skeletons, '{}.json'.format(sid)), 'w') as f:
+                json.dump(make_skeleton(sid), f)
+        self.source = catmaid.get_source(self.skeletons)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_smooth_source(self):
+        variants = ['gaussian_fixed', 'kalman_unmasked_fixed']
+        errors = smoothing.smooth_source(
+            self.source, self.out, variants=variants,
+            smoother=smoothing.NeuronSmoother(60., kalman_mode='neuron'))
+        self.assertEqual(errors, {})
+        for variant in variants:
+            for sid in (1, 2):
+                fn = smoothing.variant_filename(self.out, variant, sid)
+                with open(fn, 'r') as f:
+                    n = catmaid.neuron.Neuron(json.load(f))
+                self.assertEqual(len(n.nodes), 18)
+                # z is fixed
+                for nid in n.nodes:
+                    self.assertEqual(
+                        n.nodes[nid]['z'],
+                        self.source.get_neuron(sid).nodes[nid]['z'])
+        self.assertFalse(os.path.exists(smoothing.variant_filename(
+            self.out, 'gaussian_not_fixed', 1)))
+        # finished results are not recomputed
+        fn = smoothing.variant_filename(self.out, 'gaussian_fixed', 1)
+        with open(fn, 'w') as f:
+            f.write('done')
+        smoothing.smooth_source(self.source, self.out, variants=variants)
+        with open(fn, 'r') as f:
+            self.assertEqual(f.read(), 'done')
+        self.assertRaises(
+            ValueError, smoothing.smooth_source, self.source, self.out,
+            ['unknown'])
+
+    def test_gaussian_z(self):
+        skeleton = make_skeleton(3)
+        for (i, v) in enumerate(sorted(skeleton['vertices'])):
+            skeleton['vertices'][v]['z'] += (i % 2) * 20.
+        neuron = catmaid.neuron.Neuron(skeleton)
+        ns = smoothing.NeuronSmoother(60.)
+        os.makedirs(self.out)
+        dz = {}
+        for variant in ('gaussian_fixed', 'gaussian_not_fixed'):
+            fn = os.path.join(self.out, variant + '.json')
+            smoothing.smooth_variant(ns, neuron, variant, fn)
+            with open(fn, 'r') as f:
+                verts = json.load(f)['vertices']
+            dz[variant] = max(
+                abs(verts[v]['z'] - skeleton['vertices'][v]['z'])
+                for v in verts)
+        self.assertEqual(dz['gaussian_fixed'], 0.)
+        self.assertTrue(dz['gaussian_not_fixed'] > 1.)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -7,9 +7,14 @@ add tests for: all_neurons, all_neuron_iters, neurons_from_sk_list
 '''
 
 import json
+import math
+import shutil
+import tempfile
 import unittest
 import os
 
+import numpy
+
 import catmaid
 
 
@@ -60,6 +65,48 @@ class FileSourceTests(unittest.TestCase):
         self.assertEqual(self.file_source.get_neuron('9586').skeleton,
                          self.skel9586)
 
+    def test_tree_synapses_in_conns(self):
+        neurons = [
+            self.file_source.get_neuron(sid)
+            for sid in self.file_source.skeleton_ids()]
+        conns = catmaid.algorithms.population.network.find_conns(neurons)
+        for n in neurons:
+            tree = catmaid.rendering.converter.neuron_to_tree(n)
+            self.assertTrue(len(tree['synapses']) > 0)
+            for (cid, location, labels) in tree['synapses']:
+                self.assertIn(cid, conns)
+                self.assertIn(
+                    tree['skeleton_id'],
+                    conns[cid]['pre'] + conns[cid]['post'])
+
+    def test_myelination_report(self):
+        table = self.file_source.myelination_report()
+        self.assertEqual(table['skeleton'].tolist(), [9586, 72324])
+        self.assertEqual(table['axon'].tolist(), [16410, 116413])
+        self.assertEqual(table['trunk'].tolist(), [822784, 834786])
+        self.assertAlmostEqual(table['length'][0], 225747.32950808448)
+        self.assertAlmostEqual(table['pmas'][0], 44529.95078299283)
+        self.assertAlmostEqual(table['myelinated'][0], 30903.326999058398)
+        self.assertTrue(math.isnan(table['pmas'][1]))
+        self.assertEqual(table['myelinated'][1], 0.)
+        n = self.file_source.get_neuron(9586)
+        self.assertEqual(
+            n.myelination['16410']['dist'], table['length'][0])
+        tmp = tempfile.mkdtemp()
+        try:
+            for ext in ('csv', 'npz'):
+                fn = os.path.join(tmp, 'myelination.' + ext)
+                self.file_source.myelination_report(fn=fn)
+                loaded = catmaid.algorithms.population.myelination.load_table(
+                    fn)
+                self.assertEqual(
+                    loaded[['skeleton', 'axon', 'trunk']].tolist(),
+                    table[['skeleton', 'axon', 'trunk']].tolist())
+                numpy.testing.assert_allclose(
+                    loaded['length'], table['length'])
+        finally:
+            shutil.rmtree(tmp)
+
 
 if __name__ == '__main__':
     unittest.main()
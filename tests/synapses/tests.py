@@ -1,17 +1,16 @@
 #!/usr/bin/env python
 
-import json
 import unittest
 import os
+import shutil
+import sys
+import tempfile
 
 import catmaid
 
-
-def load_skeleton(fn):
-    f = open(fn, 'r')
-    skel = json.load(f)
-    f.close()
-    return skel
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..'))
+from fixtures import FakeSource, load_skeleton  # noqa: E402
 
 
 fake_skeletons_loc = os.path.realpath('fake_skeletons')
@@ -29,6 +28,11 @@ fake_nron_pd_far = catmaid.neuron.Neuron(fake_skel_pd_far)
 fake_nron_pp = catmaid.neuron.Neuron(fake_skel_pp)
 
 
+fake_source = FakeSource({
+    0: fake_nron_noaxon, 1: fake_nron_pd_close, 2: fake_nron_pd_far,
+    3: fake_nron_pp})
+
+
 class SynapsesTest(unittest.TestCase):
     def setUp(self):
         pass
@@ -40,6 +44,60 @@ class SynapsesTest(unittest.TestCase):
         self.assertEqual(catmaid.algorithms.population.synapses.skeleton_overlap(fake_nron_pd_far, fake_nron_noaxon), 8.9792607011065419e-09)
         self.assertEqual(catmaid.algorithms.population.synapses.skeleton_overlap(fake_nron_pp, fake_nron_noaxon), 3.5917339121251888e-08)
 
+    def test_skeleton_overlap_tolerance(self):
+        synapses = catmaid.algorithms.population.synapses
+        for nron in (fake_nron_pd_close, fake_nron_pd_far, fake_nron_pp):
+            exact = synapses.skeleton_overlap(
+                nron, fake_nron_noaxon, tolerance=None)
+            self.assertAlmostEqual(
+                synapses.skeleton_overlap(nron, fake_nron_noaxon) / exact,
+                1., places=5)
+        # a tiny cutoff excludes all cylinder pairs
+        self.assertEqual(synapses.skeleton_overlap(
+            fake_nron_pd_far, fake_nron_noaxon, sig=1e-3), 0.)
+
+    def test_overlap_matrix(self):
+        synapses = catmaid.algorithms.population.synapses
+        m = synapses.overlap_matrix(fake_source).toarray()
+        self.assertEqual(m.shape, (4, 4))
+        # no self overlap and no axon on skeleton 0
+        self.assertEqual(list(m.diagonal()), [0., 0., 0., 0.])
+        self.assertEqual(list(m[0]), [0., 0., 0., 0.])
+        for a in (1, 2, 3):
+            for d in (0, 1, 2, 3):
+                if a == d:
+                    continue
+                ov = synapses.skeleton_overlap(
+                    fake_source.get_neuron(a), fake_source.get_neuron(d))
+                self.assertAlmostEqual(m[a, d] / 1e-9, ov / 1e-9)
+
+    def test_overlap_matrix_checkpoint(self):
+        synapses = catmaid.algorithms.population.synapses
+        m = synapses.overlap_matrix(fake_source, tolerance=None)
+        d = tempfile.mkdtemp()
+        try:
+            for _ in range(2):
+                c = synapses.overlap_matrix(
+                    fake_source, tolerance=None, checkpoint_dir=d,
+                    chunk_size=1, block_size=1)
+                self.assertAlmostEqual(abs(m - c).max() / 1e-9, 0.)
+            # chunks are renamed into place, no partial files are left
+            self.assertEqual(
+                [fn for fn in os.listdir(d) if fn.endswith('.tmp')], [])
+            self.assertRaises(
+                ValueError, synapses.overlap_matrix, fake_source,
+                checkpoint_dir=d)
+        finally:
+            shutil.rmtree(d)
+
+    def test_overlap_matrix_processes(self):
+        synapses = catmaid.algorithms.population.synapses
+        m = synapses.overlap_matrix(fake_source, tolerance=None)
+        p = synapses.overlap_matrix(
+            fake_source, tolerance=None, processes=2, chunk_size=1,
+            block_size=1)
+        self.assertAlmostEqual(abs(m - p).max() / 1e-9, 0.)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+
+import copy
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from StringIO import StringIO
+
+import numpy
+from PIL import Image
+
+import catmaid
+
+
+def make_tile(value, shape=(4, 4)):
+    return numpy.ones(shape, dtype='uint8') * value
+
+
+def encode(tile):
+    f = StringIO()
+    Image.fromarray(tile).save(f, format='png')
+    return f.getvalue()
+
+
+class TileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_lru(self):
+        cache = catmaid.tiles.TileCache(max_bytes=3 * 16)
+        for i in range(3):
+            cache.put((1, 3, 4, 0, 0, 0, i), make_tile(i))
+        # touch the first tile so the second is evicted
+        self.assertEqual(cache.get((1, 3, 4, 0, 0, 0, 0))[0, 0], 0)
+        cache.put((1, 3, 4, 0, 0, 0, 3), make_tile(3))
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.nbytes, 3 * 16)
+        self.assertIsNone(cache.get((1, 3, 4, 0, 0, 0, 1)))
+        self.assertEqual(cache.get((1, 3, 4, 0, 0, 0, 2))[0, 0], 2)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_disk(self):
+        for compress in (True, False):
+            d = os.path.join(self.directory, str(compress))
+            cache = catmaid.tiles.TileCache(
+                max_bytes=16, directory=d, compress=compress)
+            cache.put((1, 3, 4, 0, 5, 1, 2), make_tile(7))
+            cache.put((1, 3, '8_xz', 0, 5, 1, 3), make_tile(8))
+            # the first tile is only on disk
+            self.assertEqual(len(cache), 1)
+            tile = cache.get((1, 3, 4, 0, 5, 1, 2))
+            self.assertEqual(tile.tolist(), make_tile(7).tolist())
+            self.assertEqual(isinstance(tile, numpy.memmap), not compress)
+            self.assertFalse(tile.flags.writeable)
+            # a new cache finds the tiles on disk
+            cache = catmaid.tiles.TileCache(directory=d, compress=compress)
+            self.assertEqual(len(cache), 0)
+            self.assertIn((1, 3, '8_xz', 0, 5, 1, 3), cache)
+            self.assertEqual(
+                cache.get((1, 3, '8_xz', 0, 5, 1, 3))[0, 0], 8)
+            cache.clear(disk=True)
+            self.assertNotIn((1, 3, 4, 0, 5, 1, 2), cache)
+            self.assertEqual(cache.disk_nbytes, 0)
+
+    def test_disk_budget(self):
+        cache = catmaid.tiles.TileCache(
+            directory=self.directory, compress=False)
+        cache.put((1, 3, 4, 0, 0, 0, 0), make_tile(0))
+        size = cache.disk_nbytes
+        cache = catmaid.tiles.TileCache(
+            directory=self.directory, max_disk_bytes=2 * size,
+            compress=False)
+        for i in range(1, 4):
+            cache.put((1, 3, 4, 0, 0, 0, i), make_tile(i))
+        self.assertEqual(cache.disk_nbytes, 2 * size)
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(
+                self.directory, '1', '3', '4', '0', '0'))),
+            ['0_2.npy', '0_3.npy'])
+
+
+stack_info = {
+    'sid': 3, 'pid': 1, 'dimension': {'x': 2500, 'y': 1100, 'z': 10},
+    'mirrors': [{
+        'tile_width': 512, 'tile_height': 256, 'file_extension': 'jpg',
+        'image_base': 'http://tiles/stack/'}]}
+
+
+class TileSourceTest(unittest.TestCase):
+    def test_urls(self):
+        ts = catmaid.tiles.TileSource(stack_info, 'http://localhost/')
+        self.assertEqual(ts.url(1, 2, 5), 'http://tiles/stack/5/0/1_2.jpg')
+        self.assertEqual((ts.rows(), ts.columns()), (4, 4))
+        self.assertEqual((ts.rows(1), ts.columns(1)), (2, 2))
+        self.assertRaises(catmaid.errors.InvalidUrl, ts.url, 4, 0, 5)
+        self.assertRaises(catmaid.errors.InvalidUrl, ts.url, 0, 2, 5, 1)
+        self.assertEqual(
+            ts.urls([0, 3, 4], 1, [7, 8, 9]),
+            ['http://tiles/stack/7/0/0_1.jpg',
+             'http://tiles/stack/8/0/3_1.jpg', None])
+        ts = catmaid.tiles.TileSource(
+            stack_info, 'http://localhost/', tiletype=3)
+        self.assertEqual(
+            ts.url(1, 1, 5, 1),
+            'http://localhost/1/stack/3/tile?x=512&y=256&z=5&width=512'
+            '&height=256&scale=0.5&row=1&col=1&file_extension=jpg'
+            '&basename=http://tiles/stack/&type=all')
+
+    def test_xyz_format(self):
+        ts = catmaid.tiles.TileSource(
+            stack_info, 'http://localhost/', 6, 'xz')
+        self.assertEqual(
+            ts.url(1, 2, 5), 'http://tiles/stack/512_256/1024_5_256/jpg')
+        for f in ('yz', 'zy'):
+            ts = catmaid.tiles.TileSource(
+                stack_info, 'http://localhost/', 8, f)
+            self.assertEqual(ts.url(1, 2, 5), 'http://tiles/stack/yz/0/5_1_2')
+        self.assertRaises(
+            ValueError, catmaid.tiles.TileSource, stack_info,
+            'http://localhost/', 8)
+
+    def test_connection(self):
+        conn = catmaid.connection.Connection(
+            'http://localhost/', 'user', 'password', project=1,
+            login=False)
+        conn._cache['stack_info'] = {1: {3: stack_info}}
+        self.assertEqual(
+            conn.fetch_tile_url(1, 2, 5), 'http://tiles/stack/5/0/1_2.jpg')
+        self.assertEqual(
+            conn.fetch_tile_url(1, 2, 5, 0, 8, 'xy', 3),
+            'http://tiles/stack/xy/0/2_1_5')
+        self.assertIs(conn.tile_source(), conn.tile_source())
+
+
+class VolumeTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = catmaid.connection.Connection(
+            'http://localhost/', 'user', 'password', project=1,
+            login=False)
+        info = {
+            'sid': 3, 'pid': 1, 'dimension': {'x': 12, 'y': 8, 'z': 4},
+            'mirrors': [{
+                'tile_width': 4, 'tile_height': 4, 'file_extension': 'png',
+                'image_base': 'http://tiles/'}]}
+        self.conn._cache['stack_info'] = {1: {3: info}}
+        # pixels are 100 * z + 12 * y + x (in stack pixels)
+        y, x = numpy.mgrid[:4, :4]
+
+        def fetch(url, post=None, read=True):
+            z, zoom, tile = url.split('/')[-3:]
+            row, column = [int(i) for i in tile.split('.')[0].split('_')]
+            return encode((
+                100 * int(z) + 12 * (row * 4 + y) +
+                column * 4 + x).astype('uint8'))
+
+        self.conn.fetch = fetch
+        y, x = numpy.mgrid[:8, :12]
+        self.stack = numpy.array([
+            100 * z + 12 * y + x for z in range(2)], dtype='uint8')
+
+    def test_fetch_volume(self):
+        bbox = ((3, 2, 0), (14, 7, 2))
+        for threads in (None, 4):
+            v = self.conn.fetch_volume(bbox, threads=threads)
+            self.assertEqual(v.shape, (2, 5, 11))
+            self.assertEqual(v.dtype, numpy.uint8)
+            # columns outside of the stack are 0
+            self.assertEqual(v[:, :, :9].tolist(),
+                             self.stack[:, 2:7, 3:].tolist())
+            self.assertEqual(v[:, :, 9:].max(), 0)
+        d = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(d, 'volume.npy')
+            v = self.conn.fetch_volume(((0, 0, 0), (12, 8, 2)), filename=fn)
+            self.assertIsInstance(v, numpy.memmap)
+            self.assertEqual(numpy.load(fn).tolist(), self.stack.tolist())
+        finally:
+            shutil.rmtree(d)
+
+    def test_iter_volume(self):
+        self.conn.enable_tile_cache()
+        sections = list(self.conn.iter_volume(
+            ((1, 1, 0), (9, 6, 2)), prefetch=1))
+        self.assertEqual([z for (z, _) in sections], [0, 1])
+        for (z, section) in sections:
+            self.assertEqual(
+                section.tolist(), self.stack[z, 1:6, 1:9].tolist())
+
+    def test_iter_volume_z_indices(self):
+        fetch = self.conn.fetch
+        fetched = []
+
+        def failing_fetch(url, post=None, read=True):
+            z = int(url.split('/')[-3])
+            fetched.append(z)
+            if z == 2:
+                raise IOError("tile not found")
+            return fetch(url, post, read)
+
+        self.conn.fetch = failing_fetch
+        self.conn.enable_tile_cache()
+        bbox = ((1, 1, 0), (9, 6, 4))
+        # section 1 is left out, 2 fails
+        sections = list(self.conn.iter_volume(
+            bbox, prefetch=2, z_indices=[0, 2, 3]))
+        self.conn.tile_cache.close()
+        self.assertEqual([z for (z, _) in sections], [0, 2, 3])
+        self.assertNotIn(1, fetched)
+        self.assertEqual(sections[1][1].max(), 0)
+        sections = list(self.conn.iter_volume(
+            bbox, z_indices=[0, 2, 3], skip_missing=True))
+        self.assertEqual([z for (z, _) in sections], [0, 3])
+
+
+class ConnectionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.conn = catmaid.connection.Connection(
+            'http://localhost/', 'user', 'password', project=1,
+            login=False)
+        # one stack (with the same id) in each of 2 projects
+        self.conn._cache['stack_info'] = {}
+        for pid in (1, 2):
+            info = copy.deepcopy(stack_info)
+            info['pid'] = pid
+            info['mirrors'][0]['image_base'] = 'http://tiles/{}/'.format(pid)
+            self.conn._cache['stack_info'][pid] = {3: info}
+        self.fetched = []
+
+        def fetch(url, post=None, read=True):
+            self.fetched.append(url)
+            pid, z, zoom, tile = url.split('/')[-4:]
+            column = int(tile.split('.')[0].split('_')[1])
+            return encode(make_tile(100 * int(pid) + 10 * int(z) + column))
+
+        self.conn.fetch = fetch
+
+    def tearDown(self):
+        if self.conn.tile_cache is not None:
+            self.conn.tile_cache.close()
+
+    def test_fetch_tile(self):
+        self.conn.enable_tile_cache()
+        for i in range(2):
+            tile = self.conn.fetch_tile(0, 1, 2)
+            self.assertEqual(tile.tolist(), make_tile(121).tolist())
+            # a copy of the cached tile is returned
+            tile[:] = 0
+        self.assertEqual(len(self.fetched), 1)
+        self.assertIn((1, 3, 4, 0, 2, 0, 1), self.conn.tile_cache)
+        # the same tile of another project is another tile
+        self.conn.set_project(2)
+        self.assertEqual(self.conn.fetch_tile(0, 1, 2)[0, 0], 221)
+        self.assertEqual(len(self.fetched), 2)
+        # tiles requested only by url are not cached
+        self.conn.fetch_tile(url='http://tiles/1/5/0/0_0.jpg')
+        self.conn.fetch_tile(url='http://tiles/1/5/0/0_0.jpg')
+        self.assertEqual(len(self.fetched), 4)
+
+    def test_prefetch(self):
+        self.conn.enable_tile_cache()
+        self.conn.prefetch_tiles([0], [0, 1], [1, 2])
+        source = self.conn.tile_source()
+        keys = [
+            source.cache_key(0, c, z) for z in (1, 2) for c in (0, 1)]
+        for i in range(100):
+            if all(k in self.conn.tile_cache for k in keys):
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.conn.fetch_tile(0, 1, 2, stack_id=3)[0, 0], 121)
+        self.assertEqual(len(self.fetched), 4)
+        self.conn.tile_cache.close()
+        self.assertIsNone(self.conn.tile_cache._pool)
+
+    def test_fetch_pending(self):
+        fetch = self.conn.fetch
+
+        def slow_fetch(url, post=None, read=True):
+            time.sleep(0.2)
+            return fetch(url, post, read)
+
+        self.conn.fetch = slow_fetch
+        self.conn.enable_tile_cache()
+        self.conn.prefetch_tiles([0], [1], [2])
+        # the tile being prefetched is waited for, not fetched again
+        self.assertEqual(self.conn.fetch_tile(0, 1, 2)[0, 0], 121)
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(self.conn.tile_cache._pending, {})
+
+
+if __name__ == '__main__':
+    unittest.main()